@@ -0,0 +1,520 @@
+"""
+Benchmark which runs the signaling server locally and simulates clients of it
+
+Every simulated pair of users goes through the same steps as the messenger client:
+login_request -> register_request -> connection_request -> offer/answer exchange,
+then relays messages to each other while both are online and while one of them is offline.
+Results are printed as JSON so runs on different commits can be compared with --compare.
+
+Example:
+    python benchmark.py --pairs 1000 --messages 20 --output results.json
+    python benchmark.py --pairs 1000 --messages 20 --compare results.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+import multiprocessing
+import resource
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+
+from websockets.asyncio.client import connect, ClientConnection
+
+from request import Request
+from codec import Codec, get_codec
+import loop_monitor
+from objects_server import Server
+from storage import create_storage
+
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentiles(values: list[float]) -> dict:
+    """Returns percentiles and maximum of latencies in milliseconds, nearest-rank method"""
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    result = {"count": len(values)}
+    for percentile in PERCENTILES:
+        index = max(0, -(-len(values) * percentile // 100) - 1)
+        result[f"p{percentile}"] = round(values[index] * 1000, 3)
+    result["max"] = round(values[-1] * 1000, 3)
+    return result
+
+
+def run_server(port: int, metrics_port: int, storage: str, event_loop: str):
+    """Runs server in the benchmark child process"""
+    logging.basicConfig(level=logging.WARNING)
+    # All simulated users connect from this machine, limits of one address would throttle the whole run
+    Server.ADDRESS_RATE_LIMITS = {}
+    sqlite_path = ""
+    if storage == "sqlite":
+        sqlite_path = os.path.join(tempfile.mkdtemp(prefix="messenger-benchmark-"), "storage.sqlite3")
+    server = Server("127.0.0.1", port, storage=create_storage(storage, Server.SERVER_DATABASE_URL, sqlite_path))
+    server.METRICS_HOST = "127.0.0.1"
+    server.metrics_port = metrics_port
+    loop_monitor.run(server.run(), event_loop)
+
+
+def process_rss(pid: int) -> int | None:
+    """Returns resident memory of the process in bytes, None where /proc is not available"""
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def current_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def scrape_metrics(port: int) -> dict[str, float]:
+    """Returns values of metrics exposed by the server by name with labels"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    await writer.drain()
+    response = (await reader.read()).decode()
+    writer.close()
+
+    values = {}
+    for line in response.split("\r\n\r\n", 1)[-1].splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            values[name] = float(value)
+    return values
+
+
+class BenchmarkConnection:
+    """Websocket of simulated client, received requests are kept in queues by type"""
+    def __init__(self, websocket: ClientConnection, codec: Codec):
+        self.__websocket = websocket
+        self.__codec = codec
+        self.__queues: dict[str, asyncio.Queue] = {}
+        self.__reader_task = asyncio.create_task(self.__read())
+
+    @classmethod
+    async def open(cls, uri: str, subprotocol: str | None, timeout: float,
+                   compression: str | None) -> 'BenchmarkConnection':
+        websocket = await connect(
+            uri,
+            subprotocols=[subprotocol] if subprotocol else None,
+            open_timeout=timeout,
+            max_size=None,
+            compression=compression
+        )
+        return cls(websocket, get_codec(websocket.subprotocol))
+
+    def __queue(self, request_type: str) -> asyncio.Queue:
+        queue = self.__queues.get(request_type)
+        if queue is None:
+            queue = self.__queues[request_type] = asyncio.Queue()
+        return queue
+
+    async def __read(self):
+        async for frame in self.__websocket:
+            request = self.__codec.decode(frame)
+            self.__queue(request.type).put_nowait(request)
+
+    async def send(self, request_type: str, user_id: str, content: dict):
+        frame = self.__codec.encode(Request(request_type=request_type, user_id=user_id, content=content))
+        await self.__websocket.send(frame, text=self.__codec.text)
+
+    async def receive(self, request_type: str, timeout: float) -> Request:
+        return await asyncio.wait_for(self.__queue(request_type).get(), timeout)
+
+    async def close(self):
+        self.__reader_task.cancel()
+        await self.__websocket.close()
+
+
+class SimulatedUser:
+    """User with main websocket and chat websocket to the other user of the pair"""
+    def __init__(self, user_id: str, target_user_id: str):
+        self.user_id = user_id
+        self.target_user_id = target_user_id
+        self.main: BenchmarkConnection | None = None
+        self.chat: BenchmarkConnection | None = None
+
+    async def close(self):
+        for connection in {self.main, self.chat} - {None}:
+            await connection.close()
+        self.main = self.chat = None
+
+
+class Benchmark:
+    """Runs benchmark phases against the server and collects results"""
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.uri = f"ws://127.0.0.1:{args.port}"
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.phase_durations: dict[str, float] = {}
+        self.counters: dict[str, int] = {}
+        self.__semaphore = asyncio.Semaphore(args.concurrency)
+        self.__sdp = "v=0" + "x" * args.sdp_size
+        self.__padding = "m" * args.message_size
+
+        self.offerers = [SimulatedUser(f"bench_a_{index}", f"bench_b_{index}") for index in range(args.pairs)]
+        self.answerers = [SimulatedUser(f"bench_b_{index}", f"bench_a_{index}") for index in range(args.pairs)]
+
+    @property
+    def users(self) -> list[SimulatedUser]:
+        return self.offerers + self.answerers
+
+    def __count(self, name: str, amount: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    async def __timed(self, name: str, coroutine):
+        start = time.perf_counter()
+        result = await coroutine
+        self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+        return result
+
+    async def __run_phase(self, name: str, step, items: list):
+        """Runs step for every item, at most args.concurrency at a time"""
+        async def run_step(item):
+            async with self.__semaphore:
+                try:
+                    await step(item)
+                except Exception as e: # Failed steps are counted, others go on
+                    key = f"{name}:{type(e).__name__}"
+                    self.errors[key] = self.errors.get(key, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(run_step(item) for item in items))
+        self.phase_durations[name] = time.perf_counter() - start
+
+    async def __open(self) -> BenchmarkConnection:
+        self.__count("connections")
+        return await self.__timed(
+            "handshake", BenchmarkConnection.open(
+                self.uri, self.args.subprotocol, self.args.timeout,
+                None if self.args.compression == "none" else self.args.compression
+            )
+        )
+
+    async def __connect_main(self, user: SimulatedUser):
+        user.main = await self.__open()
+
+    async def __add_user(self, user: SimulatedUser):
+        await user.main.send("add_user_to_data_base", user.user_id, {
+            "user_id": user.user_id, "email": f"{user.user_id}@benchmark.local", "password": "0" * 64
+        })
+        await self.__timed("add_user", user.main.receive("add_user_to_data_base_response", self.args.timeout))
+
+    async def __login(self, user: SimulatedUser):
+        await user.main.send("login_request", user.user_id, {"long_term_public_key": f"ltk_{user.user_id}"})
+        await self.__timed("login", user.main.receive("created_chats", self.args.timeout))
+
+    async def __send_chat(self, user: SimulatedUser, request_type: str, content: dict):
+        if self.args.multiplex:
+            content = {**content, "channel": user.target_user_id}
+        await user.chat.send(request_type, user.user_id, content)
+
+    async def __register(self, user: SimulatedUser) -> int:
+        """Opens chat websocket and registers it, returns number of stored messages received"""
+        # Multiplexed chat runs over the main websocket
+        user.chat = user.main if self.args.multiplex else await self.__open()
+        start = time.perf_counter()
+        await self.__send_chat(user, "register_request", {
+            "target_user_id": user.target_user_id, "public_key": f"pk_{user.user_id}"
+        })
+        stored_messages = 0
+        has_more = True
+        while has_more:
+            chunk = await user.chat.receive("send_stored_messages", self.args.timeout)
+            stored_messages += len(chunk.content["message"])
+            has_more = chunk.content.get("has_more", False)
+        await user.chat.receive("register_response", self.args.timeout)
+        self.latencies.setdefault("register", []).append(time.perf_counter() - start)
+        self.__count("stored_messages_received", stored_messages)
+        return stored_messages
+
+    async def __connection_request(self, user: SimulatedUser):
+        await self.__send_chat(user, "connection_request", {"target_user_id": user.target_user_id})
+        await self.__timed("connection_request", user.chat.receive("connection_response", self.args.timeout))
+
+    async def __join(self, user: SimulatedUser):
+        """
+        Offerers join while the other users are offline and wait for them,
+        answerers join after them and start connection
+        """
+        await self.__login(user)
+        await self.__register(user)
+        await self.__connection_request(user)
+
+    async def __exchange_offer(self, index: int):
+        """Answerer sends offer, offerer replies with answer, round trip is measured at the answerer"""
+        offerer, answerer = self.offerers[index], self.answerers[index]
+        await offerer.chat.receive("connection_establishment_request", self.args.timeout)
+
+        start = time.perf_counter()
+        await self.__send_chat(answerer, "share_offer_request", {
+            "target_user_id": offerer.user_id, "offer": self.__sdp
+        })
+        await offerer.chat.receive("share_offer_request", self.args.timeout)
+        await self.__send_chat(offerer, "share_answer_request", {
+            "target_user_id": answerer.user_id, "answer": self.__sdp
+        })
+        await answerer.chat.receive("share_answer_request", self.args.timeout)
+        self.latencies.setdefault("offer_answer", []).append(time.perf_counter() - start)
+
+    async def __send_messages(self, sender: SimulatedUser, count: int):
+        for _ in range(count):
+            await self.__send_chat(sender, "relay_message_request", {
+                "target_user": sender.target_user_id,
+                "message": f"{time.perf_counter()}:{self.__padding}",
+                "public_key": f"pk_{sender.user_id}"
+            })
+
+    async def __relay_online(self, index: int):
+        """Both users of the pair send messages to each other, delivery latency is measured by receiver"""
+        offerer, answerer = self.offerers[index], self.answerers[index]
+
+        async def receive_messages(receiver: SimulatedUser):
+            for _ in range(self.args.messages):
+                request = await receiver.chat.receive("relay_message_request", self.args.timeout)
+                message = request.content["message"]
+                if isinstance(message, bytes): # Pass-through payload
+                    message = message.decode()
+                sent_at = float(message.split(":", 1)[0])
+                self.latencies.setdefault("relay_online", []).append(time.perf_counter() - sent_at)
+                self.__count("relay_online_delivered")
+
+        await asyncio.gather(
+            self.__send_messages(offerer, self.args.messages),
+            self.__send_messages(answerer, self.args.messages),
+            receive_messages(offerer),
+            receive_messages(answerer)
+        )
+
+    async def __relay_offline(self, index: int):
+        await self.__send_messages(self.offerers[index], self.args.messages)
+        self.__count("relay_offline_sent", self.args.messages)
+
+    async def __rejoin_answerer(self, user: SimulatedUser):
+        user.main = await self.__open()
+        await self.__login(user)
+        await self.__register(user)
+
+    async def __wait_online_users(self, expected: int):
+        """Waits until server has handled disconnects, so following messages take offline path"""
+        deadline = time.perf_counter() + self.args.timeout
+        while time.perf_counter() < deadline:
+            metrics = await scrape_metrics(self.args.metrics_port)
+            if metrics.get("messenger_online_users", 0) <= expected:
+                return
+            await asyncio.sleep(0.05)
+        self.errors["wait_online_users:timeout"] = 1
+
+    async def __wait_requests_handled(self, request_type: str, expected: int):
+        """Waits until server has handled requests which were sent, they may still be in its queues"""
+        name = f'messenger_request_duration_seconds_count{{request_type="{request_type}"}}'
+        deadline = time.perf_counter() + self.args.timeout
+        while time.perf_counter() < deadline:
+            metrics = await scrape_metrics(self.args.metrics_port)
+            if metrics.get(name, 0) >= expected:
+                return
+            await asyncio.sleep(0.05)
+        self.errors[f"wait_{request_type}:timeout"] = 1
+
+    async def run(self, server_pid: int) -> dict:
+        rss_before = process_rss(server_pid)
+        pairs = list(range(self.args.pairs))
+
+        await self.__run_phase("connect", self.__connect_main, self.users)
+        await self.__run_phase("add_user", self.__add_user, self.users)
+        await self.__run_phase("join_offerers", self.__join, self.offerers)
+        await self.__run_phase("join_answerers", self.__join, self.answerers)
+        await self.__run_phase("offer_answer", self.__exchange_offer, pairs)
+
+        rss_online = process_rss(server_pid)
+        metrics_online = await scrape_metrics(self.args.metrics_port)
+
+        await self.__run_phase("relay_online", self.__relay_online, pairs)
+
+        for user in self.answerers:
+            await user.close()
+        await self.__wait_online_users(self.args.pairs)
+        await self.__run_phase("relay_offline", self.__relay_offline, pairs)
+        # Offline messages are counted as stored once server has handled them, not once they were sent
+        start = time.perf_counter()
+        await self.__wait_requests_handled("relay_message_request", 3 * self.args.pairs * self.args.messages)
+        self.phase_durations["relay_offline"] += time.perf_counter() - start
+        await self.__run_phase("rejoin_answerers", self.__rejoin_answerer, self.answerers)
+        metrics_end = await scrape_metrics(self.args.metrics_port)
+
+        for user in self.users:
+            await user.close()
+
+        clients = 2 * self.args.pairs
+        connect_phases = ("connect", "join_offerers", "join_answerers")
+        connect_time = sum(self.phase_durations[phase] for phase in connect_phases)
+        users_in_memory = metrics_online.get("messenger_users_in_memory", 0)
+        compression_input = metrics_end.get('messenger_compression_bytes_total{stage="input"}', 0)
+        compression_output = metrics_end.get('messenger_compression_bytes_total{stage="output"}', 0)
+
+        return {
+            "connections": {
+                "count": self.counters.get("connections", 0),
+                "per_second": round(self.counters.get("connections", 0) / connect_time, 1)
+            },
+            "latency_ms": {name: percentiles(values) for name, values in self.latencies.items()},
+            "throughput": {
+                "relay_online_messages_per_second": round(
+                    self.counters.get("relay_online_delivered", 0) / self.phase_durations["relay_online"], 1),
+                "relay_offline_messages_per_second": round(
+                    self.counters.get("relay_offline_sent", 0) / self.phase_durations["relay_offline"], 1),
+                "stored_messages_delivered_per_second": round(
+                    self.counters.get("stored_messages_received", 0) / self.phase_durations["rejoin_answerers"], 1)
+            },
+            "messages": {
+                "relay_online_delivered": self.counters.get("relay_online_delivered", 0),
+                "relay_offline_sent": self.counters.get("relay_offline_sent", 0),
+                "stored_messages_received": self.counters.get("stored_messages_received", 0)
+            },
+            "memory": {
+                "server_rss_bytes": rss_online,
+                "server_rss_bytes_per_client": (
+                    round((rss_online - rss_before) / clients) if rss_online and rss_before else None),
+                "presence_table_bytes": metrics_online.get("messenger_presence_table_bytes"),
+                "presence_table_bytes_per_user": (
+                    round(metrics_online["messenger_presence_table_bytes"] / users_in_memory)
+                    if users_in_memory else None)
+            },
+            "compression": {
+                "messages_compressed": metrics_end.get('messenger_compressed_messages_total{result="compressed"}', 0),
+                "messages_skipped": metrics_end.get('messenger_compressed_messages_total{result="skipped"}', 0),
+                "bytes_saved": compression_input - compression_output,
+                "ratio": round(compression_output / compression_input, 3) if compression_input else None,
+                "cpu_seconds": round(metrics_end.get("messenger_compression_seconds_sum", 0), 3)
+            },
+            "phase_seconds": {name: round(duration, 3) for name, duration in self.phase_durations.items()},
+            "errors": self.errors
+        }
+
+
+def flatten(results: dict, prefix: str = "") -> dict[str, float]:
+    """Returns numeric values of nested results by dotted names"""
+    values = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[f"{prefix}{name}"] = value
+    return values
+
+
+def compare(results: dict, baseline: dict) -> dict[str, dict]:
+    """Returns change of every metric relative to the baseline run"""
+    current, previous = flatten(results["results"]), flatten(baseline["results"])
+    changes = {}
+    for name in sorted(current.keys() & previous.keys()):
+        if previous[name]:
+            changes[name] = {
+                "baseline": previous[name],
+                "current": current[name],
+                "change_percent": round((current[name] - previous[name]) / previous[name] * 100, 1)
+            }
+    return changes
+
+
+async def wait_for_server(uri: str, timeout: float):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            async with connect(uri):
+                return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def run_benchmark(args: argparse.Namespace, server_pid: int) -> dict:
+    await wait_for_server(f"ws://127.0.0.1:{args.port}", args.timeout)
+    return await Benchmark(args).run(server_pid)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pairs", type=int, default=500, help="pairs of simulated users, each user has 2 websockets")
+    parser.add_argument("--messages", type=int, default=20, help="messages sent by each user in relay phases")
+    parser.add_argument("--message-size", type=int, default=256, help="bytes of padding in relayed messages")
+    parser.add_argument("--sdp-size", type=int, default=2000, help="bytes of offers and answers")
+    parser.add_argument("--concurrency", type=int, default=200, help="users which run phase step at the same time")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for each response")
+    parser.add_argument("--subprotocol", default=None,
+                        help="codec negotiated by clients, e.g. messenger.msgpack, JSON if not set")
+    parser.add_argument("--multiplex", action="store_true",
+                        help="chats run over the main websocket with channel ids instead of own websockets")
+    parser.add_argument("--compression", choices=("deflate", "none"), default="deflate",
+                        help="permessage-deflate offered by clients")
+    parser.add_argument("--event-loop", choices=("asyncio", "uvloop"), default="asyncio",
+                        help="event loop backend of the server")
+    parser.add_argument("--storage", choices=("memory", "sqlite", "postgres"), default="memory",
+                        help="memory, SQLite file in temporary directory or local Postgres from DATABASE_URL")
+    parser.add_argument("--port", type=int, default=9900)
+    parser.add_argument("--metrics-port", type=int, default=9901)
+    parser.add_argument("--output", help="file to write JSON results to, stdout if not set")
+    parser.add_argument("--compare", help="JSON results of previous run to compare with")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # Every simulated user has two websockets, both ends are open in this machine
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit < hard_limit:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+
+    server_process = multiprocessing.Process(
+        target=run_server, args=(args.port, args.metrics_port, args.storage, args.event_loop), daemon=True
+    )
+    server_process.start()
+    try:
+        results = asyncio.run(run_benchmark(args, server_process.pid))
+    finally:
+        server_process.terminate()
+        server_process.join()
+
+    output = {
+        "benchmark": "signaling_server",
+        "commit": current_commit(),
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "parameters": {name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+        "results": results
+    }
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            output["comparison"] = compare(output, json.load(file))
+
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    sys.exit(1 if results["errors"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""buses which connect several server workers sharing presence and routing state"""
+import asyncio
+import json
+import logging
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable
+
+import asyncpg
+
+from request import Request, encode_payload
+from server_logging import log_event, logger
+
+BusMessageHandler = Callable[[dict], Awaitable[None]]
+
+
+class MessageBus(ABC):
+    """
+    Base class for buses between server workers
+    Messages published by one worker are delivered to the others in the order they were published
+    """
+    @abstractmethod
+    async def start(self, worker_id: str, handle_message: BusMessageHandler):
+        """Starts delivering messages for the worker to handle_message"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def broadcast(self, message: dict):
+        """Sends message to all workers except the sender"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def send(self, worker_id: str, message: dict):
+        """Sends message to one worker"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def close(self):
+        """Stops delivering messages to the worker"""
+        raise NotImplementedError
+
+
+class LocalBus:
+    """
+    Bus between workers running in the same process, e.g. to run several workers in one process locally
+    One LocalBus object is shared by all servers which should act as workers of one deployment,
+    each of them gets its own endpoint from attach()
+    """
+    def __init__(self):
+        self.__queues: dict[str, asyncio.Queue] = {} # worker_id: queue of messages to it
+        self.__tasks: dict[str, asyncio.Task] = {}
+
+    def attach(self) -> MessageBus:
+        """Returns bus endpoint for one more worker"""
+        return _LocalBusEndpoint(self)
+
+    async def _start(self, worker_id: str, handle_message: BusMessageHandler):
+        queue = asyncio.Queue()
+        self.__queues[worker_id] = queue
+        self.__tasks[worker_id] = asyncio.create_task(_deliver_messages(queue, handle_message))
+
+    async def _broadcast(self, sender_worker_id: str, message: dict):
+        for worker_id, queue in self.__queues.items():
+            if worker_id != sender_worker_id:
+                queue.put_nowait(message)
+
+    async def _send(self, worker_id: str, message: dict):
+        queue = self.__queues.get(worker_id)
+        if queue is None:
+            log_event("bus_message_dropped", logging.WARNING, worker_id=worker_id, reason="unknown_worker")
+            return
+        queue.put_nowait(message)
+
+    async def _close(self, worker_id: str):
+        self.__queues.pop(worker_id, None)
+        task = self.__tasks.pop(worker_id, None)
+        if task is not None:
+            task.cancel()
+
+
+class _LocalBusEndpoint(MessageBus):
+    """LocalBus endpoint used by one worker"""
+    def __init__(self, local_bus: LocalBus):
+        self.__local_bus = local_bus
+        self.__worker_id = None
+
+    async def start(self, worker_id: str, handle_message: BusMessageHandler):
+        self.__worker_id = worker_id
+        await self.__local_bus._start(worker_id, handle_message)
+
+    async def broadcast(self, message: dict):
+        await self.__local_bus._broadcast(self.__worker_id, message)
+
+    async def send(self, worker_id: str, message: dict):
+        await self.__local_bus._send(worker_id, message)
+
+    async def close(self):
+        await self.__local_bus._close(self.__worker_id)
+
+
+class PostgresBus(MessageBus):
+    """
+    Bus between workers built on Postgres LISTEN/NOTIFY
+    Messages to one worker larger than NOTIFY payload limit are stored in bus_messages table
+    and only their id is sent in the notification
+    """
+    BROADCAST_CHANNEL = "messenger_workers"
+    WORKER_CHANNEL_PREFIX = "messenger_worker_"
+    MAX_PAYLOAD_SIZE = 7900 # Postgres limit is 8000 bytes
+
+    def __init__(self, database_url: str, pool_size: int = 2):
+        self.__database_url = database_url
+        self.__pool_size = pool_size
+        self.__worker_id = None
+        self.__handle_message: BusMessageHandler | None = None
+        self.__listen_connection: asyncpg.Connection | None = None
+        self.__pool: asyncpg.Pool | None = None
+        self.__queue: asyncio.Queue = asyncio.Queue()
+        self.__deliver_task: asyncio.Task | None = None
+
+    async def start(self, worker_id: str, handle_message: BusMessageHandler):
+        self.__worker_id = worker_id
+        self.__handle_message = handle_message
+        self.__pool = await asyncpg.create_pool(self.__database_url, min_size=1, max_size=self.__pool_size)
+        self.__listen_connection = await asyncpg.connect(self.__database_url)
+        await self.__listen_connection.add_listener(self.BROADCAST_CHANNEL, self.__on_notification)
+        await self.__listen_connection.add_listener(self.__worker_channel(worker_id), self.__on_notification)
+        self.__deliver_task = asyncio.create_task(_deliver_messages(self.__queue, self.__load_and_handle))
+
+    async def broadcast(self, message: dict):
+        message = {**message, "sender_worker_id": self.__worker_id}
+        payload = json.dumps(message, default=encode_payload)
+        if len(payload.encode()) > self.MAX_PAYLOAD_SIZE:
+            raise ValueError(f"Broadcast message is too large ({len(payload)} bytes).")
+        await self.__pool.execute("SELECT pg_notify($1, $2);", self.BROADCAST_CHANNEL, payload)
+
+    async def send(self, worker_id: str, message: dict):
+        payload = json.dumps(message, default=encode_payload)
+        async with self.__pool.acquire() as conn:
+            if len(payload.encode()) > self.MAX_PAYLOAD_SIZE:
+                async with conn.transaction():
+                    message_id = await conn.fetchval(
+                        "INSERT INTO bus_messages (payload) VALUES ($1) RETURNING id;", payload
+                    )
+                    payload = json.dumps({"stored_message_id": message_id})
+                    await conn.execute("SELECT pg_notify($1, $2);", self.__worker_channel(worker_id), payload)
+            else:
+                await conn.execute("SELECT pg_notify($1, $2);", self.__worker_channel(worker_id), payload)
+
+    async def close(self):
+        if self.__deliver_task is not None:
+            self.__deliver_task.cancel()
+        if self.__listen_connection is not None:
+            await self.__listen_connection.close()
+        if self.__pool is not None:
+            await self.__pool.close()
+
+    def __worker_channel(self, worker_id: str) -> str:
+        return f"{self.WORKER_CHANNEL_PREFIX}{worker_id}"
+
+    def __on_notification(self, connection, pid, channel, payload):
+        message = json.loads(payload)
+        if message.get("sender_worker_id") == self.__worker_id:
+            return # Own broadcast
+        self.__queue.put_nowait(message)
+
+    async def __load_and_handle(self, message: dict):
+        """Loads message which was too large for notification payload before handling it"""
+        if "stored_message_id" in message:
+            payload = await self.__pool.fetchval(
+                "DELETE FROM bus_messages WHERE id = $1 RETURNING payload;", message["stored_message_id"]
+            )
+            if payload is None:
+                return
+            message = json.loads(payload)
+        await self.__handle_message(message)
+
+
+async def _deliver_messages(queue: asyncio.Queue, handle_message: BusMessageHandler):
+    """Passes messages from the queue to the handler one by one"""
+    while True:
+        message = await queue.get()
+        try:
+            await handle_message(message)
+        except Exception:
+            logger.exception("bus_message_failed", extra={"fields": {"bus_event": message.get("event")}})
+
+
+class RemoteWebSocket:
+    """
+    Stand-in for websocket of the user which is connected to another worker
+    Messages sent to it are delivered by that worker
+    """
+    def __init__(self, bus: MessageBus, worker_id: str, user_id: str, chat_user_id: str | None):
+        self.bus = bus
+        self.worker_id = worker_id
+        self.user_id = user_id
+        self.chat_user_id = chat_user_id # None for main websocket
+
+    async def send(self, request: Request):
+        """Sends request to the worker which owns the websocket, it is encoded with the codec of the websocket there"""
+        await self.bus.send(self.worker_id, {
+            "event": "deliver",
+            "user_id": self.user_id,
+            "chat_user_id": self.chat_user_id,
+            "request": request.to_dict()
+        })
+
+    async def close(self):
+        """Websocket is closed by the worker which owns it"""
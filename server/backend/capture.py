@@ -0,0 +1,61 @@
+"""recording of received frames, captures are replayed and mutated by fuzz.py"""
+import json
+import time
+import base64
+
+
+class CapturedSession:
+    """Frames received by one connection in the order they came"""
+    __slots__ = ("subprotocol", "frames")
+
+    def __init__(self, subprotocol: str | None, frames: list[str | bytes] | None = None):
+        self.subprotocol = subprotocol
+        self.frames: list[str | bytes] = frames if frames is not None else []
+
+
+class FrameRecorder:
+    """
+    Appends every received frame to a JSON lines file, binary frames are base64 encoded
+    Frames carry passwords hashes, keys and messages, so it is meant for test environments only
+    Writes are buffered, the file is complete after close()
+    """
+    def __init__(self, path: str):
+        self.__file = open(path, "a", encoding="utf-8", buffering=1024 * 1024)
+
+    def record(self, connection_id: str, subprotocol: str | None, frame: str | bytes):
+        is_text = isinstance(frame, str)
+        self.__file.write(json.dumps({
+            "time": round(time.time(), 6),
+            "connection": connection_id,
+            "subprotocol": subprotocol,
+            "text": is_text,
+            "frame": frame if is_text else base64.b64encode(frame).decode()
+        }) + "\n")
+
+    def close(self):
+        self.__file.close()
+
+
+def read_capture(path: str) -> list[CapturedSession]:
+    """Reads capture file, sessions are ordered by their first frame"""
+    sessions: dict[str, CapturedSession] = {}
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            session = sessions.setdefault(record["connection"], CapturedSession(record["subprotocol"]))
+            frame = record["frame"]
+            session.frames.append(frame if record["text"] else base64.b64decode(frame))
+    return list(sessions.values())
+
+
+def write_capture(path: str, sessions: list[CapturedSession]):
+    """Writes sessions in capture format, e.g. frames which crashed the server for regression corpus"""
+    recorder = FrameRecorder(path)
+    try:
+        for index, session in enumerate(sessions):
+            for frame in session.frames:
+                recorder.record(f"session-{index}", session.subprotocol, frame)
+    finally:
+        recorder.close()
@@ -0,0 +1,149 @@
+"""codecs which convert requests to websocket frames and back, negotiated per connection as subprotocol"""
+import json
+import struct
+from abc import ABC, abstractmethod
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from request import MalformedRequestError, Request, encode_payload
+
+
+# Content field of requests which is only forwarded by the server, never read by it
+PASS_THROUGH_FIELDS = {
+    "share_offer_request": "offer",
+    "share_answer_request": "answer",
+    "relay_message_request": "message",
+}
+
+
+def _dumps_json(data: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, default=encode_payload)
+    return json.dumps(data, default=encode_payload, separators=(",", ":")).encode()
+
+
+def _loads_json(data: str | bytes) -> dict:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _check_payload(request_type: str, payload: bytes) -> bytes:
+    """Pass-through payloads received as bytes have to be UTF-8, stored messages and JSON carry them as text"""
+    try:
+        payload.decode()
+    except UnicodeDecodeError as e:
+        raise MalformedRequestError(f"Payload of {request_type} is not UTF-8") from e
+    return payload
+
+
+class Codec(ABC):
+    """Base class for codecs"""
+    subprotocol: str | None = None
+    text: bool = True # Frames are sent as text frames
+
+    @abstractmethod
+    def encode(self, request: Request) -> str | bytes:
+        """Converts request to websocket frame"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def decode(self, frame: str | bytes) -> Request:
+        """Converts websocket frame to request"""
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    """
+    JSON text frames, used by clients which do not negotiate subprotocol
+    orjson is used when it is installed
+    """
+    subprotocol = "messenger.json"
+
+    def encode(self, request: Request) -> bytes:
+        # Already UTF-8 encoded, sent as text frame
+        return _dumps_json(request.to_dict())
+
+    def decode(self, frame: str | bytes) -> Request:
+        return Request.from_dict(_loads_json(frame))
+
+
+class MsgPackCodec(Codec):
+    """MessagePack binary frames"""
+    subprotocol = "messenger.msgpack"
+    text = False
+
+    def encode(self, request: Request) -> bytes:
+        content = request.content
+        field = PASS_THROUGH_FIELDS.get(request.type)
+        if field is not None and isinstance(content.get(field), (bytearray, memoryview)):
+            content = {**content, field: bytes(content[field])}
+        return msgpack.packb({"type": request.type, "user_id": request.user_id, "content": content})
+
+    def decode(self, frame: bytes) -> Request:
+        request = Request.from_dict(msgpack.unpackb(frame))
+        field = PASS_THROUGH_FIELDS.get(request.type)
+        if field is not None and isinstance(request.content.get(field), bytes):
+            _check_payload(request.type, request.content[field])
+        return request
+
+
+class PassThroughCodec(Codec):
+    """
+    Binary frames which carry pass-through payload (SDP offer or answer, encrypted message) undecoded
+    Frame is 4 byte big-endian header length, JSON header with the rest of the request and raw payload
+    Payload is kept as bytes in request content and written to the outgoing frame as is
+    """
+    subprotocol = "messenger.passthrough"
+    text = False
+    HEADER_LENGTH = struct.Struct("!I")
+
+    def encode(self, request: Request) -> bytes:
+        content = request.content
+        payload = b""
+        field = PASS_THROUGH_FIELDS.get(request.type)
+        if field is not None and field in content:
+            value = content[field]
+            payload = value.encode() if isinstance(value, str) else value
+            content = {key: value for key, value in content.items() if key != field}
+
+        header = _dumps_json({"type": request.type, "user_id": request.user_id, "content": content})
+        return b"".join((self.HEADER_LENGTH.pack(len(header)), header, payload))
+
+    def decode(self, frame: bytes) -> Request:
+        header_end = self.HEADER_LENGTH.size + self.HEADER_LENGTH.unpack_from(frame)[0]
+        request = Request.from_dict(_loads_json(frame[self.HEADER_LENGTH.size:header_end]))
+
+        field = PASS_THROUGH_FIELDS.get(request.type)
+        if field is not None and len(frame) > header_end:
+            request.content[field] = _check_payload(request.type, frame[header_end:])
+        return request
+
+
+JSON_CODEC = JsonCodec()
+
+# Codecs which can be negotiated, in order of server preference
+CODECS: dict[str, Codec] = {PassThroughCodec.subprotocol: PassThroughCodec(), JSON_CODEC.subprotocol: JSON_CODEC}
+if msgpack is not None:
+    CODECS[MsgPackCodec.subprotocol] = MsgPackCodec()
+
+
+def select_subprotocol(connection, subprotocols: list[str]) -> str | None:
+    """Picks the first codec the client offered, connections without subprotocol use JSON"""
+    for subprotocol in subprotocols:
+        if subprotocol in CODECS:
+            return subprotocol
+    return None
+
+
+def get_codec(subprotocol: str | None) -> Codec:
+    """Returns codec of the connection with negotiated subprotocol"""
+    return CODECS.get(subprotocol, JSON_CODEC)
@@ -0,0 +1,82 @@
+"""permessage-deflate compression of outgoing messages which are big enough to benefit from it"""
+import time
+from typing import Sequence
+
+from websockets import frames
+from websockets.extensions.base import Extension
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.typing import ExtensionParameter
+
+from metrics import ServerMetrics
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    """
+    Compresses outgoing messages of at least threshold bytes, smaller ones are sent as is
+    Compressing tiny frames costs CPU and often makes them bigger because of deflate overhead
+    """
+    def __init__(self, *args, threshold: int, metrics: ServerMetrics | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__threshold = threshold
+        self.__metrics = metrics
+        self.__compress_message = True # Continuation frames follow the first frame of their message
+
+    def encode(self, frame: frames.Frame) -> frames.Frame:
+        if frame.opcode in frames.CTRL_OPCODES:
+            return frame
+        if frame.opcode is not frames.OP_CONT:
+            self.__compress_message = len(frame.data) >= self.__threshold
+            if self.__metrics is not None:
+                self.__metrics.compressed_messages.inc(result="compressed" if self.__compress_message else "skipped")
+        if not self.__compress_message:
+            # Message without rsv1 flag is not decompressed by the peer
+            return frame
+
+        started_at = time.perf_counter()
+        encoded_frame = super().encode(frame)
+        if self.__metrics is not None:
+            self.__metrics.compression_duration.observe(time.perf_counter() - started_at)
+            self.__metrics.compression_bytes.inc(len(frame.data), stage="input")
+            self.__metrics.compression_bytes.inc(len(encoded_frame.data), stage="output")
+        return encoded_frame
+
+
+class ThresholdPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+    """Negotiates permessage-deflate like the default factory, connections get ThresholdPerMessageDeflate"""
+    def __init__(self, threshold: int, metrics: ServerMetrics | None = None, **kwargs):
+        super().__init__(**kwargs)
+        self.__threshold = threshold
+        self.__metrics = metrics
+
+    def process_request_params(
+        self,
+        params: Sequence[ExtensionParameter],
+        accepted_extensions: Sequence[Extension],
+    ) -> tuple[list[ExtensionParameter], PerMessageDeflate]:
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            threshold=self.__threshold,
+            metrics=self.__metrics
+        )
+
+
+def compression_extensions(compression: str, threshold: int, level: int, window_bits: int,
+                           metrics: ServerMetrics | None = None) -> list[ThresholdPerMessageDeflateFactory]:
+    """Returns extensions for websockets.serve, compression is "deflate" or empty string to disable it"""
+    if not compression:
+        return []
+    if compression != "deflate":
+        raise ValueError(f"Unsupported websocket compression: {compression}")
+    return [ThresholdPerMessageDeflateFactory(
+        threshold,
+        metrics,
+        server_max_window_bits=window_bits,
+        client_max_window_bits=window_bits,
+        # memLevel 5 is websockets default, it uses less memory per connection than zlib default
+        compress_settings={"level": level, "memLevel": 5}
+    )]
@@ -0,0 +1,331 @@
+"""
+Replay and fuzz harness which drives recorded and mutated frames through the signaling server
+
+Server runs in this process with in-memory storage, sessions of frames are replayed over concurrent
+connections and part of the frames is mutated: fields are dropped or get values of wrong types,
+request types and target ids are replaced, frames are truncated. Requests which fail with unexpected
+exception and connections dropped by the server are reported as crashes, throughput is reported as well.
+
+Sessions come from capture files written by the server with CAPTURE_PATH set and from built-in seed
+sessions which go through every request type. Sessions which crashed the server can be saved with
+--save-crashes and replayed without mutations as regression corpus.
+
+Example:
+    python fuzz.py --duration 30 --save-crashes crashes.jsonl
+    python fuzz.py --corpus crashes.jsonl --mutation-rate 0
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import logging
+import traceback
+from collections import Counter, OrderedDict
+
+# Work factor of password hashes is lowered, so registration does not limit the rate
+os.environ.setdefault("SCRYPT_N", "16")
+
+import websockets
+from websockets.asyncio.client import connect
+
+from request import Request
+from codec import CODECS, get_codec
+from capture import CapturedSession, read_capture, write_capture
+from objects_server import Server
+from storage import MemoryStorage
+from server_logging import logger
+
+
+# Values which replace fields of mutated requests
+INTERESTING_VALUES = (
+    None, True, 0, -1, 2 ** 64, 1.5, "", "x" * 100_000, "\u0000", [], [None], ["user"], {}, {"user": 1}
+)
+# Sessions of which frames are kept to save the ones which crashed the server
+KEPT_SESSIONS = 10_000
+
+
+def seed_sessions(pairs: int) -> list[CapturedSession]:
+    """
+    Sessions of pairs of users which send every request type the server handles
+    Pairs use codecs the server supports in turn, JSON frames are text and other ones binary
+    """
+    subprotocols = [None, *CODECS]
+    sessions = []
+    for index in range(pairs):
+        subprotocol = subprotocols[index % len(subprotocols)]
+        codec = get_codec(subprotocol)
+
+        def frame(request_type: str, sender_id: str | None, **content) -> str | bytes:
+            encoded = codec.encode(Request(request_type=request_type, user_id=sender_id, content=content))
+            return encoded.decode() if codec.text and isinstance(encoded, bytes) else encoded
+
+        for user_id, target_user_id in ((f"a{index}", f"b{index}"), (f"b{index}", f"a{index}")):
+            email = f"{user_id}@fuzz.local"
+            sessions.append(CapturedSession(subprotocol, [
+                frame("add_user_to_data_base", None, user_id=user_id, email=email, password="0" * 64),
+                frame("get_user_info_from_data_base", None, email=email, password="0" * 64),
+                frame("check_user_existance_request", user_id, target_user_id=target_user_id),
+                frame("check_users_existance_request", user_id, target_user_ids=[target_user_id, "nobody"]),
+                frame("login_request", user_id, long_term_public_key=f"ltk_{user_id}"),
+                frame("send_long_term_public_key_request", user_id, long_term_public_key=f"ltk2_{user_id}"),
+                frame("get_long_term_public_key_request", user_id, target_user_id=target_user_id),
+                frame("get_long_term_public_keys_request", user_id, target_user_ids=[target_user_id, user_id]),
+                frame("subscribe_presence_request", user_id, target_user_ids=[target_user_id]),
+                frame("create_chat_request", user_id, target_user_id=target_user_id),
+                frame("created_chats_ack_request", user_id, cursor=1),
+                frame("register_request", user_id, target_user_id=target_user_id, public_key=f"pk_{user_id}"),
+                frame("connection_request", user_id, target_user_id=target_user_id),
+                frame("get_target_user_status_request", user_id, target_user_id=target_user_id),
+                frame("get_public_key_request", user_id, target_user_id=target_user_id),
+                frame("share_offer_request", user_id, target_user_id=target_user_id, offer="v=0 offer"),
+                frame("share_answer_request", user_id, target_user_id=target_user_id, answer="v=0 answer"),
+                frame("relay_message_request", user_id, target_user=target_user_id, message="hello",
+                      public_key=f"pk_{user_id}"),
+                frame("register_request", user_id, target_user_id=target_user_id, public_key=f"pk_{user_id}",
+                      channel=target_user_id),
+                frame("unsubscribe_presence_request", user_id, target_user_ids=[target_user_id]),
+            ]))
+    return sessions
+
+
+class FrameMutator:
+    """Returns mutated copies of frames, JSON frames are mutated structurally, binary ones byte-wise"""
+    def __init__(self, rng: random.Random):
+        self.__rng = rng
+        self.__request_types = list(Server.REQUEST_FIELDS) + ["unknown_request", "", "__class__"]
+
+    def mutate(self, frame: str | bytes) -> str | bytes:
+        if isinstance(frame, bytes):
+            return self.__mutate_bytes(frame)
+        try:
+            data = json.loads(frame)
+        except ValueError:
+            return self.__mutate_text(frame)
+        if not isinstance(data, dict) or self.__rng.random() < 0.1:
+            return self.__mutate_text(frame)
+        return json.dumps(self.__mutate_request(data))
+
+    def __mutate_request(self, data: dict):
+        rng = self.__rng
+        content = data.get("content") if isinstance(data.get("content"), dict) else data
+        match rng.randrange(7):
+            case 0: # Field is missing
+                target = rng.choice((data, content))
+                if target:
+                    del target[rng.choice(list(target))]
+            case 1: # Field has value of wrong type
+                target = rng.choice((data, content))
+                if target:
+                    target[rng.choice(list(target))] = rng.choice(INTERESTING_VALUES)
+            case 2:
+                data["type"] = rng.choice(self.__request_types)
+            case 3: # Target user which is not known to the server
+                for key in ("target_user_id", "target_user"):
+                    if key in content:
+                        content[key] = f"unknown{rng.randrange(1000)}"
+            case 4:
+                data["user_id"] = rng.choice((None, f"unknown{rng.randrange(1000)}", ""))
+            case 5:
+                content["channel"] = rng.choice(INTERESTING_VALUES)
+            case 6: # Whole frame is not an object
+                return rng.choice(INTERESTING_VALUES)
+        return data
+
+    def __mutate_text(self, frame: str) -> str:
+        if not frame:
+            return "{"
+        position = self.__rng.randrange(len(frame))
+        return frame[:position] if self.__rng.random() < 0.5 else frame[:position] + "\x00{" + frame[position:]
+
+    def __mutate_bytes(self, frame: bytes) -> bytes:
+        if not frame:
+            return b"\xff"
+        data = bytearray(frame)
+        for _ in range(self.__rng.randint(1, 4)):
+            data[self.__rng.randrange(len(data))] = self.__rng.randrange(256)
+        return bytes(data[:self.__rng.randint(1, len(data))]) if self.__rng.random() < 0.3 else bytes(data)
+
+
+class CrashCollector(logging.Handler):
+    """Collects exceptions logged by the server and ones of tasks nobody awaited"""
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.crashes: Counter = Counter() # signature: count
+        self.peers: dict[tuple, str] = {} # (host, port) of client which sent failed request: signature
+
+    @staticmethod
+    def signature(exception: BaseException) -> str:
+        frames = traceback.extract_tb(exception.__traceback__)
+        location = f"{os.path.basename(frames[-1].filename)}:{frames[-1].lineno}" if frames else "unknown"
+        # Handler of the request, the same helper fails differently in different handlers
+        handler = next((frame.name for frame in reversed(frames)
+                        if "__handle_" in frame.name and not frame.name.endswith("__handle_request")), None)
+        return f"{type(exception).__name__} at {location}" + (f" in {handler}" if handler else "")
+
+    def emit(self, record: logging.LogRecord):
+        if record.exc_info is None or record.exc_info[1] is None:
+            return
+        signature = self.signature(record.exc_info[1])
+        self.crashes[signature] += 1
+        peer = getattr(record, "fields", {}).get("peer")
+        if peer:
+            self.peers[tuple(peer[:2])] = signature
+
+    def handle_loop_exception(self, loop: asyncio.AbstractEventLoop, context: dict):
+        exception = context.get("exception")
+        if exception is None:
+            self.crashes[f"loop error: {context.get('message')}"] += 1
+        else:
+            self.crashes[self.signature(exception)] += 1
+
+
+class Fuzzer:
+    def __init__(self, args: argparse.Namespace, sessions: list[CapturedSession]):
+        self.args = args
+        self.uri = f"ws://127.0.0.1:{args.port}"
+        self.sessions = sessions
+        self.rng = random.Random(args.seed)
+        self.mutator = FrameMutator(self.rng)
+        self.collector = CrashCollector()
+        self.counters: Counter = Counter()
+        self.responses: Counter = Counter() # response type or error type: count
+        self.dropped: Counter = Counter() # close code of connections dropped by the server: count
+        self.sent_sessions: OrderedDict[tuple, CapturedSession] = OrderedDict() # client address: sent frames
+
+    async def __read(self, websocket, codec):
+        async for frame in websocket:
+            try:
+                response = codec.decode(frame)
+            except Exception:
+                self.responses["undecodable"] += 1
+                continue
+            if response.type == "error_response":
+                self.responses[f"error_response:{response.content.get('error_type')}"] += 1
+            else:
+                self.responses[response.type] += 1
+
+    async def __replay(self, session: CapturedSession):
+        """Sends frames of the session over new connection without waiting for responses"""
+        sent = CapturedSession(session.subprotocol)
+        try:
+            websocket = await connect(
+                self.uri, subprotocols=[session.subprotocol] if session.subprotocol else None, max_size=None
+            )
+        except (OSError, websockets.exceptions.InvalidHandshake):
+            self.counters["connect_failed"] += 1
+            return
+
+        self.sent_sessions[websocket.local_address[:2]] = sent
+        while len(self.sent_sessions) > KEPT_SESSIONS:
+            self.sent_sessions.popitem(last=False)
+        reader = asyncio.create_task(self.__read(websocket, get_codec(websocket.subprotocol)))
+        try:
+            for frame in session.frames:
+                if self.rng.random() < self.args.mutation_rate:
+                    frame = self.mutator.mutate(frame)
+                    self.counters["frames_mutated"] += 1
+                sent.frames.append(frame)
+                await websocket.send(frame, text=isinstance(frame, str))
+                self.counters["frames_sent"] += 1
+            # Responses to the last frames arrive before the connection is closed
+            await asyncio.sleep(self.args.linger)
+            await websocket.close()
+        except websockets.exceptions.ConnectionClosed as e:
+            close_code = e.rcvd.code if e.rcvd is not None else None
+            self.dropped[str(close_code)] += 1
+            self.collector.crashes[f"connection dropped with code {close_code}"] += 1
+        finally:
+            reader.cancel()
+            self.counters["sessions"] += 1
+
+    async def __worker(self, deadline: float):
+        while time.perf_counter() < deadline and self.counters["sessions"] < self.args.sessions:
+            await self.__replay(self.rng.choice(self.sessions))
+
+    async def run(self) -> dict:
+        asyncio.get_running_loop().set_exception_handler(self.collector.handle_loop_exception)
+        logger.addHandler(self.collector)
+        logger.propagate = False
+        # Connection handlers which fail are logged by websockets
+        logging.getLogger("websockets").addHandler(self.collector)
+        logging.getLogger("websockets").propagate = False
+
+        # Every frame has to reach handlers, limits would reject most of them at this rate
+        Server.RATE_LIMITS = {}
+        Server.RATE_LIMIT_DEFAULT = None
+        Server.ADDRESS_RATE_LIMITS = {}
+        Server.OVERLOAD_LOOP_LAG = float("inf")
+        Server.CAPTURE_PATH = ""
+        server = Server("127.0.0.1", self.args.port, storage=MemoryStorage())
+        server.metrics_port = 0
+        server_task = asyncio.create_task(server.run())
+        await asyncio.sleep(0.5)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(self.__worker(start + self.args.duration) for _ in range(self.args.connections)))
+        duration = time.perf_counter() - start
+
+        server.stop()
+        await server_task
+        logger.removeHandler(self.collector)
+        logging.getLogger("websockets").removeHandler(self.collector)
+
+        crashed_sessions = [session for address, session in self.sent_sessions.items()
+                            if address in self.collector.peers]
+        if self.args.save_crashes and crashed_sessions:
+            write_capture(self.args.save_crashes, crashed_sessions)
+
+        return {
+            "sessions": self.counters["sessions"],
+            "frames_sent": self.counters["frames_sent"],
+            "frames_mutated": self.counters["frames_mutated"],
+            "frames_per_second": round(self.counters["frames_sent"] / duration, 1),
+            "connect_failed": self.counters["connect_failed"],
+            "responses": dict(self.responses.most_common()),
+            "connections_dropped": dict(self.dropped),
+            "crashes": dict(self.collector.crashes.most_common()),
+            "crashed_sessions": len(crashed_sessions)
+        }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", nargs="*", default=[], help="capture files with sessions to replay")
+    parser.add_argument("--no-seeds", action="store_true", help="replay only sessions from corpus files")
+    parser.add_argument("--seed-pairs", type=int, default=20, help="pairs of users in built-in seed sessions")
+    parser.add_argument("--mutation-rate", type=float, default=0.3, help="part of frames which are mutated")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run")
+    parser.add_argument("--sessions", type=int, default=sys.maxsize, help="sessions to replay at most")
+    parser.add_argument("--connections", type=int, default=50, help="sessions replayed at the same time")
+    parser.add_argument("--linger", type=float, default=0.05, help="seconds to wait for responses before closing")
+    parser.add_argument("--seed", type=int, default=None, help="seed of random mutations")
+    parser.add_argument("--port", type=int, default=9910)
+    parser.add_argument("--save-crashes", help="file to write sessions which crashed the server to")
+    parser.add_argument("--output", help="file to write JSON results to, stdout if not set")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    sessions = [] if args.no_seeds else seed_sessions(args.seed_pairs)
+    for path in args.corpus:
+        sessions.extend(read_capture(path))
+    if not sessions:
+        raise SystemExit("No sessions to replay.")
+
+    results = asyncio.run(Fuzzer(args, sessions).run())
+    output = json.dumps({"fuzz": "signaling-server", "parameters": vars(args), "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    # Non-zero exit code fails regression runs
+    sys.exit(1 if results["crashes"] else 0)
+
+
+if __name__ == "__main__":
+    main()
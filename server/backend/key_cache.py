@@ -0,0 +1,43 @@
+"""bounded cache for long-term public keys of users"""
+import time
+from collections import OrderedDict
+
+
+MISSING = object() # Returned by KeyCache.get when nothing is known about the user
+
+
+class KeyCache:
+    """
+    LRU cache of public keys with time to live
+    None is cached for users without key, such entries live for negative_ttl seconds
+    """
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float):
+        self.__max_size = max_size
+        self.__ttl = ttl
+        self.__negative_ttl = negative_ttl
+        self.__entries: OrderedDict[str, tuple[str | None, float]] = OrderedDict() # user_id: (key, expires at)
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def get(self, user_id: str):
+        """Returns cached key, None if user is known to have no key, MISSING if it is not cached"""
+        entry = self.__entries.get(user_id)
+        if entry is None:
+            return MISSING
+        public_key, expires_at = entry
+        if expires_at < time.monotonic():
+            del self.__entries[user_id]
+            return MISSING
+        self.__entries.move_to_end(user_id)
+        return public_key
+
+    def set(self, user_id: str, public_key: str | None):
+        """Caches key of the user, None caches that user has no key"""
+        if self.__max_size <= 0:
+            return
+        ttl = self.__ttl if public_key is not None else self.__negative_ttl
+        self.__entries[user_id] = (public_key, time.monotonic() + ttl)
+        self.__entries.move_to_end(user_id)
+        while len(self.__entries) > self.__max_size:
+            self.__entries.popitem(last=False)
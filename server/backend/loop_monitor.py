@@ -0,0 +1,106 @@
+"""event loop backend and monitor of its lag"""
+import time
+import asyncio
+import logging
+import threading
+import contextlib
+from typing import Coroutine
+
+from metrics import ServerMetrics
+from server_logging import log_event
+
+
+def run(main: Coroutine, backend: str = "asyncio"):
+    """
+    Runs coroutine in new event loop, backend is "asyncio" or "uvloop"
+    uvloop falls back to asyncio loop if it is not installed or not supported on the platform
+    """
+    loop_factory = None
+    if backend == "uvloop":
+        try:
+            import uvloop
+            loop_factory = uvloop.new_event_loop
+        except ImportError:
+            log_event("uvloop_unavailable", logging.WARNING)
+    elif backend != "asyncio":
+        raise ValueError(f"Unsupported event loop backend: {backend}")
+
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        log_event("event_loop_started", logging.INFO, backend=type(runner.get_loop()).__module__.split(".")[0])
+        return runner.run(main)
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes up a task which sleeps for interval
+    Lag grows when callbacks block the loop or there are more ready callbacks than it can run
+    Lag above warning_threshold is logged with the request which was running when a watchdog thread
+    saw the loop stuck, requests are labeled by track()
+    """
+    def __init__(self, interval: float, warning_threshold: float = 0.0, metrics: ServerMetrics | None = None):
+        self.__interval = interval
+        self.__warning_threshold = warning_threshold # 0 disables warnings and the watchdog
+        self.__metrics = metrics
+        self.__task: asyncio.Task | None = None
+        self.lag: float = 0.0 # Seconds, measured at the last wake up
+
+        self.__labels: dict[asyncio.Task, str] = {} # Task: request type it is handling
+        self.__woke_up_at = time.monotonic()
+        self.__blocked_by: tuple[str, str] | None = None # (request type, task name) set by the watchdog
+        self.__watchdog: threading.Thread | None = None
+        self.__watchdog_stop = threading.Event()
+
+    def start(self):
+        self.__task = asyncio.create_task(self.__run())
+        if self.__warning_threshold > 0:
+            self.__watchdog_stop.clear()
+            self.__watchdog = threading.Thread(
+                target=self.__watch, args=(asyncio.get_running_loop(),), name="loop-watchdog", daemon=True
+            )
+            self.__watchdog.start()
+
+    def close(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+        if self.__watchdog is not None:
+            self.__watchdog_stop.set()
+            self.__watchdog = None
+
+    @contextlib.contextmanager
+    def track(self, label: str):
+        """Labels the current task for the time of the block, lag warnings name it if it blocks the loop"""
+        task = asyncio.current_task()
+        self.__labels[task] = label
+        try:
+            yield
+        finally:
+            self.__labels.pop(task, None)
+
+    def __watch(self, loop: asyncio.AbstractEventLoop):
+        """Runs in a thread, samples the task which runs while the loop does not wake up the monitor in time"""
+        while not self.__watchdog_stop.wait(self.__interval):
+            late = time.monotonic() - self.__woke_up_at - self.__interval
+            if late < self.__warning_threshold or self.__blocked_by is not None:
+                continue
+            task = asyncio.current_task(loop)
+            if task is not None:
+                # Tasks which do not handle requests, e.g. background ones, are reported as other
+                self.__blocked_by = (self.__labels.get(task, "other"), task.get_name())
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started_at = loop.time()
+            self.__woke_up_at = time.monotonic()
+            await asyncio.sleep(self.__interval)
+            self.lag = max(0.0, loop.time() - started_at - self.__interval)
+
+            if self.__warning_threshold and self.lag >= self.__warning_threshold:
+                # Lag caused by too many ready callbacks has no single culprit
+                request_type, task_name = self.__blocked_by or ("unknown", None)
+                log_event("event_loop_lag", logging.WARNING, lag=round(self.lag, 3), request_type=request_type,
+                          task=task_name)
+                if self.__metrics is not None:
+                    self.__metrics.event_loop_stalls.inc(request_type=request_type)
+            self.__blocked_by = None
@@ -0,0 +1,100 @@
+"""write-behind buffer for messages which are stored for offline users"""
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from server_logging import log_event
+
+
+StoredMessage = tuple[str, str, str] # (user_id, target_user_id, message)
+
+
+class MessageWriteBuffer:
+    """
+    Collects messages for offline users and writes them to the database in batches
+    Batch is written when max_batch_size messages are collected or flush_interval passes
+    When max_size messages are buffered put() waits until buffer is flushed
+    """
+    def __init__(self,
+                 write_function: Callable[[list[StoredMessage]], Awaitable[None]],
+                 max_size: int,
+                 max_batch_size: int,
+                 flush_interval: float):
+        self.__write_function = write_function
+        self.__max_size = max_size
+        self.__max_batch_size = max_batch_size
+        self.__flush_interval = flush_interval
+
+        self.__buffer: list[StoredMessage] = []
+        self.__write_lock = asyncio.Lock() # Only one batch is written at a time
+        self.__not_full = asyncio.Event()
+        self.__not_full.set()
+        self.__flush_needed = asyncio.Event()
+        self.__flush_task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self.__buffer)
+
+    def start(self):
+        """Starts background task which flushes buffer"""
+        self.__flush_task = asyncio.create_task(self.__run())
+
+    async def close(self):
+        """Stops background task and writes all buffered messages"""
+        if self.__flush_task is not None:
+            self.__flush_task.cancel()
+            try:
+                await self.__flush_task
+            except asyncio.CancelledError:
+                pass
+            self.__flush_task = None
+
+        try:
+            await self.flush()
+        except Exception as e:
+            log_event("buffered_messages_lost", logging.ERROR, messages=len(self.__buffer), error=str(e))
+
+    async def put(self, user_id: str, target_user_id: str, message: str):
+        """Adds message to the buffer, waits if buffer is full"""
+        while len(self.__buffer) >= self.__max_size:
+            self.__not_full.clear()
+            self.__flush_needed.set()
+            await self.__not_full.wait()
+
+        self.__buffer.append((user_id, target_user_id, message))
+        if len(self.__buffer) >= self.__max_batch_size:
+            self.__flush_needed.set()
+
+    async def flush(self):
+        """
+        Writes all buffered messages to the database
+        If write fails batch is returned to the front of the buffer and exception is raised
+        """
+        async with self.__write_lock:
+            while self.__buffer:
+                batch = self.__buffer[:self.__max_batch_size]
+                del self.__buffer[:len(batch)]
+                try:
+                    await self.__write_function(batch)
+                except BaseException:
+                    self.__buffer[:0] = batch
+                    raise
+                finally:
+                    if len(self.__buffer) < self.__max_size:
+                        self.__not_full.set()
+
+    async def __run(self):
+        """Flushes buffer when batch is full or flush interval passes"""
+        while True:
+            try:
+                await asyncio.wait_for(self.__flush_needed.wait(), self.__flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.__flush_needed.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                # Messages stay in the buffer and are written on the next attempt
+                log_event("buffered_messages_write_failed", logging.ERROR, messages=len(self.__buffer), error=str(e))
+                await asyncio.sleep(self.__flush_interval)
@@ -0,0 +1,252 @@
+"""metrics of the server in Prometheus text format and http endpoint which exposes them"""
+import asyncio
+from typing import Callable, Iterable
+
+from server_logging import log_event
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def _format_labels(labelnames: tuple[str, ...], labelvalues: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    """Base class for metrics, values are kept per combination of label values"""
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self) -> Iterable[str]:
+        """Returns exposition lines of metric values"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Value which only increases"""
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.__values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.__values[key] = self.__values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self.__values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterable[str]:
+        for key, value in self.__values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Gauge(Metric):
+    """Value which is set directly or read from function when metrics are collected"""
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 function: Callable[[], float] | None = None):
+        super().__init__(name, documentation, labelnames)
+        self.__values: dict[tuple, float] = {}
+        self.__function = function
+
+    def set(self, value: float, **labels):
+        self.__values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.__values[key] = self.__values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self) -> Iterable[str]:
+        if self.__function is not None:
+            yield f"{self.name} {self.__function()}"
+            return
+        for key, value in self.__values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets"""
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.__values: dict[tuple, list] = {} # labels: [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        values = self.__values.get(key)
+        if values is None:
+            values = self.__values[key] = [0] * (len(self.buckets) + 2)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                values[index] += 1
+                break
+        values[-2] += value
+        values[-1] += 1
+
+    def samples(self) -> Iterable[str]:
+        for key, values in self.__values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            yield f"{self.name}_bucket{labels} {values[-1]}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {values[-2]}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {values[-1]}"
+
+
+class MetricsRegistry:
+    """Collection of metrics which are exposed together"""
+    def __init__(self):
+        self.__metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.__metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+              function: Callable[[], float] | None = None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Returns all metrics in Prometheus text exposition format"""
+        return "\n".join(metric.render() for metric in self.__metrics) + "\n"
+
+
+class ServerMetrics:
+    """Metrics collected by the signaling server"""
+    def __init__(self):
+        self.registry = MetricsRegistry()
+
+        self.requests = self.registry.counter(
+            "messenger_requests_total", "Requests received, by type", ("request_type",))
+        self.request_duration = self.registry.histogram(
+            "messenger_request_duration_seconds", "Time spent handling request, by type", ("request_type",))
+        self.request_errors = self.registry.counter(
+            "messenger_request_errors_total", "Requests which failed, by type and error", ("request_type", "error"))
+        self.request_queue_depth = self.registry.histogram(
+            "messenger_request_queue_depth", "Requests waiting in connection queue when new one is added",
+            buckets=SIZE_BUCKETS)
+        self.requests_rejected = self.registry.counter(
+            "messenger_requests_rejected_total", "Requests which were not handled, by type and reason",
+            ("request_type", "reason"))
+        self.connections = self.registry.gauge(
+            "messenger_connections", "Open websocket connections")
+        self.compressed_messages = self.registry.counter(
+            "messenger_compressed_messages_total",
+            "Outgoing messages by compression result (compressed, skipped below threshold)", ("result",))
+        self.compression_duration = self.registry.histogram(
+            "messenger_compression_seconds", "Time spent compressing outgoing frames")
+        self.compression_bytes = self.registry.counter(
+            "messenger_compression_bytes_total",
+            "Bytes of compressed frames before (input) and after (output) compression, input - output is saved",
+            ("stage",))
+        self.connection_evictions = self.registry.counter(
+            "messenger_connection_evictions_total",
+            "Connections dropped by the server, by reason (ping_timeout, idle, slow_consumer)", ("reason",))
+
+        self.event_loop_stalls = self.registry.counter(
+            "messenger_event_loop_stalls_total",
+            "Event loop lags above warning threshold, by request type which was running (other, unknown)",
+            ("request_type",))
+
+        self.db_query_duration = self.registry.histogram(
+            "messenger_db_query_duration_seconds", "Time spent in database helper including pool wait, by query",
+            ("query",))
+        self.db_pool_acquire_duration = self.registry.histogram(
+            "messenger_db_pool_acquire_seconds", "Time spent waiting for connection from the pool")
+
+        self.key_cache_lookups = self.registry.counter(
+            "messenger_key_cache_lookups_total", "Public key lookups in cache, by result (hit, negative_hit, miss)",
+            ("result",))
+        self.key_cache_skipped_writes = self.registry.counter(
+            "messenger_key_cache_skipped_writes_total", "Public key saves skipped because key has not changed")
+
+        self.pending_connections = self.registry.counter(
+            "messenger_pending_connections_total", "Waits for offline users which ended, by result (matched, expired)",
+            ("result",))
+
+        self.password_hash_queue_duration = self.registry.histogram(
+            "messenger_password_hash_queue_seconds", "Time password hashing waited for free worker")
+        self.password_hash_duration = self.registry.histogram(
+            "messenger_password_hash_duration_seconds", "Time spent hashing password in worker, by operation",
+            ("operation",))
+
+        self.stored_messages_dropped = self.registry.counter(
+            "messenger_stored_messages_dropped_total", "Messages for offline users which were not stored, by reason",
+            ("reason",))
+
+        self.relay_bytes = self.registry.counter(
+            "messenger_relay_bytes_total", "Bytes of relayed offers, answers and messages, by direction",
+            ("direction",))
+
+    def gauge_function(self, name: str, documentation: str, function: Callable[[], float]):
+        """Registers gauge which value is read from function when metrics are collected"""
+        self.registry.gauge(name, documentation, function=function)
+
+
+async def serve_metrics(registry: MetricsRegistry, host: str, port: int) -> asyncio.AbstractServer:
+    """Starts http server which returns metrics on GET /metrics"""
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            # Headers are not used
+            while await reader.readline() not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            log_event("metrics_request_failed", error=str(e))
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle_connection, host, port)
@@ -0,0 +1,3 @@
+-- Stored messages are looked up and drained by (recipient, sender) in id order
+CREATE INDEX IF NOT EXISTS messages_target_user_id_user_id_id_idx
+    ON messages (target_user_id, user_id, id);
@@ -0,0 +1,6 @@
+-- Messages between server workers which do not fit into NOTIFY payload
+CREATE UNLOGGED TABLE IF NOT EXISTS bus_messages (
+    id BIGSERIAL PRIMARY KEY,
+    payload TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,2 @@
+-- Server side password hashes are longer than SHA-256 strings sent by clients
+ALTER TABLE users ALTER COLUMN password TYPE TEXT;
@@ -0,0 +1,6 @@
+-- State of users kept in memory of the server, saved on shutdown and restored on startup
+CREATE TABLE IF NOT EXISTS presence_snapshots (
+    id SERIAL PRIMARY KEY,
+    state JSONB NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
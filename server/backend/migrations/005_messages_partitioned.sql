@@ -0,0 +1,29 @@
+-- Messages are partitioned by day so expired ones are removed by dropping partitions
+DO $$
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'messages'::regclass) = 'p' THEN
+        RETURN; -- Created partitioned by db_init_server.sql
+    END IF;
+
+    ALTER TABLE messages RENAME TO messages_unpartitioned;
+    ALTER INDEX IF EXISTS messages_target_user_id_user_id_id_idx RENAME TO messages_unpartitioned_recipient_idx;
+
+    CREATE TABLE messages (
+        id BIGSERIAL NOT NULL,
+        user_id VARCHAR(100) NOT NULL,
+        target_user_id VARCHAR(100) NOT NULL,
+        message TEXT NOT NULL,
+        timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    ) PARTITION BY RANGE (timestamp);
+    CREATE INDEX messages_target_user_id_user_id_id_idx ON messages (target_user_id, user_id, id);
+    -- Rows of days without own partition, daily partitions are created by the server
+    CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+    -- Stored messages keep their ids, drained messages are found by them
+    INSERT INTO messages (id, user_id, target_user_id, message, timestamp)
+        SELECT id, user_id, target_user_id, message, COALESCE(timestamp, CURRENT_TIMESTAMP)
+        FROM messages_unpartitioned;
+    PERFORM setval(pg_get_serial_sequence('messages', 'id'), COALESCE((SELECT MAX(id) FROM messages), 0) + 1, false);
+    DROP TABLE messages_unpartitioned;
+END
+$$;
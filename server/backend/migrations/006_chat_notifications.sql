@@ -0,0 +1,12 @@
+-- Chats created with offline users, delivered on login and removed once the client acknowledges them
+CREATE TABLE IF NOT EXISTS chat_notifications (
+    id BIGSERIAL PRIMARY KEY,
+    recipient_id VARCHAR(255) NOT NULL,
+    creator_id VARCHAR(255) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (recipient_id, creator_id)
+);
+
+-- Pages of notifications are read by recipient in order of id
+CREATE INDEX IF NOT EXISTS chat_notifications_recipient_id_id_idx
+    ON chat_notifications (recipient_id, id);
@@ -1,38 +1,52 @@
 """objects related to the server"""
 import os
 import logging
-from datetime import datetime
 import asyncio
+import contextlib
+import random
+import signal
+import sys
+import time
+import uuid
+from types import MappingProxyType
 from typing import Union
 import websockets
-import asyncpg
+from websockets.frames import CloseCode
 from websockets.legacy.client import WebSocketClientProtocol
 from websockets.legacy.server import WebSocketServerProtocol
 
 from request import Request
+from codec import get_codec, select_subprotocol
+from message_buffer import MessageWriteBuffer
+from storage import DatabaseUnavailableError, Storage, create_storage
+from key_cache import KeyCache, MISSING
+from password_hashing import PasswordHasher, is_legacy_hash
+from presence import PresenceFanout
+from compression import compression_extensions
+from capture import FrameRecorder
+from pending_registry import PendingRegistry
+from rate_limiter import RateLimiter, parse_rate_limit, parse_rate_limits
+from loop_monitor import LoopLagMonitor
+from request_dispatcher import RequestDispatcher
+from bus import MessageBus, PostgresBus, RemoteWebSocket
+from metrics import ServerMetrics, serve_metrics
+from server_logging import log_event, logger
 
 
 WebSocket = Union[WebSocketClientProtocol, WebSocketServerProtocol]
 
 
+class ChannelWebSocket:
+    """
+    Chat which is multiplexed over the main websocket of the user
+    Requests of such chat carry channel id chosen by the client, requests sent to it are marked with the same id
+    """
+    __slots__ = ("websocket", "channel")
 
-def setup_logging():
-    """Sets up logging for the application"""
-    # Ensure folder for logs exists
-    FOLDER_PATH = "./logs"
-    if not os.path.exists(FOLDER_PATH):
-        os.makedirs(FOLDER_PATH)
+    def __init__(self, websocket: WebSocket, channel: str):
+        self.websocket = websocket
+        self.channel = channel
 
-    # Set up logging
-    TIMESTAMP = datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')[:-3]
-    LOG_FILENAME = f"./logs/log_{TIMESTAMP}.log"
-    logging.basicConfig(
-        filename=LOG_FILENAME,
-        level=logging.DEBUG,
-        format='%(asctime)s.%(msecs)03d [%(levelname)s] %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-setup_logging()
 
 
 class IncorrectRequestTypeError(Exception):
@@ -43,215 +57,681 @@ class UserNotRegisteredError(Exception):
     """Exception which is raised when target user is not registered on server"""
 
 
-class User:
-    """Class that represents user on the server side"""
-    def __init__(self):
-        self.is_online = False # Indicates if user is connected to the server
+class InvalidRequestError(Exception):
+    """Exception which is raised when request can not be handled, error_type is sent to the client"""
+    def __init__(self, error_type: str, message: str):
+        super().__init__(message)
+        self.error_type = error_type
 
-        # Websocket which is used to comunicate with the server for entire app
-        self.main_websocket = None
-        # Websockets which are used to comunicate with other users in chats
-        self.websockets = {} #  chat with target_user_id: websocket
 
-        self.pending_users = set() # User waiting for you
-        self.pended_users = set() # User you are waiting for
+def _is_text(value) -> bool:
+    return isinstance(value, str)
 
-        self.long_term_public_key = None
-        self.public_keys = {} # Target user id you have chat with: your public key
-        self.created_chats = [] # Chats other users created with you
 
-    def disconnect(self):
-        """Sets user to default disconnected state"""
-        self.is_online = False
-        self.pended_users = set()
-        self.main_websocket = None
-        self.websockets = {}
-        self.public_keys = {}
+def _is_payload(value) -> bool:
+    """Offers, answers and messages are strings, pass-through codec keeps them as bytes"""
+    return isinstance(value, (str, bytes))
 
 
-class Server:
-    """Class to represent server which handles establishing connection between users"""
-    SERVER_DATABASE_URL = os.getenv("DATABASE_URL")
+def _is_text_list(value) -> bool:
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
 
-    def __init__(self, ip: str, port: int):
-        self.ip: str = ip
-        self.port: int = port
-        self.__clients: dict[User] = {} # user_id: User
 
-    async def __save_message_to_db(self, user_id: str, target_user_id: str, message: str) -> None:
-        """Saves message to the database"""
-        conn = await asyncpg.connect(self.SERVER_DATABASE_URL)
-        try:
-            await conn.execute("""--sql
-                INSERT INTO messages (user_id, target_user_id, message)
-                VALUES ($1, $2, $3);
-            """, user_id, target_user_id, message)
-        finally:
-            await conn.close()
+def _is_cursor(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
 
-    async def __get_messages_from_db(self, user_id: str, target_user_id: str) -> list:
-        """Gets messages to specified user from the database"""
-        conn = await asyncpg.connect(self.SERVER_DATABASE_URL)
-        try:
-            rows = await conn.fetch("""--sql
-                SELECT message FROM messages
-                WHERE user_id = $1 AND target_user_id = $2;
-            """, target_user_id, user_id)
 
-            await conn.execute("""--sql
-                DELETE FROM messages
-                WHERE user_id = $1 AND target_user_id = $2;
-            """, target_user_id, user_id)
+_EMPTY_DICT = MappingProxyType({})
 
-            messages = [row["message"] for row in rows]
 
-            return messages
-        finally:
-            await conn.close()
+class User:
+    """
+    Class that represents user on the server side
+    Containers are allocated on first write and released when they become empty,
+    reading an unallocated container returns shared empty read-only one
+    """
+    __slots__ = ("is_online", "main_websocket", "long_term_public_key",
+                 "_websockets", "_public_keys")
 
-    async def __save_key_to_db(self, user_id: str, public_key: str) -> None:
-        """Saves public key to the database"""
-        print(f"Saving public key for {user_id} to database...")
-        conn = await asyncpg.connect(self.SERVER_DATABASE_URL)
-        try:
-            await conn.execute("""--sql
-                INSERT INTO public_keys (user_id, public_key)
-                VALUES ($1, $2)
-                ON CONFLICT (user_id)
-                DO UPDATE SET
-                    public_key = EXCLUDED.public_key,
-                    timestamp = CURRENT_TIMESTAMP;
-            """, user_id, public_key)
-        finally:
-            await conn.close()
-        print(f"Public key for {user_id} saved to database.")
+    def __init__(self):
+        self.is_online = False # Indicates if user is connected to the server
 
-    async def __get_key_from_db(self, user_id: str) -> str:
-        """Gets public key from the database"""
-        print(f"Getting public key of user: {user_id} from database...")
-        conn = await asyncpg.connect(self.SERVER_DATABASE_URL)
-        try:
-            row = await conn.fetchrow("""--sql
-                SELECT public_key FROM public_keys
-                WHERE user_id = $1;
-            """, user_id)
+        # Websocket which is used to comunicate with the server for entire app
+        self.main_websocket = None
+        self.long_term_public_key = None
 
-            if row is None:
-                return None
+        self._websockets: dict | None = None #  chat with target_user_id: websocket
+        self._public_keys: dict | None = None # Target user id you have chat with: your public key
 
-            print(f"Public key of user: {user_id} received from database.")
-            return row["public_key"]
-        finally:
-            await conn.close()
+    @property
+    def websockets(self):
+        """Websockets which are used to comunicate with other users in chats"""
+        return self._websockets if self._websockets is not None else _EMPTY_DICT
+
+    @property
+    def public_keys(self):
+        return self._public_keys if self._public_keys is not None else _EMPTY_DICT
 
-    async def __add_user_to_db(self, user_id: str, email: str, password: str) -> bool:
+    @property
+    def is_idle(self) -> bool:
         """
-        Adds user to the database. Assumes password is already hashed via SHA-256 on the client.
-        Returns True if user was added, False if user already exists or error occurred.
+        Indicates if user is offline and no state is kept for him, so he can be removed from memory
+        Waits are kept by PendingRegistry and chats created with him by storage
         """
-        print(f"📥 Checking if user {user_id} or email {email} already exists...")
+        return not self.is_online
 
-        try:
-            conn = await asyncpg.connect(self.SERVER_DATABASE_URL)
-            print("🔌 Connected to DB")
+    def add_chat(self, target_user_id: str, websocket, public_key: str):
+        """Stores websocket and public key used in chat with target user"""
+        if self._websockets is None:
+            self._websockets = {}
+            self._public_keys = {}
+        self._websockets[target_user_id] = websocket
+        self._public_keys[target_user_id] = public_key
 
-            try:
-                existing_user = await conn.fetchrow("""
-                    SELECT id FROM users WHERE user_id = $1 OR email = $2;
-                """, user_id, email)
-                print("📊 Existing user check complete.")
-            except Exception as e:
-                print(f"❌ Error checking for existing user: {e}")
-                return False
-
-            if existing_user:
-                print("⚠️ User already exists.")
-                return False
+    def disconnect(self):
+        """Sets user to default disconnected state"""
+        self.is_online = False
+        self.main_websocket = None
+        self._websockets = None
+        self._public_keys = None
 
-            try:
-                print("💾 Inserting user with client-side hashed password...")
+    def memory_size(self) -> int:
+        """Returns number of bytes used by the object and its containers, websockets are not counted"""
+        size = sys.getsizeof(self)
+        for container in (self._websockets, self._public_keys):
+            if container is not None:
+                size += sys.getsizeof(container)
+        if self._public_keys:
+            size += sum(sys.getsizeof(value) for value in self._public_keys.values())
+        return size
 
-                await conn.execute("""
-                    INSERT INTO users (user_id, email, password)
-                    VALUES ($1, $2, $3);
-                """, user_id, email, password)
 
-                print(f"✅ New user {user_id} inserted into DB.")
-                return True
+class Server:
+    """Class to represent server which handles establishing connection between users"""
+    SERVER_DATABASE_URL = os.getenv("DATABASE_URL")
+    # postgres, sqlite (one file, single host) or memory (nothing survives restart)
+    STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres")
+    SQLITE_PATH = os.getenv("SQLITE_PATH", "messenger.sqlite3")
+
+    # Write-behind buffer for messages to offline users
+    MESSAGE_BUFFER_MAX_SIZE = int(os.getenv("MESSAGE_BUFFER_MAX_SIZE", "10000"))
+    MESSAGE_BUFFER_BATCH_SIZE = int(os.getenv("MESSAGE_BUFFER_BATCH_SIZE", "500"))
+    MESSAGE_BUFFER_FLUSH_INTERVAL = float(os.getenv("MESSAGE_BUFFER_FLUSH_INTERVAL", "0.05"))
+
+    # Maximum number of stored messages sent to the user in one send_stored_messages frame
+    STORED_MESSAGES_CHUNK_SIZE = int(os.getenv("STORED_MESSAGES_CHUNK_SIZE", "100"))
+    # Chunk is also cut when its messages reach this size, so it fits into max frame size of clients
+    STORED_MESSAGES_CHUNK_MAX_BYTES = int(os.getenv("STORED_MESSAGES_CHUNK_MAX_BYTES", str(256 * 1024)))
+    # Chats created with offline user are sent on login in pages, the next one after the client acknowledges
+    CHAT_NOTIFICATIONS_PAGE_SIZE = int(os.getenv("CHAT_NOTIFICATIONS_PAGE_SIZE", "100"))
+
+    # Cache of long-term public keys in front of the database, 0 disables it
+    KEY_CACHE_MAX_SIZE = int(os.getenv("KEY_CACHE_MAX_SIZE", "100000"))
+    KEY_CACHE_TTL = float(os.getenv("KEY_CACHE_TTL", "600"))
+    KEY_CACHE_NEGATIVE_TTL = float(os.getenv("KEY_CACHE_NEGATIVE_TTL", "30")) # For users without key
+    # Threads which hash passwords, hashing is too slow to run on the event loop
+    PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+    # Batch lookups of larger lists of users are split into several queries
+    BATCH_LOOKUP_MAX_SIZE = int(os.getenv("BATCH_LOOKUP_MAX_SIZE", "1000"))
+
+    # Per connection request handling
+    REQUEST_QUEUE_SIZE = int(os.getenv("REQUEST_QUEUE_SIZE", "64")) # Reading from socket pauses when queue is full
+    MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "8"))
+    # Requests which other requests of the connection depend on, handled when nothing else runs
+    EXCLUSIVE_REQUEST_TYPES = frozenset({"login_request"})
+    # Requests which are handled in the order they were received relative to requests for the same target user
+    ORDERED_REQUEST_TYPES = frozenset({
+        "register_request",
+        "connection_request",
+        "share_offer_request",
+        "share_answer_request",
+        "relay_message_request",
+        "get_target_user_status_request",
+        "create_chat_request",
+        "send_long_term_public_key_request",
+    })
+    # Content fields which requests must have: check of the value
+    REQUEST_FIELDS = MappingProxyType({
+        "register_request": {"target_user_id": _is_text, "public_key": _is_text},
+        "connection_request": {"target_user_id": _is_text},
+        "share_offer_request": {"target_user_id": _is_text, "offer": _is_payload},
+        "share_answer_request": {"target_user_id": _is_text, "answer": _is_payload},
+        "relay_message_request": {"target_user": _is_text, "message": _is_payload, "public_key": _is_text},
+        "get_target_user_status_request": {"target_user_id": _is_text},
+        "get_public_key_request": {"target_user_id": _is_text},
+        "send_long_term_public_key_request": {"long_term_public_key": _is_text},
+        "get_long_term_public_key_request": {"target_user_id": _is_text},
+        "get_long_term_public_keys_request": {"target_user_ids": _is_text_list},
+        "subscribe_presence_request": {"target_user_ids": _is_text_list},
+        "unsubscribe_presence_request": {"target_user_ids": _is_text_list},
+        "login_request": {"long_term_public_key": _is_text},
+        "create_chat_request": {"target_user_id": _is_text},
+        "created_chats_ack_request": {"cursor": _is_cursor},
+        "add_user_to_data_base": {},
+        "get_user_info_from_data_base": {},
+        "check_user_existance_request": {"target_user_id": _is_text},
+        "check_users_existance_request": {"target_user_ids": _is_text_list},
+    })
+    # Requests which can be sent before login, others must have user id
+    ANONYMOUS_REQUEST_TYPES = frozenset({
+        "add_user_to_data_base",
+        "get_user_info_from_data_base",
+        "check_user_existance_request",
+        "check_users_existance_request",
+        "get_long_term_public_key_request",
+        "get_long_term_public_keys_request",
+    })
+
+    # Limits of requests per user, "request_type=rate/burst,..." with rate in requests per second
+    # Requests before the connection sent user id are limited per connection
+    RATE_LIMITS = parse_rate_limits(os.getenv(
+        "RATE_LIMITS",
+        "relay_message_request=50/200,add_user_to_data_base=0.1/5,get_user_info_from_data_base=0.5/10"
+    ))
+    # Limit of all other request types together, empty string disables it
+    RATE_LIMIT_DEFAULT = parse_rate_limit(os.getenv("RATE_LIMIT_DEFAULT", "50/200"))
+    # Limits of all connections from one address together, clients behind NAT or proxy share the address
+    # so they are much looser than per user ones
+    ADDRESS_RATE_LIMITS = parse_rate_limits(os.getenv(
+        "ADDRESS_RATE_LIMITS", "add_user_to_data_base=5/100,get_user_info_from_data_base=25/500"
+    ))
+    ADDRESS_RATE_LIMIT_DEFAULT = parse_rate_limit(os.getenv("ADDRESS_RATE_LIMIT_DEFAULT", ""))
+    # Header with client address set by load balancer, e.g. X-Forwarded-For, empty uses address of connection
+    CLIENT_ADDRESS_HEADER = os.getenv("CLIENT_ADDRESS_HEADER", "")
+    # Requests are rejected with overloaded response while event loop lag or database queue are above limits
+    OVERLOAD_LOOP_LAG = float(os.getenv("OVERLOAD_LOOP_LAG", "0.5"))
+    OVERLOAD_PENDING_DB_OPERATIONS = int(os.getenv("OVERLOAD_PENDING_DB_OPERATIONS", "100"))
+    OVERLOAD_RETRY_AFTER = float(os.getenv("OVERLOAD_RETRY_AFTER", "1"))
+    LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+    # Lag above it is logged with request type which blocked the loop, 0 disables it
+    LOOP_LAG_WARNING = float(os.getenv("LOOP_LAG_WARNING", "0.2"))
+
+    # Sharing of presence and routing state between several server workers
+    BUS_BACKEND = os.getenv("BUS_BACKEND", "none") # none (single worker) or postgres
+    BUS_HEARTBEAT_INTERVAL = float(os.getenv("BUS_HEARTBEAT_INTERVAL", "5"))
+    BUS_WORKER_TIMEOUT = float(os.getenv("BUS_WORKER_TIMEOUT", "15")) # Users of silent worker are disconnected
+    # Before stored messages are read other workers write buffered ones, they are waited for at most this long
+    BUS_FLUSH_TIMEOUT = float(os.getenv("BUS_FLUSH_TIMEOUT", "2"))
+
+    # Offline users without pending state are removed from memory, this is how often it is checked
+    PRESENCE_SWEEP_INTERVAL = float(os.getenv("PRESENCE_SWEEP_INTERVAL", "60"))
+    # User waits for offline target of connection_request at most this long
+    PENDING_CONNECTION_TTL = float(os.getenv("PENDING_CONNECTION_TTL", str(24 * 60 * 60)))
+    # Status changes of users are sent to their subscribers together once per interval
+    PRESENCE_FANOUT_INTERVAL = float(os.getenv("PRESENCE_FANOUT_INTERVAL", "0.1"))
+    PRESENCE_MAX_SUBSCRIPTIONS = int(os.getenv("PRESENCE_MAX_SUBSCRIPTIONS", "1000")) # Per user
+
+    # Liveness of websockets, dead and slow clients are disconnected so messages to them are stored
+    WEBSOCKET_PING_INTERVAL = float(os.getenv("WEBSOCKET_PING_INTERVAL", "20"))
+    WEBSOCKET_PING_TIMEOUT = float(os.getenv("WEBSOCKET_PING_TIMEOUT", "20")) # Pong has to arrive within it
+    WEBSOCKET_CLOSE_TIMEOUT = float(os.getenv("WEBSOCKET_CLOSE_TIMEOUT", "5"))
+    WEBSOCKET_IDLE_TIMEOUT = float(os.getenv("WEBSOCKET_IDLE_TIMEOUT", "0")) # No requests received, 0 disables it
+    WEBSOCKET_WRITE_LIMIT = int(os.getenv("WEBSOCKET_WRITE_LIMIT", str(64 * 1024))) # Outbound bytes buffered per connection
+    WEBSOCKET_SEND_TIMEOUT = float(os.getenv("WEBSOCKET_SEND_TIMEOUT", "10")) # Buffer has to drain within it
+    WEBSOCKET_MAX_SIZE = int(os.getenv("WEBSOCKET_MAX_SIZE", str(1024 * 1024))) # Incoming message size, 0 disables it
+
+    # permessage-deflate is negotiated with clients which support it, empty string disables it
+    WEBSOCKET_COMPRESSION = os.getenv("WEBSOCKET_COMPRESSION", "deflate")
+    WEBSOCKET_COMPRESSION_THRESHOLD = int(os.getenv("WEBSOCKET_COMPRESSION_THRESHOLD", "512")) # Smaller are sent as is
+    WEBSOCKET_COMPRESSION_LEVEL = int(os.getenv("WEBSOCKET_COMPRESSION_LEVEL", "6"))
+    WEBSOCKET_COMPRESSION_WINDOW_BITS = int(os.getenv("WEBSOCKET_COMPRESSION_WINDOW_BITS", "12"))
+
+    # On SIGTERM clients are told to reconnect after random delay in this range, so they do not come back at once
+    RECONNECT_DELAY_MIN = float(os.getenv("RECONNECT_DELAY_MIN", "1"))
+    RECONNECT_DELAY_MAX = float(os.getenv("RECONNECT_DELAY_MAX", "30"))
+    SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "30")) # For requests which are handled to finish
+
+    # Expired stored messages are removed and new partitions are created this often
+    MESSAGE_MAINTENANCE_INTERVAL = float(os.getenv("MESSAGE_MAINTENANCE_INTERVAL", "3600"))
+
+    # Received frames are appended to this file to be replayed by fuzz.py, empty string disables it
+    CAPTURE_PATH = os.getenv("CAPTURE_PATH", "")
+
+    # Side http server with /metrics endpoint, 0 disables it
+    METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+    # Request types which carry offers, answers and messages between users
+    RELAY_REQUEST_TYPES = frozenset({"share_offer_request", "share_answer_request", "relay_message_request"})
+    # Request types of chats, only they can be multiplexed over the main websocket with channel id
+    CHANNEL_REQUEST_TYPES = frozenset({
+        "register_request", "connection_request", "get_target_user_status_request", "get_public_key_request",
+        *RELAY_REQUEST_TYPES
+    })
+
+    def __init__(self, ip: str, port: int, bus: MessageBus | None = None, reuse_port: bool = False,
+                 storage: Storage | None = None):
+        self.ip: str = ip
+        self.port: int = port
+        self.reuse_port: bool = reuse_port # Several worker processes listen on the same port
+        # Users connected to this worker and replicas of users connected to other workers
+        self.__clients: dict[User] = {} # user_id: User
 
+        self.worker_id: str = uuid.uuid4().hex[:12]
+        if bus is None and self.BUS_BACKEND == "postgres":
+            bus = PostgresBus(self.SERVER_DATABASE_URL)
+        self.__bus: MessageBus | None = bus
+        self.__workers_last_seen: dict[str, float] = {} # worker_id: loop time of its last bus message
+        # flush request id: (workers which have not written their buffers yet, event set when all did)
+        self.__flush_waits: dict[str, tuple[set[str], asyncio.Event]] = {}
+
+        self.metrics = ServerMetrics()
+        self.metrics_port: int = self.METRICS_PORT
+        self.metrics.gauge_function("messenger_online_users", "Users which are online",
+                                    lambda: sum(client.is_online for client in self.__clients.values()))
+        self.metrics.gauge_function("messenger_users_in_memory", "Users kept in presence table",
+                                    lambda: len(self.__clients))
+        self.metrics.gauge_function("messenger_presence_table_bytes", "Memory used by presence table",
+                                    self.presence_table_size)
+        if storage is None:
+            storage = create_storage(self.STORAGE_BACKEND, self.SERVER_DATABASE_URL, self.SQLITE_PATH, self.metrics)
+        self.__storage = storage
+        self.__message_buffer = MessageWriteBuffer(
+            write_function=self.__storage.save_messages,
+            max_size=self.MESSAGE_BUFFER_MAX_SIZE,
+            max_batch_size=self.MESSAGE_BUFFER_BATCH_SIZE,
+            flush_interval=self.MESSAGE_BUFFER_FLUSH_INTERVAL
+        )
+        self.metrics.gauge_function("messenger_message_buffer_size", "Messages waiting to be written to database",
+                                    lambda: len(self.__message_buffer))
+        self.__presence = PresenceFanout(
+            send_updates=self.__send_presence_updates,
+            interval=self.PRESENCE_FANOUT_INTERVAL,
+            max_subscriptions=self.PRESENCE_MAX_SUBSCRIPTIONS
+        )
+        self.metrics.gauge_function("messenger_presence_subscriptions", "Subscriptions to status of users",
+                                    lambda: self.__presence.subscriptions_count)
+        self.__rate_limiter = RateLimiter(self.RATE_LIMITS, self.RATE_LIMIT_DEFAULT)
+        self.__address_rate_limiter = RateLimiter(self.ADDRESS_RATE_LIMITS, self.ADDRESS_RATE_LIMIT_DEFAULT)
+        self.__loop_lag_monitor = LoopLagMonitor(self.LOOP_LAG_INTERVAL, self.LOOP_LAG_WARNING, self.metrics)
+        self.metrics.gauge_function("messenger_event_loop_lag_seconds", "Lag of the event loop at the last check",
+                                    lambda: self.__loop_lag_monitor.lag)
+        self.__pending = PendingRegistry(self.PENDING_CONNECTION_TTL, self.metrics)
+        self.metrics.gauge_function("messenger_pending_connections", "Users waiting for offline users",
+                                    lambda: len(self.__pending))
+        self.__capture = FrameRecorder(self.CAPTURE_PATH) if self.CAPTURE_PATH else None
+        self.__stop_event = asyncio.Event()
+        # Requests of every connection which were received and not handled yet, shutdown waits for them
+        self.__connection_requests: dict[WebSocket, tuple[asyncio.Queue, RequestDispatcher]] = {}
+        self.__password_hasher = PasswordHasher(self.PASSWORD_HASH_WORKERS, self.metrics)
+        self.__key_cache = KeyCache(self.KEY_CACHE_MAX_SIZE, self.KEY_CACHE_TTL, self.KEY_CACHE_NEGATIVE_TTL)
+        self.metrics.gauge_function("messenger_key_cache_size", "Public keys in cache",
+                                    lambda: len(self.__key_cache))
+
+    async def __get_key(self, user_id: str) -> str | None:
+        """Returns long-term public key of the user from cache or database"""
+        public_key = self.__key_cache.get(user_id)
+        if public_key is not MISSING:
+            self.metrics.key_cache_lookups.inc(result="hit" if public_key is not None else "negative_hit")
+            return public_key
+
+        self.metrics.key_cache_lookups.inc(result="miss")
+        public_key = await self.__storage.get_key(user_id)
+        self.__key_cache.set(user_id, public_key)
+        return public_key
+
+    async def __get_keys(self, user_ids: list[str]) -> dict[str, str | None]:
+        """Returns long-term public keys of several users, keys which are not cached are read with one query"""
+        public_keys = {}
+        missing_user_ids = []
+        for user_id in user_ids:
+            public_key = self.__key_cache.get(user_id)
+            if public_key is MISSING:
+                missing_user_ids.append(user_id)
+            else:
+                self.metrics.key_cache_lookups.inc(result="hit" if public_key is not None else "negative_hit")
+                public_keys[user_id] = public_key
+
+        if missing_user_ids:
+            self.metrics.key_cache_lookups.inc(len(missing_user_ids), result="miss")
+            for start in range(0, len(missing_user_ids), self.BATCH_LOOKUP_MAX_SIZE):
+                loaded_keys = await self.__storage.get_keys(missing_user_ids[start:start + self.BATCH_LOOKUP_MAX_SIZE])
+                for user_id, public_key in loaded_keys.items():
+                    self.__key_cache.set(user_id, public_key)
+                public_keys.update(loaded_keys)
+        return public_keys
+
+    async def __save_key(self, user_id: str, public_key: str):
+        """Saves long-term public key to the database and cache, write is skipped if key has not changed"""
+        if self.__key_cache.get(user_id) == public_key:
+            self.metrics.key_cache_skipped_writes.inc()
+            return
+        await self.__storage.save_key(user_id, public_key)
+        self.__key_cache.set(user_id, public_key)
+
+    def __get_or_create_client(self, user_id: str) -> User:
+        client = self.__clients.get(user_id)
+        if client is None:
+            client = self.__clients[user_id] = User()
+        return client
+
+    def __is_idle(self, user_id: str, client: User) -> bool:
+        return client.is_idle and not self.__pending.involves(user_id)
+
+    def __evict_if_idle(self, user_id: str):
+        """Removes user from memory if he is offline and no state is kept for him"""
+        client = self.__clients.get(user_id)
+        if client is not None and self.__is_idle(user_id, client):
+            del self.__clients[user_id]
+
+    async def __sweep_idle_users(self):
+        """Periodically removes expired waits and idle users, e.g. offline targets of register requests"""
+        while True:
+            await asyncio.sleep(self.PRESENCE_SWEEP_INTERVAL)
+            for waiter_id, target_id in self.__pending.expire():
+                log_event("pending_connection_expired", logging.INFO, sampled=True,
+                          user_id=waiter_id, target_user_id=target_id)
+            for user_id in [user_id for user_id, client in self.__clients.items() if self.__is_idle(user_id, client)]:
+                del self.__clients[user_id]
+            self.__rate_limiter.prune()
+            self.__address_rate_limiter.prune()
+
+    async def __maintain_messages(self):
+        """Runs maintenance of stored messages at start and then periodically"""
+        while True:
+            try:
+                await self.__storage.maintain()
             except Exception as e:
-                print(f"❌ Error inserting user into DB: {e}")
-                return False
-
-            finally:
-                await conn.close()
-                print("🔒 DB connection closed.")
+                log_event("messages_maintenance_failed", logging.ERROR, error=str(e))
+            await asyncio.sleep(self.MESSAGE_MAINTENANCE_INTERVAL)
+
+    def presence_table_size(self) -> int:
+        """Returns number of bytes used by presence table (users in memory and their state)"""
+        size = sys.getsizeof(self.__clients)
+        for user_id, client in self.__clients.items():
+            size += sys.getsizeof(user_id) + client.memory_size()
+        return size
+
+    @staticmethod
+    def __is_local(websocket: WebSocket | RemoteWebSocket | None) -> bool:
+        """Checks if websocket is connected to this worker"""
+        return websocket is not None and not isinstance(websocket, RemoteWebSocket)
+
+    def __apply_login(self, user_id: str, websocket: WebSocket | RemoteWebSocket, long_term_public_key: str):
+        client = self.__get_or_create_client(user_id)
+        client.main_websocket = websocket
+        if not client.is_online:
+            client.is_online = True
+            self.__presence.status_changed(user_id, True)
+        client.long_term_public_key = long_term_public_key
+
+    def __apply_register(self, user_id: str, target_user_id: str,
+                         websocket: WebSocket | ChannelWebSocket | RemoteWebSocket, public_key: str):
+        client = self.__get_or_create_client(user_id)
+        self.__get_or_create_client(target_user_id)
+        client.add_chat(target_user_id, websocket, public_key)
+        if not client.is_online:
+            client.is_online = True
+            self.__presence.status_changed(user_id, True)
+
+    def __apply_pending(self, user_id: str, target_user_id: str):
+        """User with user_id starts waiting for target user to come online"""
+        self.__get_or_create_client(user_id)
+        self.__get_or_create_client(target_user_id)
+        self.__pending.add(user_id, target_user_id)
+
+    def __apply_pending_matched(self, user_id: str, target_user_id: str):
+        """Target user which was waiting for user with user_id got connected to him"""
+        self.__pending.remove(target_user_id, user_id)
+        self.__evict_if_idle(user_id)
+        self.__evict_if_idle(target_user_id)
+
+    def __apply_disconnect(self, user_id: str):
+        disconnected_user = self.__clients.get(user_id)
+        if disconnected_user is None:
+            return
 
-        except Exception as conn_err:
-            print(f"❌ Failed to connect to DB: {conn_err}")
+        target_user_ids = list(self.__pending.targets_of(user_id))
+        self.__pending.remove_waiter(user_id)
+        if disconnected_user.is_online:
+            self.__presence.status_changed(user_id, False)
+        # Subscriptions last while subscriber is connected
+        self.__presence.unsubscribe(user_id)
+        disconnected_user.disconnect()
+        self.__evict_if_idle(user_id)
+
+        for target_user_id in target_user_ids:
+            self.__evict_if_idle(target_user_id)
+
+    async def __send_presence_updates(self, updates: dict[str, dict[str, bool]]):
+        """Sends batched status changes to subscribers connected to this worker"""
+        sends = []
+        for subscriber_id, presence in updates.items():
+            subscriber = self.__clients.get(subscriber_id)
+            if subscriber is None or not self.__is_local(subscriber.main_websocket):
+                continue
+            presence_update = Request(request_type="presence_update", content={"presence": presence})
+            sends.append(self.__send(subscriber.main_websocket, presence_update))
+        # One slow or closed subscriber does not hold back the others
+        await asyncio.gather(*sends, return_exceptions=True)
+
+    async def __send(self, websocket: WebSocket | ChannelWebSocket | RemoteWebSocket, request: Request):
+        """Encodes request with the codec negotiated by the connection and sends it"""
+        if isinstance(websocket, RemoteWebSocket):
+            await websocket.send(request)
+            return
+        if isinstance(websocket, ChannelWebSocket):
+            request = Request(request.type, request.user_id, {**request.content, "channel": websocket.channel})
+            websocket = websocket.websocket
+        codec = get_codec(websocket.subprotocol)
+        frame = codec.encode(request)
+        if request.type in self.RELAY_REQUEST_TYPES:
+            self.metrics.relay_bytes.inc(len(frame), direction="out")
+        try:
+            # Send waits while more than write limit is buffered for the connection
+            async with asyncio.timeout(self.WEBSOCKET_SEND_TIMEOUT or None):
+                await websocket.send(frame, text=codec.text)
+        except TimeoutError:
+            # Client does not read, connection is dropped and user is disconnected by its receive task
+            self.metrics.connection_evictions.inc(reason="slow_consumer")
+            log_event("slow_consumer_evicted", logging.WARNING, request_type=request.type)
+            websocket.transport.abort()
+            raise websockets.exceptions.ConnectionClosedError(None, None)
+
+    async def __publish_state(self, event: str, **fields):
+        """Sends change of presence or routing state to other workers"""
+        if self.__bus is None:
+            return
+        await self.__bus.broadcast({"event": event, "worker_id": self.worker_id, **fields})
+
+    async def __handle_bus_message(self, message: dict):
+        """Applies state change made by another worker or delivers message to the websocket of this worker"""
+        worker_id = message.get("worker_id")
+        if worker_id is not None:
+            self.__workers_last_seen[worker_id] = asyncio.get_running_loop().time()
+
+        match message["event"]:
+            case "deliver":
+                await self.__deliver_to_local_websocket(
+                    message["user_id"], message["chat_user_id"], Request.from_dict(message["request"])
+                )
+            case "login":
+                # User who has reconnected to this worker keeps his local websocket
+                if not self.__is_local(self.__get_websocket(message["user_id"], None)):
+                    self.__apply_login(
+                        message["user_id"],
+                        RemoteWebSocket(self.__bus, worker_id, message["user_id"], None),
+                        message["long_term_public_key"]
+                    )
+                # Key was saved to the database by another worker, cached one may be outdated
+                self.__key_cache.set(message["user_id"], message["long_term_public_key"])
+            case "public_key":
+                self.__key_cache.set(message["user_id"], message["long_term_public_key"])
+            case "register":
+                if not self.__is_local(self.__get_websocket(message["user_id"], message["target_user_id"])):
+                    self.__apply_register(
+                        message["user_id"],
+                        message["target_user_id"],
+                        RemoteWebSocket(self.__bus, worker_id, message["user_id"], message["target_user_id"]),
+                        message["public_key"]
+                    )
+            case "pending":
+                self.__apply_pending(message["user_id"], message["target_user_id"])
+            case "pending_matched":
+                self.__apply_pending_matched(message["user_id"], message["target_user_id"])
+            case "disconnect":
+                # Late event of worker which user has left must not disconnect him from the current one
+                if self.__is_connected_only_to(message["user_id"], worker_id):
+                    self.__apply_disconnect(message["user_id"])
+                elif (client := self.__clients.get(message["user_id"])) is not None:
+                    # Sender ignored login and chats of this worker while it had own connection of the user
+                    await self.__send_user_state_to_worker(worker_id, message["user_id"], client)
+            case "flush_messages":
+                try:
+                    await self.__message_buffer.flush()
+                except Exception as e:
+                    # Messages stay in the buffer, waiting worker is not blocked by the failure
+                    log_event("bus_flush_failed", logging.ERROR, error=str(e))
+                await self.__bus.send(worker_id, {
+                    "event": "messages_flushed", "worker_id": self.worker_id, "request_id": message["request_id"]
+                })
+            case "messages_flushed":
+                flush_wait = self.__flush_waits.get(message["request_id"])
+                if flush_wait is not None:
+                    waiting_workers, flushed = flush_wait
+                    waiting_workers.discard(worker_id)
+                    if not waiting_workers:
+                        flushed.set()
+            case "worker_started":
+                await self.__send_state_to_worker(worker_id)
+            case "worker_stopped":
+                self.__forget_worker(worker_id)
+            case "heartbeat":
+                pass
+            case _:
+                log_event("unknown_bus_event", logging.WARNING, bus_event=message["event"])
+
+    def __get_websocket(self, user_id: str, chat_user_id: str | None):
+        """Returns main websocket of the user or websocket of his chat with chat_user_id, None if there is none"""
+        client = self.__clients.get(user_id)
+        if client is None:
+            return None
+        return client.main_websocket if chat_user_id is None else client.websockets.get(chat_user_id)
+
+    def __is_connected_only_to(self, user_id: str, worker_id: str) -> bool:
+        """Checks that all websockets of the user are connected to the worker"""
+        client = self.__clients.get(user_id)
+        if client is None:
             return False
+        return all(isinstance(websocket, RemoteWebSocket) and websocket.worker_id == worker_id
+                   for websocket in (client.main_websocket, *client.websockets.values()) if websocket is not None)
+
+    async def __deliver_to_local_websocket(self, user_id: str, chat_user_id: str | None, request: Request):
+        """Sends request which another worker addressed to websocket of this worker"""
+        websocket = self.__get_websocket(user_id, chat_user_id)
+        if not self.__is_local(websocket):
+            log_event("bus_delivery_dropped", logging.WARNING, user_id=user_id, chat_user_id=chat_user_id)
+            return
+        await self.__send(websocket, request)
+
+    async def __send_state_to_worker(self, worker_id: str):
+        """Sends state of users connected to this worker to the worker which has just started"""
+        for user_id, client in list(self.__clients.items()):
+            await self.__send_user_state_to_worker(worker_id, user_id, client)
+
+    async def __send_user_state_to_worker(self, worker_id: str, user_id: str, client: User):
+        """Sends login, chats and waits of the user which are connected to this worker"""
+        def state_message(event: str, **fields) -> dict:
+            return {"event": event, "worker_id": self.worker_id, **fields}
+
+        if self.__is_local(client.main_websocket):
+            await self.__bus.send(worker_id, state_message(
+                "login", user_id=user_id, long_term_public_key=client.long_term_public_key
+            ))
+        has_local_chats = False
+        for target_user_id, websocket in list(client.websockets.items()):
+            if self.__is_local(websocket):
+                has_local_chats = True
+                await self.__bus.send(worker_id, state_message(
+                    "register", user_id=user_id, target_user_id=target_user_id,
+                    public_key=client.public_keys.get(target_user_id)
+                ))
+        # Waits are sent once per user, the registry changes while messages are sent
+        if has_local_chats:
+            for pended_user_id in list(self.__pending.targets_of(user_id)):
+                await self.__bus.send(worker_id, state_message(
+                    "pending", user_id=user_id, target_user_id=pended_user_id
+                ))
+
+    def __forget_worker(self, worker_id: str):
+        """Disconnects users which were connected to stopped worker"""
+        self.__workers_last_seen.pop(worker_id, None)
+        for user_id, client in list(self.__clients.items()):
+            websockets_ = [client.main_websocket, *client.websockets.values()]
+            if any(isinstance(websocket, RemoteWebSocket) and websocket.worker_id == worker_id
+                   for websocket in websockets_):
+                self.__apply_disconnect(user_id)
+        log_event("worker_removed", logging.WARNING, worker_id=worker_id)
+
+    async def __send_heartbeats(self):
+        """Periodically tells other workers this worker is alive and removes workers which are silent"""
+        while True:
+            await self.__publish_state("heartbeat")
+            now = asyncio.get_running_loop().time()
+            for worker_id, last_seen in list(self.__workers_last_seen.items()):
+                if now - last_seen > self.BUS_WORKER_TIMEOUT:
+                    self.__forget_worker(worker_id)
+            await asyncio.sleep(self.BUS_HEARTBEAT_INTERVAL)
+
+    async def __flush_message_buffers(self):
+        """Writes messages buffered by this worker and waits until other workers write theirs"""
+        await self.__message_buffer.flush()
+        if self.__bus is None or not self.__workers_last_seen:
+            return
 
-
-    async def __get_user_info_from_db(self, email: str, password: str) -> dict | None:
-        """
-        Checks user credentials. Password is assumed to be hashed SHA-256 from client.
-        """
-        conn = await asyncpg.connect(self.SERVER_DATABASE_URL)
+        request_id = uuid.uuid4().hex
+        waiting_workers = set(self.__workers_last_seen)
+        flushed = asyncio.Event()
+        self.__flush_waits[request_id] = (waiting_workers, flushed)
         try:
-            row = await conn.fetchrow("""
-                SELECT user_id, email, password
-                FROM users
-                WHERE email = $1;
-            """, email)
-
-            if row is None:
-                return None
-
-            stored_password = row["password"]
-            if password == stored_password:
-                return {"user_id": row["user_id"], "email": row["email"]}
-            else:
-                return None
+            await self.__publish_state("flush_messages", request_id=request_id)
+            async with asyncio.timeout(self.BUS_FLUSH_TIMEOUT):
+                await flushed.wait()
+        except TimeoutError:
+            log_event("bus_flush_timeout", logging.WARNING, workers=len(waiting_workers))
         finally:
-            await conn.close()
-
+            del self.__flush_waits[request_id]
 
-    def __disconnect_user(self, user_id: str):
+    async def __disconnect_user(self, user_id: str):
         """Disconnect user with given user id"""
-        disconnected_user = self.__clients[user_id]
-
-        for pended_user_id in disconnected_user.pended_users:
-            self.__clients[pended_user_id].pending_users.discard(user_id)
-
-        self.__clients[user_id].disconnect()
-        print(f"User {user_id} was disconnected")
+        self.__apply_disconnect(user_id)
+        await self.__publish_state("disconnect", user_id=user_id)
+        log_event("user_disconnected", logging.INFO, user_id=user_id)
 
     async def __handle_register_request(self, websocket: WebSocket, user_id: str, data: dict):
         """Function which handles receiving and processing register_request from user"""
         target_user_id = data["target_user_id"]
-        client = self.__clients[user_id]
-        target_client = self.__clients.setdefault(target_user_id, User())
-
         public_key = data["public_key"]
 
-        client.websockets[target_user_id] = websocket
-        client.is_online = True
-        client.public_keys[target_user_id] = public_key
+        self.__apply_register(user_id, target_user_id, websocket, public_key)
+        await self.__publish_state("register", user_id=user_id, target_user_id=target_user_id, public_key=public_key)
+        target_client = self.__clients[target_user_id]
+
+        # Messages which are still buffered by any worker have to reach the database before it is read
+        await self.__flush_message_buffers()
 
-        # Stored messages are sent to the user as one relay_message_request
-        stored_messages = await self.__get_messages_from_db(user_id, target_user_id)
+        async def send_stored_messages_chunk(stored_messages: list[str], cursor: int, has_more: bool):
+            send_stored_messages = Request(
+                request_type="send_stored_messages",
+                content={"message": stored_messages, "cursor": cursor, "has_more": has_more}
+            )
+            await self.__send(websocket, send_stored_messages)
 
-        send_stored_messages = Request(
-            request_type="send_stored_messages",
-            content={"message": stored_messages}
+        # Stored messages are sent to the user in chunks, chunk is removed from the database once it is sent
+        await self.__storage.drain_messages(
+            user_id, target_user_id, self.STORED_MESSAGES_CHUNK_SIZE, self.STORED_MESSAGES_CHUNK_MAX_BYTES,
+            send_stored_messages_chunk
         )
-        await websocket.send(send_stored_messages.json_string)
 
-        if target_user_id in target_client.pending_users:
-            client.pending_users.discard(target_user_id)
-            target_client.pended_users.discard(user_id)
+        # Target user sent connection_request while this user was offline and is waiting for him
+        # Waits restored from snapshot belong to users who have not reconnected yet, they are kept until chat
+        # of the waiter is registered again
+        target_user_websocket = target_client.websockets.get(user_id)
+        if target_user_websocket is not None and self.__pending.match(target_user_id, user_id):
+            self.__apply_pending_matched(user_id, target_user_id)
+            await self.__publish_state("pending_matched", user_id=user_id, target_user_id=target_user_id)
 
-            target_user_public_key = target_client.public_keys[user_id]
+            target_user_public_key = target_client.public_keys.get(user_id)
 
             register_response = Request(
                 request_type="register_response",
@@ -260,15 +740,14 @@ class Server:
                         "role": "answer",
                         "public_key": target_user_public_key}
             )
-            await websocket.send(register_response.json_string)
-            print(f"Connection establishment request sent: {register_response.json_string}")
+            await self.__send(websocket, register_response)
 
             connection_establishment_request = Request(
                 request_type="connection_establishment_request",
                 content={"user_id": user_id, "role": "offer"}
             )
-            await target_client.websockets[user_id].send(connection_establishment_request.json_string)
-            print(f"Connection establishment request sent: {connection_establishment_request.json_string}")
+            await self.__send(target_user_websocket, connection_establishment_request)
+            log_event("connection_establishment_request_sent", user_id=user_id, target_user_id=target_user_id)
 
         elif target_client.is_online:
             register_response = Request(
@@ -276,30 +755,34 @@ class Server:
                 content = {"register_response_type": "target_user_online"}
                         # "public_key": self.__clients[target_user_id].public_keys[user_id]}
             )
-            await websocket.send(register_response.json_string)
+            await self.__send(websocket, register_response)
 
         else:
             register_response = Request(
                 request_type="register_response",
                 content = {"register_response_type": "target_user_offline"}
             )
-            await websocket.send(register_response.json_string)
+            await self.__send(websocket, register_response)
 
     async def __handle_connection_request(self, websocket: WebSocket, user_id: str, data: dict):
         """Function which handles processing connection_request from user"""
         target_user_id = data["target_user_id"]
+        # Public key of the chat is sent to the target user
+        self.__get_chat_websocket(user_id, target_user_id)
         client = self.__clients[user_id]
 
-        if target_user_id not in self.__clients:
+        # Offline users are not kept in memory, database tells if target user is registered at all
+        if target_user_id not in self.__clients and not await self.__storage.user_exists(target_user_id):
             connection_response= Request(
                 request_type="connection_response",
                 content = {"connection_response_type": "client_not_registered_error"}
             )
-            await websocket.send(connection_response.json_string)
+            await self.__send(websocket, connection_response)
             return
 
-        target_client = self.__clients[target_user_id]
-        if target_client.is_online:
+        target_client = self.__clients.get(target_user_id)
+        # Online target user which has not registered chat with the user yet is waited for like offline one
+        if target_client is not None and target_client.is_online and user_id in target_client.websockets:
             connection_establishment_request = Request(
                 request_type="connection_establishment_request",
                 content={"user_id": user_id,
@@ -307,8 +790,7 @@ class Server:
                         "public_key": client.public_keys[target_user_id]}
             )
 
-            await target_client.websockets[user_id].send(connection_establishment_request.json_string)
-            print(f"Connection establishment request sent to answerer: {connection_establishment_request}")
+            await self.__send(target_client.websockets[user_id], connection_establishment_request)
 
             connection_response = Request(
                 request_type="connection_response",
@@ -316,143 +798,176 @@ class Server:
                         "role": "offer",
                         "public_key": target_client.public_keys[user_id]}
             )
-            await websocket.send(connection_response.json_string)
-            print(f"Connection establishment request sent to offerer: {connection_response}")
+            await self.__send(websocket, connection_response)
+            log_event("connection_establishment_request_sent", user_id=user_id, target_user_id=target_user_id)
 
         else:
-            target_client.is_pended = True
-            target_client.pending_users.add(user_id)
-            client.pended_users.add(target_user_id)
+            self.__apply_pending(user_id, target_user_id)
+            await self.__publish_state("pending", user_id=user_id, target_user_id=target_user_id)
 
             connection_response = Request(
                 request_type="connection_response",
                 content = {"connection_response_type": "target_user_offline"}
             )
-            await websocket.send(connection_response.json_string)
+            await self.__send(websocket, connection_response)
 
     async def __handle_share_offer_request(self, user_id: str, data: dict):
         """Sends offer SDP to the target user"""
         target_user_id = data["target_user_id"]
-        target_user_websocket = self.__clients[target_user_id].websockets[user_id]
+        target_user_websocket = self.__get_chat_websocket(target_user_id, user_id)
         offer = data["offer"]
         share_offer_request = Request(
             request_type="share_offer_request",
             content={"user_id": target_user_id, "offer": offer}
         )
 
-        await target_user_websocket.send(share_offer_request.json_string)
-        print(f"Offer was sent to the target user: {share_offer_request.json_string}")
+        await self.__send(target_user_websocket, share_offer_request)
+        log_event("offer_relayed", sampled=True, user_id=user_id, target_user_id=target_user_id, offer=offer)
 
     async def __handle_share_answer_request(self, user_id: str, data: dict):
         """Sends answer SDP to the target user"""
         target_user_id = data["target_user_id"]
-        target_user_websocket = self.__clients[target_user_id].websockets[user_id]
+        target_user_websocket = self.__get_chat_websocket(target_user_id, user_id)
         answer = data["answer"]
         share_answer_request = Request(
             request_type="share_answer_request",
             content={"user_id": target_user_id, "answer": answer}
         )
 
-        await target_user_websocket.send(share_answer_request.json_string)
-        print(f"Answer was sent to the target user: {share_answer_request.json_string}")
+        await self.__send(target_user_websocket, share_answer_request)
+        log_event("answer_relayed", sampled=True, user_id=user_id, target_user_id=target_user_id, answer=answer)
 
     async def __handle_relay_message_request(self, user_id: str, data: dict):
         """
         Function which handles processing relay_message_request from user
         If user onlines sends message to the target user
-        If user is offline stores message in the database
+        If user is offline or his connection closes during sending stores message in the database
         """
         target_user_id = data["target_user"]
-        target_client = self.__clients[target_user_id]
+        target_client = self.__clients.get(target_user_id)
 
-        if target_client.is_online:
+        # Messages to target user who has not registered chat with the user are stored until he does
+        if target_client is not None and target_client.is_online and user_id in target_client.websockets:
             target_user_websocket = target_client.websockets[user_id]
             relay_message_request = Request(
                 request_type="relay_message_request",
                 content={"message": data["message"], "public_key": data["public_key"]}
                 )
-            await target_user_websocket.send(relay_message_request.json_string)
-            print(f"Message from {user_id} to {target_user_id} was relayed.")
-
-        else:
             try:
-                await self.__save_message_to_db(
-                    user_id=user_id,
-                    target_user_id=target_user_id,
-                    message=data["message"]
-                )
-                print(f"Message from {user_id} to {data['target_user']} saved to database.")
+                await self.__send(target_user_websocket, relay_message_request)
+                log_event("message_relayed", sampled=True, user_id=user_id, target_user_id=target_user_id)
+                return
+            except websockets.exceptions.ConnectionClosed:
+                # Target user was evicted as slow consumer or closed connection which is not disconnected yet
+                log_event("relay_target_closed", sampled=True, user_id=user_id, target_user_id=target_user_id)
 
-            except KeyError as e:
-                print(f"Missing key in relay_message_request: {e}")
-            except Exception as e:
-                print(f"Error while handling relay_message_request: {e}")
+        try:
+            message = data["message"]
+            if isinstance(message, bytes): # Pass-through payload
+                message = message.decode()
+            # Message is written to the database in the background, waits only if buffer is full
+            await self.__message_buffer.put(
+                user_id=user_id,
+                target_user_id=target_user_id,
+                message=message
+            )
+            log_event("message_stored", sampled=True, user_id=user_id, target_user_id=target_user_id)
+
+        except KeyError as e:
+            log_event("relay_message_request_missing_key", logging.WARNING, user_id=user_id, key=str(e))
+        except Exception as e:
+            log_event("relay_message_request_failed", logging.ERROR, user_id=user_id, error=str(e))
 
     async def __handle_get_target_user_status_request(self, user_id: str, data: dict):
         target_user_id = data["target_user_id"]
-        websocket = self.__clients[user_id].websockets[target_user_id]
+        websocket = self.__get_chat_websocket(user_id, target_user_id)
 
-        target_user_status = self.__clients[target_user_id].is_online
+        target_client = self.__clients.get(target_user_id)
+        target_user_status = target_client is not None and target_client.is_online
         target_user_public_key = None
         if target_user_status:
-            target_user_public_key = self.__clients[target_user_id].public_keys[user_id]
+            target_user_public_key = target_client.public_keys.get(user_id)
 
         target_user_status_request = Request(
             request_type="target_user_status_response",
             content={"target_user_status": target_user_status,
                     "public_key": target_user_public_key}
         )
-        await websocket.send(target_user_status_request.json_string)
-        print(f"Target user status request sent: {target_user_status_request.json_string}")
+        await self.__send(websocket, target_user_status_request)
+        log_event("target_user_status_sent", sampled=True, user_id=user_id, target_user_id=target_user_id,
+                  target_user_status=target_user_status)
+
+    async def __handle_subscribe_presence_request(self, websocket: WebSocket, user_id: str, data: dict):
+        """Subscribes user to status changes of target users and sends their current status"""
+        target_user_ids = self.__presence.subscribe(user_id, list(dict.fromkeys(data["target_user_ids"])))
+        presence = {}
+        for target_user_id in target_user_ids:
+            target_client = self.__clients.get(target_user_id)
+            presence[target_user_id] = target_client is not None and target_client.is_online
+
+        presence_update = Request(request_type="presence_update", content={"presence": presence})
+        await self.__send(websocket, presence_update)
+
+    async def __handle_unsubscribe_presence_request(self, user_id: str, data: dict):
+        self.__presence.unsubscribe(user_id, data["target_user_ids"])
 
     async def __handle_send_long_term_public_key_request(self, user_id: str, data: dict):
         """Saves long term public key to the database"""
         public_key = data["long_term_public_key"]
-        await self.__save_key_to_db(user_id, public_key)
+        await self.__save_key(user_id, public_key)
+        await self.__publish_state("public_key", user_id=user_id, long_term_public_key=public_key)
 
     async def __handle_get_long_term_public_key_request(self, websocket, data: dict):
         """Gets long term public key from the database"""
         target_user_id = data["target_user_id"]
-        public_key = await self.__get_key_from_db(target_user_id)
+        public_key = await self.__get_key(target_user_id)
         if public_key is None:
             raise UserNotRegisteredError("Target user is not registered on the server.")
         get_long_term_public_key_request = Request(
             request_type="get_long_term_public_key_response",
             content={"long_term_public_key": public_key}
         )
-        print(f"Long term public key request sent: {get_long_term_public_key_request.json_string}")
-        await websocket.send(get_long_term_public_key_request.json_string)
+        await self.__send(websocket, get_long_term_public_key_request)
+
+    async def __handle_get_long_term_public_keys_request(self, websocket, data: dict):
+        """Gets long term public keys of several users, None for users which are not registered"""
+        target_user_ids = list(dict.fromkeys(data["target_user_ids"]))
+        public_keys = await self.__get_keys(target_user_ids)
+        get_long_term_public_keys_response = Request(
+            request_type="get_long_term_public_keys_response",
+            content={"long_term_public_keys": public_keys}
+        )
+        await self.__send(websocket, get_long_term_public_keys_response)
 
-    async def __handle_get_public_key_request(self, user_id: str, data: dict):
+    async def __handle_get_public_key_request(self, websocket: WebSocket, user_id: str, data: dict):
+        """Sends public key target user uses in chat with the user"""
         target_user_id = data["target_user_id"]
-        public_key = self.__clients[target_user_id].public_key
+        target_client = self.__clients.get(target_user_id)
+        public_key = target_client.public_keys.get(user_id) if target_client is not None else None
         if public_key is None:
             raise UserNotRegisteredError("Target user is not registered on the server.")
         get_public_key_request = Request(
             request_type="get_public_key_response",
             content={"public_key": public_key}
         )
-        await self.__clients[user_id].websocket.send(get_public_key_request.json_string)
+        await self.__send(websocket, get_public_key_request)
 
     async def __handle_add_user_to_db_request(self, websocket, data: dict):
-        print("🟡 Entered __handle_add_user_to_db_request")
-
         user_id = data.get("user_id")
         email = data.get("email")
         password = data.get("password")
 
-        print(f"🧾 Received data: username={user_id}, email={email}, password={'*' * len(password) if password else None}")
-
-        if not user_id or not email or not password:
+        if not all(isinstance(value, str) and value for value in (user_id, email, password)):
             error_response = Request(
                 request_type="add_user_to_data_base_response",
                 content={"status": "error", "message": "Missing username, email, or password."}
             )
-            await websocket.send(error_response.json_string)
-            print("❌ Sent error response: missing fields")
+            await self.__send(websocket, error_response)
+            log_event("add_user_missing_fields", logging.INFO, user_id=user_id)
             return
 
-        success = await self.__add_user_to_db(user_id, email, password)
+        password_hash = await self.__password_hasher.hash(password)
+        success = await self.__storage.add_user(user_id, email, password_hash)
 
         if success:
             success_response = Request(
@@ -465,8 +980,7 @@ class Server:
                 content={"status": "error", "message": "Username or email already exists."}
             )
 
-        print("📤 Sending response to client:", success_response.json_string)
-        await websocket.send(success_response.json_string)
+        await self.__send(websocket, success_response)
 
 
     async def __handle_check_user_exists_request(self, websocket, data: dict):
@@ -476,25 +990,30 @@ class Server:
         email = data.get("email")
         password = data.get("password")
 
-        if not email or not password:
+        if not all(isinstance(value, str) and value for value in (email, password)):
             error_response = Request(
                 request_type="get_user_info_from_data_base_response",
                 content={"status": "error", "message": "Missing email or password."}
             )
-            await websocket.send(error_response.json_string)
+            await self.__send(websocket, error_response)
             return
 
-        user_info = await self.__get_user_info_from_db(email, password)
-        user_exists = bool(user_info)
+        user_info = await self.__storage.get_user(email)
+        user_exists = user_info is not None and await self.__password_hasher.verify(password, user_info["password"])
 
         if not user_exists:
             error_response = Request(
                 request_type="get_user_info_from_data_base_response",
                 content={"status": "error", "message": "Invalid email or password."}
             )
-            await websocket.send(error_response.json_string)
+            await self.__send(websocket, error_response)
             return
 
+        if is_legacy_hash(user_info["password"]):
+            # Password of user registered before server side hashing is replaced with its hash
+            await self.__storage.update_password(user_info["user_id"], await self.__password_hasher.hash(password))
+            log_event("password_rehashed", logging.INFO, user_id=user_info["user_id"])
+
         success_response = Request(
             request_type="get_user_info_from_data_base_response",
             content={
@@ -504,122 +1023,536 @@ class Server:
                 "password": password  # ⬅️ hashed password from client
             }
         )
-        await websocket.send(success_response.json_string)
+        await self.__send(websocket, success_response)
 
 
     async def __handle_user_existance_request(self, websocket, user_id: str, data: dict):
         """Checks if user are registred on the server"""
         target_user_id = data["target_user_id"]
-        try:
-            conn = await asyncpg.connect(self.SERVER_DATABASE_URL)
+        user_existance = await self.__storage.user_exists(target_user_id)
 
-            row = await conn.fetchval(
-                "SELECT EXISTS(SELECT 1 FROM users WHERE user_id = $1)",
-                target_user_id
+        user_existance_request = Request(
+            request_type="check_user_existance_request",
+            content={"target_user_id": target_user_id, "user_existance": bool(user_existance)}
+        )
+        await self.__send(websocket, user_existance_request)
+
+    async def __handle_users_existance_request(self, websocket, data: dict):
+        """Checks which of several users are registered on the server"""
+        target_user_ids = list(dict.fromkeys(data["target_user_ids"]))
+        users_existance = {}
+        for start in range(0, len(target_user_ids), self.BATCH_LOOKUP_MAX_SIZE):
+            users_existance.update(
+                await self.__storage.users_exist(target_user_ids[start:start + self.BATCH_LOOKUP_MAX_SIZE])
             )
 
-            user_existance_request = Request(
-                request_type="check_user_existance_request",
-                content={"target_user_id": target_user_id, "user_existance": bool(row)}
-            )
-            await websocket.send(user_existance_request.json_string)
-        finally:
-            await conn.close()
+        users_existance_response = Request(
+            request_type="check_users_existance_response",
+            content={"users_existance": users_existance}
+        )
+        await self.__send(websocket, users_existance_response)
 
 
     async def __handle_login_request(self, websocket: WebSocket, user_id: str, data: dict):
-        client = self.__clients.setdefault(user_id, User())
-        client.main_websocket = websocket
-        client.is_online = True
-
         public_key = data["long_term_public_key"]
-        client.long_term_public_key = public_key
-        await self.__save_key_to_db(user_id, public_key)
+        self.__apply_login(user_id, websocket, public_key)
+        await self.__publish_state("login", user_id=user_id, long_term_public_key=public_key)
+        await self.__save_key(user_id, public_key)
+        await self.__send_created_chats(websocket, user_id, cursor=0, first_page=True)
+
+    async def __send_created_chats(self, websocket: WebSocket, user_id: str, cursor: int, first_page: bool = False):
+        """
+        Sends page of chats other users created with the user while he was offline
+        The next page is sent when the client acknowledges this one with created_chats_ack_request
+        """
+        notifications = await self.__storage.get_chat_notifications(
+            user_id, cursor, self.CHAT_NOTIFICATIONS_PAGE_SIZE + 1
+        )
+        has_more = len(notifications) > self.CHAT_NOTIFICATIONS_PAGE_SIZE
+        notifications = notifications[:self.CHAT_NOTIFICATIONS_PAGE_SIZE]
+        # Login always gets the first page, even empty one
+        if not notifications and not first_page:
+            return
 
         created_chats_request = Request(
             request_type="created_chats",
-            content={"created_chats": client.created_chats}
+            content={"created_chats": [creator_id for _, creator_id in notifications],
+                     "cursor": notifications[-1][0] if notifications else cursor,
+                     "has_more": has_more}
         )
-        await websocket.send(created_chats_request.json_string)
-        client.created_chats = []
+        await self.__send(websocket, created_chats_request)
+
+    async def __handle_created_chats_ack_request(self, websocket: WebSocket, user_id: str, data: dict):
+        """Removes chats which the client has received up to cursor and sends the next page"""
+        cursor = int(data["cursor"])
+        await self.__storage.ack_chat_notifications(user_id, cursor)
+        await self.__send_created_chats(websocket, user_id, cursor)
 
     async def __handle_create_chat_request(self, user_id: str, data: dict):
         target_user_id = data["target_user_id"]
-        target_client = self.__clients[target_user_id]
+        target_client = self.__clients.get(target_user_id)
+        # Notifications are stored only for registered users, offline ones are not kept in memory
+        if target_client is None and not await self.__storage.user_exists(target_user_id):
+            log_event("chat_target_not_registered", user_id=user_id, target_user_id=target_user_id)
+            return
 
-        if target_client.is_online:
+        # User who registered chat but has not logged in has no main websocket
+        if target_client is not None and target_client.is_online and target_client.main_websocket is not None:
             create_chat_request = Request(
                 request_type="create_chat_request",
                 content={"target_user_id": user_id}
             )
-            await target_client.main_websocket.send(create_chat_request.json_string)
+            await self.__send(target_client.main_websocket, create_chat_request)
 
         else:
-            target_client.created_chats.append(user_id)
+            # Stored until target user logs in and acknowledges it, the same chat is stored once
+            await self.__storage.add_chat_notification(target_user_id, user_id)
+
+    def __owns_connection(self, user_id: str, websocket: WebSocket) -> bool:
+        """Checks if websocket is still used by the user, it may have reconnected with another one"""
+        client = self.__clients.get(user_id)
+        if client is None:
+            return False
+        if client.main_websocket is websocket:
+            return True
+        return any(
+            chat_websocket is websocket
+            or (isinstance(chat_websocket, ChannelWebSocket) and chat_websocket.websocket is websocket)
+            for chat_websocket in client.websockets.values()
+        )
 
     async def __receive_requests(self, websocket: WebSocket, requests_queue: asyncio.Queue):
         """Function which receives requests from user and adds them to the requests queue"""
         user_id = None
         try:
-            async for request in websocket:
-                print(f"Request received: {request}")
-                request = Request.from_string(request)
+            codec = get_codec(websocket.subprotocol)
+            while True:
+                async with asyncio.timeout(self.WEBSOCKET_IDLE_TIMEOUT or None):
+                    frame = await websocket.recv()
+                if self.__capture is not None:
+                    self.__capture.record(websocket.id.hex, websocket.subprotocol, frame)
+                try:
+                    request = codec.decode(frame)
+                except Exception as e:
+                    # Bad frame is reported to the client, connection keeps working
+                    await self.__reject_malformed_frame(websocket, e)
+                    continue
+                if self.__stop_event.is_set():
+                    # Requests which arrive during shutdown are not handled, client retries them after reconnect
+                    await self.__reject_request(websocket, request, "overloaded", self.OVERLOAD_RETRY_AFTER,
+                                                reason="shutdown")
+                    continue
                 user_id = request.user_id
-                requests_queue.put_nowait(request)
-        except websockets.exceptions.ConnectionClosed:
-            print(f"Connection closed for user: {user_id}")
+                log_event("request_received", sampled=True, request_type=request.type, user_id=user_id)
+                self.metrics.requests.inc(request_type=self.__request_label(request))
+                if request.type in self.RELAY_REQUEST_TYPES:
+                    self.metrics.relay_bytes.inc(len(frame), direction="in")
+                self.metrics.request_queue_depth.observe(requests_queue.qsize())
+                # Waits while queue is full, so client is not read faster than requests are handled
+                await requests_queue.put(request)
+        except websockets.exceptions.ConnectionClosed as e:
+            if e.rcvd is None and e.sent is not None and e.sent.code == CloseCode.INTERNAL_ERROR:
+                # Pong was not received within ping timeout
+                self.metrics.connection_evictions.inc(reason="ping_timeout")
+            log_event("connection_closed", logging.INFO, user_id=user_id)
+        except TimeoutError:
+            self.metrics.connection_evictions.inc(reason="idle")
+            log_event("connection_idle_timeout", logging.INFO, user_id=user_id)
         except asyncio.CancelledError:
-            print("Handler task was cancelled")
+            log_event("receive_task_cancelled", user_id=user_id)
             return
         finally:
-            if user_id is not None:
-                self.__disconnect_user(user_id)
+            if user_id is not None and self.__owns_connection(user_id, websocket):
+                await self.__disconnect_user(user_id)
 
+            # Stops request handling loop, if this task was cancelled the loop is already stopped
+            if not asyncio.current_task().cancelling():
+                await requests_queue.put(None)
             await websocket.close()
 
+    async def __reject_malformed_frame(self, websocket: WebSocket, error: Exception):
+        self.metrics.request_errors.inc(request_type="malformed", error=type(error).__name__)
+        log_event("malformed_frame", logging.WARNING, sampled=True, error=str(error))
+        error_response = Request(
+            request_type="error_response",
+            content={"error_type": "malformed_request", "message": "Frame is not a request."}
+        )
+        await self.__send(websocket, error_response)
+
+    def __request_label(self, request: Request) -> str:
+        """Request type used in metrics, types which are not known are counted together"""
+        return request.type if request.type in self.REQUEST_FIELDS else "unknown"
+
+    def __validate_request(self, request: Request):
+        """Checks that request has user id and content fields its handler reads"""
+        fields = self.REQUEST_FIELDS.get(request.type)
+        if fields is None:
+            raise IncorrectRequestTypeError(f"Incorrect request type in __websocket_handler ({request.type}).")
+        if request.user_id is None and request.type not in self.ANONYMOUS_REQUEST_TYPES:
+            raise InvalidRequestError("invalid_request", "Request has to have user id.")
+        for field, is_valid in fields.items():
+            if not is_valid(request.content.get(field)):
+                raise InvalidRequestError("invalid_request", f"Field {field} is missing or has wrong type.")
+        channel = request.content.get("channel")
+        if channel is not None and not isinstance(channel, (str, int)):
+            raise InvalidRequestError("invalid_request", "Field channel has wrong type.")
+
+    async def __reject_invalid_request(self, websocket: WebSocket, request: Request, error: Exception):
+        """Sends error to the client of request which can not be handled, it is not a failure of the server"""
+        error_type = {
+            IncorrectRequestTypeError: "incorrect_request_type",
+            UserNotRegisteredError: "user_not_registered",
+        }.get(type(error)) or error.error_type
+        self.metrics.request_errors.inc(request_type=self.__request_label(request), error=error_type)
+        log_event("invalid_request", logging.INFO, sampled=True, request_type=request.type,
+                  user_id=request.user_id, error_type=error_type, error=str(error))
+        error_response = Request(
+            request_type="error_response",
+            content={"error_type": error_type, "request_type": request.type, "message": str(error)}
+        )
+        if isinstance(request.content.get("channel"), (str, int)):
+            error_response.content["channel"] = request.content["channel"]
+        try:
+            await self.__send(websocket, error_response)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    def __get_chat_websocket(self, user_id: str, target_user_id: str):
+        """Returns websocket of chat user has with target user"""
+        client = self.__clients.get(user_id)
+        websocket = client.websockets.get(target_user_id) if client is not None else None
+        if websocket is None:
+            raise InvalidRequestError("chat_not_registered", "Chat with target user is not registered.")
+        return websocket
+
+    async def __dispatch_request(self, websocket: WebSocket, request: Request):
+        """Calls handler corresponding to the request type"""
+        request_type = request.type
+        user_id = request.user_id
+        data = request.content
+        if "channel" in data and request_type in self.CHANNEL_REQUEST_TYPES:
+            # Chat multiplexed over the main websocket, responses have to be marked with its channel
+            # Other requests, e.g. login_request, are handled as if sent without channel
+            websocket = ChannelWebSocket(websocket, data["channel"])
+
+        match request_type:
+            case "register_request":
+                await self.__handle_register_request(websocket, user_id, data)
+            case "connection_request":
+                await self.__handle_connection_request(websocket, user_id, data)
+            case "share_offer_request":
+                await self.__handle_share_offer_request(user_id, data)
+            case "share_answer_request":
+                await self.__handle_share_answer_request(user_id, data)
+            case "relay_message_request":
+                await self.__handle_relay_message_request(user_id, data)
+            case "get_target_user_status_request":
+                await self.__handle_get_target_user_status_request(user_id, data)
+            case "get_public_key_request":
+                await self.__handle_get_public_key_request(websocket, user_id, data)
+            case "send_long_term_public_key_request":
+                await self.__handle_send_long_term_public_key_request(user_id, data)
+            case "get_long_term_public_key_request":
+                await self.__handle_get_long_term_public_key_request(websocket, data)
+            case "get_long_term_public_keys_request":
+                await self.__handle_get_long_term_public_keys_request(websocket, data)
+            case "subscribe_presence_request":
+                await self.__handle_subscribe_presence_request(websocket, user_id, data)
+            case "unsubscribe_presence_request":
+                await self.__handle_unsubscribe_presence_request(user_id, data)
+            case "login_request":
+                await self.__handle_login_request(websocket, user_id, data)
+            case "create_chat_request":
+                await self.__handle_create_chat_request(user_id, data)
+            case "created_chats_ack_request":
+                await self.__handle_created_chats_ack_request(websocket, user_id, data)
+            case "add_user_to_data_base":
+                await self.__handle_add_user_to_db_request(websocket, data)
+            case "get_user_info_from_data_base":
+                await self.__handle_check_user_exists_request(websocket, data)
+            case "check_user_existance_request":
+                await self.__handle_user_existance_request(websocket, user_id, data)
+            case "check_users_existance_request":
+                await self.__handle_users_existance_request(websocket, data)
+            case _:
+                raise IncorrectRequestTypeError(f"Incorrect request type in __websocket_handler ({request_type}).")
+
+    def __get_ordering_key(self, request: Request) -> tuple | None:
+        """Returns key of requests which have to be handled in order with the given one, None if it is independent"""
+        if request.type not in self.ORDERED_REQUEST_TYPES:
+            return None
+
+        target_user_id = request.content.get("target_user_id") or request.content.get("target_user")
+        if target_user_id is not None:
+            return ("target_user", target_user_id)
+        return ("request_type", request.type)
+
+    async def __handle_request(self, websocket: WebSocket, request: Request):
+        """Handles request, errors are reported to the client or logged instead of stopping the connection"""
+        start = time.perf_counter()
+        try:
+            with self.__loop_lag_monitor.track(self.__request_label(request)):
+                await self.__dispatch_request(websocket, request)
+        except (InvalidRequestError, UserNotRegisteredError) as e:
+            await self.__reject_invalid_request(websocket, request, e)
+        except DatabaseUnavailableError as e:
+            self.metrics.request_errors.inc(request_type=self.__request_label(request), error="database_unavailable")
+            log_event("database_unavailable", logging.ERROR, request_type=request.type, error=str(e))
+            error_response = Request(
+                request_type="error_response",
+                content={"error_type": "database_unavailable",
+                        "request_type": request.type,
+                        "message": "Server database is temporarily unavailable, try again later."}
+            )
+            try:
+                await self.__send(websocket, error_response)
+            except websockets.exceptions.ConnectionClosed:
+                pass
+        except websockets.exceptions.ConnectionClosed:
+            self.metrics.request_errors.inc(request_type=self.__request_label(request), error="connection_closed")
+            log_event("connection_closed_while_handling", logging.INFO,
+                      request_type=request.type, user_id=request.user_id)
+        except Exception as e:
+            self.metrics.request_errors.inc(request_type=self.__request_label(request), error=type(e).__name__)
+            logger.exception("request_failed", extra={"fields": {"request_type": request.type,
+                                                                 "user_id": request.user_id,
+                                                                 "peer": websocket.remote_address}})
+        finally:
+            self.metrics.request_duration.observe(time.perf_counter() - start, request_type=self.__request_label(request))
+
+    @property
+    def is_overloaded(self) -> bool:
+        """Indicates if new requests have to be rejected so requests which are handled do not slow down further"""
+        return (self.__loop_lag_monitor.lag > self.OVERLOAD_LOOP_LAG
+                or self.__storage.pending_operations > self.OVERLOAD_PENDING_DB_OPERATIONS)
+
+    def __client_address(self, websocket: WebSocket) -> str:
+        if self.CLIENT_ADDRESS_HEADER:
+            forwarded = websocket.request.headers.get(self.CLIENT_ADDRESS_HEADER)
+            if forwarded:
+                # The last entry is added by the load balancer, the ones before it are sent by the client
+                return forwarded.split(",")[-1].strip()
+        return str(websocket.remote_address[0])
+
+    async def __admit_request(self, websocket: WebSocket, request: Request, rate_limit_key: str,
+                              address: str) -> bool:
+        """
+        Checks rate limits of the user or connection and of the address and load of the server,
+        sends rejection if request is not handled
+        """
+        if self.is_overloaded:
+            response_type, retry_after = "overloaded", self.OVERLOAD_RETRY_AFTER
+        else:
+            retry_after = (self.__rate_limiter.allow(rate_limit_key, request.type)
+                           or self.__address_rate_limiter.allow(address, request.type))
+            if retry_after is None:
+                return True
+            response_type = "rate_limited"
+
+        await self.__reject_request(websocket, request, response_type, retry_after)
+        return False
+
+    async def __reject_request(self, websocket: WebSocket, request: Request, response_type: str, retry_after: float,
+                               reason: str | None = None):
+        """Tells the client that request is not handled and it can be sent again after retry_after seconds"""
+        reason = reason or response_type
+        self.metrics.requests_rejected.inc(request_type=self.__request_label(request), reason=reason)
+        log_event("request_rejected", sampled=True, request_type=request.type, user_id=request.user_id,
+                  reason=reason)
+        content = {"request_type": request.type, "retry_after": round(retry_after, 3)}
+        if isinstance(request.content, dict) and "channel" in request.content:
+            content["channel"] = request.content["channel"]
+        try:
+            await self.__send(websocket, Request(request_type=response_type, content=content))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
     async def __websocket_handler(self, websocket):
-        print("New client connected.")
-        requests_queue = asyncio.Queue()
-        asyncio.create_task(self.__receive_requests(websocket, requests_queue))
+        log_event("client_connected", sampled=True)
+        self.metrics.connections.inc()
+        requests_queue = asyncio.Queue(maxsize=self.REQUEST_QUEUE_SIZE)
+        receive_task = asyncio.create_task(self.__receive_requests(websocket, requests_queue))
+        dispatcher = RequestDispatcher(
+            handle=lambda request: self.__handle_request(websocket, request),
+            max_concurrent=self.MAX_CONCURRENT_REQUESTS
+        )
+        self.__connection_requests[websocket] = (requests_queue, dispatcher)
+        # Requests are limited by the first user id sent by the connection and its address, user id of every
+        # request is set by the client, so changing it does not reset limits
+        address = self.__client_address(websocket)
+        rate_limit_key = f"connection/{websocket.id.hex}"
+        has_user_id = False
 
-        while True:
-            request = await requests_queue.get()
-            request_type = request.type
-            user_id = request.user_id
-            data = request.content
-
-            match request_type:
-                case "register_request":
-                    await self.__handle_register_request(websocket, user_id, data)
-                case "connection_request":
-                    await self.__handle_connection_request(websocket, user_id, data)
-                case "share_offer_request":
-                    await self.__handle_share_offer_request(user_id, data)
-                case "share_answer_request":
-                    await self.__handle_share_answer_request(user_id, data)
-                case "relay_message_request":
-                    await self.__handle_relay_message_request(user_id, data)
-                case "get_target_user_status_request":
-                    await self.__handle_get_target_user_status_request(user_id, data)
-                case "send_long_term_public_key_request":
-                    await self.__handle_send_long_term_public_key_request(user_id, data)
-                case "get_long_term_public_key_request":
-                    await self.__handle_get_long_term_public_key_request(websocket, data)
-                case "login_request":
-                    await self.__handle_login_request(websocket, user_id, data)
-                case "create_chat_request":
-                    await self.__handle_create_chat_request(user_id, data)
-                case "add_user_to_data_base":
-                    await self.__handle_add_user_to_db_request(websocket, data)
-                case "get_user_info_from_data_base":
-                    await self.__handle_check_user_exists_request(websocket, data)
-                case "check_user_existance_request":
-                    await self.__handle_user_existance_request(websocket, user_id, data)
-                case _:
-                    raise IncorrectRequestTypeError(f"Incorrect request type in __websocket_handler ({request_type}).")
+        try:
+            while (request := await requests_queue.get()) is not None:
+                try:
+                    if not has_user_id and isinstance(request.user_id, str) and request.user_id:
+                        rate_limit_key = f"user/{address}/{request.user_id}"
+                        has_user_id = True
+                    if not await self.__admit_request(websocket, request, rate_limit_key, address):
+                        continue
+                    # Requests are validated before dispatching, ordering key is made of their fields
+                    try:
+                        self.__validate_request(request)
+                    except (InvalidRequestError, IncorrectRequestTypeError) as e:
+                        await self.__reject_invalid_request(websocket, request, e)
+                        continue
+                    await dispatcher.dispatch(
+                        request,
+                        ordering_key=self.__get_ordering_key(request),
+                        exclusive=request.type in self.EXCLUSIVE_REQUEST_TYPES
+                    )
+                finally:
+                    requests_queue.task_done()
+            requests_queue.task_done()
+            # Requests received before connection was closed are still handled
+            await dispatcher.join()
+        finally:
+            del self.__connection_requests[websocket]
+            receive_task.cancel()
+            self.metrics.connections.dec()
+
+    def stop(self):
+        """Starts graceful shutdown of the server which is run by run()"""
+        self.__stop_event.set()
+
+    async def __save_snapshot(self):
+        """Saves users waiting for offline users, it is lost with process memory otherwise"""
+        state = {"pending": []}
+        for user_id, client in self.__clients.items():
+            # Other workers keep state of users connected to them
+            if self.__bus is None or self.__is_local(client.main_websocket):
+                state["pending"].extend([user_id, target_user_id]
+                                        for target_user_id in self.__pending.targets_of(user_id))
+
+        if state["pending"]:
+            await self.__storage.save_snapshot(state)
+        log_event("snapshot_saved", logging.INFO, pending=len(state["pending"]))
+
+    async def __restore_snapshots(self):
+        """Restores state saved by workers which were stopped before"""
+        for state in await self.__storage.load_snapshots():
+            # Snapshots saved before chats were stored durably have them in memory state
+            created_chats = state.get("created_chats", {})
+            for user_id, creator_ids in created_chats.items():
+                for creator_id in creator_ids:
+                    await self.__storage.add_chat_notification(user_id, creator_id)
+            for user_id, target_user_id in state["pending"]:
+                self.__apply_pending(user_id, target_user_id)
+                await self.__publish_state("pending", user_id=user_id, target_user_id=target_user_id)
+            log_event("snapshot_restored", logging.INFO, created_chats=len(created_chats),
+                      pending=len(state["pending"]))
+
+    async def __shutdown(self, websocket_server):
+        """
+        Stops accepting connections and handling new requests, waits for requests which were received before,
+        saves state and closes connections with a hint when to reconnect
+        """
+        log_event("shutdown_started", logging.INFO, worker_id=self.worker_id,
+                  connections=len(websocket_server.connections))
+        websocket_server.close(close_connections=False)
+
+        async def finish_requests(requests_queue: asyncio.Queue, dispatcher: RequestDispatcher):
+            await requests_queue.join()
+            await dispatcher.join()
+
+        # Responses of these requests are sent while connections are still open
+        try:
+            async with asyncio.timeout(self.SHUTDOWN_TIMEOUT):
+                await asyncio.gather(*(finish_requests(requests_queue, dispatcher)
+                                       for requests_queue, dispatcher in self.__connection_requests.values()))
+        except TimeoutError:
+            log_event("shutdown_timeout", logging.WARNING, worker_id=self.worker_id, stage="requests")
+
+        # Users are disconnected when their connections close, that clears state which has to be saved
+        await self.__save_snapshot()
+
+        async def close_connection(websocket):
+            reconnect_request = Request(
+                request_type="reconnect",
+                content={"reason": "server_restart",
+                         "retry_after": round(random.uniform(self.RECONNECT_DELAY_MIN, self.RECONNECT_DELAY_MAX), 3)}
+            )
+            try:
+                await self.__send(websocket, reconnect_request)
+            finally:
+                await websocket.close(CloseCode.SERVICE_RESTART, "server restart")
+
+        await asyncio.gather(
+            *(close_connection(websocket) for websocket in websocket_server.connections),
+            return_exceptions=True
+        )
+        try:
+            async with asyncio.timeout(self.SHUTDOWN_TIMEOUT):
+                await websocket_server.wait_closed()
+        except TimeoutError:
+            log_event("shutdown_timeout", logging.WARNING, worker_id=self.worker_id, stage="connections")
 
     async def run(self):
-        """Runs websocket server"""
-        async with websockets.serve(self.__websocket_handler, self.ip, self.port):
-            print("WebSocket server is running")
-            await asyncio.Future()
+        """Runs websocket server until stop() is called or SIGTERM or SIGINT is received"""
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            # Not supported on Windows or outside of the main thread
+            with contextlib.suppress(NotImplementedError, RuntimeError):
+                loop.add_signal_handler(signal_number, self.stop)
+
+        await self.__storage.open()
+        sweep_task = asyncio.create_task(self.__sweep_idle_users())
+        maintenance_task = asyncio.create_task(self.__maintain_messages())
+        metrics_server = None
+        if self.metrics_port:
+            metrics_server = await serve_metrics(self.metrics.registry, self.METRICS_HOST, self.metrics_port)
+        self.__message_buffer.start()
+        self.__presence.start()
+        self.__loop_lag_monitor.start()
+
+        heartbeat_task = None
+        if self.__bus is not None:
+            await self.__bus.start(self.worker_id, self.__handle_bus_message)
+            await self.__publish_state("worker_started")
+            heartbeat_task = asyncio.create_task(self.__send_heartbeats())
+        await self.__restore_snapshots()
+
+        try:
+            async with websockets.serve(
+                self.__websocket_handler,
+                self.ip,
+                self.port,
+                select_subprotocol=select_subprotocol,
+                reuse_port=self.reuse_port,
+                ping_interval=self.WEBSOCKET_PING_INTERVAL or None,
+                ping_timeout=self.WEBSOCKET_PING_TIMEOUT or None,
+                close_timeout=self.WEBSOCKET_CLOSE_TIMEOUT,
+                write_limit=self.WEBSOCKET_WRITE_LIMIT,
+                max_size=self.WEBSOCKET_MAX_SIZE or None,
+                compression=None, # Replaced by extension which skips small messages
+                extensions=compression_extensions(
+                    self.WEBSOCKET_COMPRESSION,
+                    self.WEBSOCKET_COMPRESSION_THRESHOLD,
+                    self.WEBSOCKET_COMPRESSION_LEVEL,
+                    self.WEBSOCKET_COMPRESSION_WINDOW_BITS,
+                    self.metrics
+                )
+            ) as websocket_server:
+                log_event("server_started", logging.INFO, worker_id=self.worker_id, port=self.port)
+                await self.__stop_event.wait()
+                await self.__shutdown(websocket_server)
+        finally:
+            sweep_task.cancel()
+            maintenance_task.cancel()
+            if metrics_server is not None:
+                metrics_server.close()
+            if self.__bus is not None:
+                heartbeat_task.cancel()
+                await self.__publish_state("worker_stopped")
+                await self.__bus.close()
+            self.__loop_lag_monitor.close()
+            await self.__presence.close()
+            await self.__message_buffer.close()
+            await self.__storage.close()
+            self.__password_hasher.close()
+            if self.__capture is not None:
+                self.__capture.close()
+            for signal_number in (signal.SIGTERM, signal.SIGINT):
+                with contextlib.suppress(NotImplementedError, RuntimeError):
+                    loop.remove_signal_handler(signal_number)
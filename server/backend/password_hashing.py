@@ -0,0 +1,84 @@
+"""server side hashing of passwords, hashes are computed in worker threads off the event loop"""
+import os
+import time
+import hmac
+import base64
+import hashlib
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import ServerMetrics
+
+
+SCRYPT_PREFIX = "scrypt"
+# Work factors of new hashes, stored hashes keep the ones they were made with
+SCRYPT_N = int(os.getenv("SCRYPT_N", str(2 ** 14)))
+SCRYPT_R = int(os.getenv("SCRYPT_R", "8"))
+SCRYPT_P = int(os.getenv("SCRYPT_P", "1"))
+SCRYPT_SALT_SIZE = 16
+SCRYPT_KEY_SIZE = 32
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p,
+        maxmem=2 * 128 * n * r * p, dklen=SCRYPT_KEY_SIZE
+    )
+
+
+def hash_password(password: str) -> str:
+    """Returns scrypt hash of the password in the form scrypt$n$r$p$salt$hash"""
+    salt = os.urandom(SCRYPT_SALT_SIZE)
+    key = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return "$".join((
+        SCRYPT_PREFIX, str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P),
+        base64.b64encode(salt).decode(), base64.b64encode(key).decode()
+    ))
+
+
+def is_legacy_hash(stored_password: str) -> bool:
+    """Users registered before server side hashing have SHA-256 from the client stored as is"""
+    return not stored_password.startswith(SCRYPT_PREFIX + "$")
+
+
+def verify_password(password: str, stored_password: str) -> bool:
+    """Checks password against stored scrypt hash or legacy SHA-256 string"""
+    if is_legacy_hash(stored_password):
+        return hmac.compare_digest(password.encode(), stored_password.encode())
+
+    _, n, r, p, salt, key = stored_password.split("$")
+    computed_key = _scrypt(password, base64.b64decode(salt), int(n), int(r), int(p))
+    return hmac.compare_digest(computed_key, base64.b64decode(key))
+
+
+class PasswordHasher:
+    """
+    Runs password hashing in a pool of threads, hashlib releases GIL while scrypt is computed
+    At most max_workers hashes run at a time, others wait in the queue
+    """
+    def __init__(self, max_workers: int, metrics: ServerMetrics | None = None):
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hash")
+        self.__semaphore = asyncio.Semaphore(max_workers)
+        self.__metrics = metrics
+
+    async def __run(self, operation: str, function, *args):
+        queued_at = time.perf_counter()
+        async with self.__semaphore:
+            started_at = time.perf_counter()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self.__executor, function, *args)
+            finally:
+                if self.__metrics is not None:
+                    self.__metrics.password_hash_queue_duration.observe(started_at - queued_at)
+                    self.__metrics.password_hash_duration.observe(
+                        time.perf_counter() - started_at, operation=operation
+                    )
+
+    async def hash(self, password: str) -> str:
+        return await self.__run("hash", hash_password, password)
+
+    async def verify(self, password: str, stored_password: str) -> bool:
+        return await self.__run("verify", verify_password, password, stored_password)
+
+    def close(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
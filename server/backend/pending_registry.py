@@ -0,0 +1,87 @@
+"""users waiting for other users to come online to connect with them"""
+import time
+from collections import OrderedDict
+
+from metrics import ServerMetrics
+
+
+_EMPTY_SET = frozenset()
+
+
+class PendingRegistry:
+    """
+    Index of waits in both directions, every operation on one wait is O(1)
+    Wait expires ttl seconds after it was added, expired waits are removed by expire()
+    """
+    def __init__(self, ttl: float, metrics: ServerMetrics | None = None):
+        self.__ttl = ttl
+        self.__metrics = metrics
+        # (waiter_id, target_id): expires at, ordered by expiration since all waits have the same ttl
+        self.__waits: OrderedDict[tuple[str, str], float] = OrderedDict()
+        self.__targets: dict[str, set[str]] = {} # waiter_id: ids of users he is waiting for
+        self.__waiters: dict[str, set[str]] = {} # target_id: ids of users waiting for him
+
+    def __len__(self) -> int:
+        return len(self.__waits)
+
+    def __discard(self, waiter_id: str, target_id: str) -> bool:
+        if self.__waits.pop((waiter_id, target_id), None) is None:
+            return False
+        for index, key, value in ((self.__targets, waiter_id, target_id), (self.__waiters, target_id, waiter_id)):
+            user_ids = index[key]
+            user_ids.discard(value)
+            if not user_ids:
+                del index[key]
+        return True
+
+    def add(self, waiter_id: str, target_id: str):
+        """Waiter starts waiting for target, wait which already exists is renewed"""
+        self.__waits[(waiter_id, target_id)] = time.monotonic() + self.__ttl
+        self.__waits.move_to_end((waiter_id, target_id))
+        self.__targets.setdefault(waiter_id, set()).add(target_id)
+        self.__waiters.setdefault(target_id, set()).add(waiter_id)
+
+    def match(self, waiter_id: str, target_id: str) -> bool:
+        """Removes wait when target came to waiter, returns if waiter was waiting for him"""
+        expires_at = self.__waits.get((waiter_id, target_id))
+        if expires_at is None:
+            return False
+        self.__discard(waiter_id, target_id)
+        if expires_at < time.monotonic():
+            self.__count("expired")
+            return False
+        self.__count("matched")
+        return True
+
+    def remove(self, waiter_id: str, target_id: str):
+        self.__discard(waiter_id, target_id)
+
+    def remove_waiter(self, waiter_id: str):
+        """Removes all waits of the user, e.g. when he disconnects"""
+        for target_id in list(self.__targets.get(waiter_id, ())):
+            self.__discard(waiter_id, target_id)
+
+    def targets_of(self, waiter_id: str) -> frozenset[str] | set[str]:
+        return self.__targets.get(waiter_id, _EMPTY_SET)
+
+    def involves(self, user_id: str) -> bool:
+        """Checks if user waits for someone or someone waits for him"""
+        return user_id in self.__targets or user_id in self.__waiters
+
+    def expire(self) -> list[tuple[str, str]]:
+        """Removes waits which expired, returns them as (waiter_id, target_id)"""
+        now = time.monotonic()
+        expired = []
+        while self.__waits:
+            (waiter_id, target_id), expires_at = next(iter(self.__waits.items()))
+            if expires_at >= now:
+                break
+            self.__discard(waiter_id, target_id)
+            expired.append((waiter_id, target_id))
+        if expired:
+            self.__count("expired", len(expired))
+        return expired
+
+    def __count(self, result: str, amount: int = 1):
+        if self.__metrics is not None:
+            self.__metrics.pending_connections.inc(amount, result=result)
@@ -0,0 +1,107 @@
+"""subscriptions to online status of users and batched fan-out of its changes"""
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from server_logging import log_event
+
+
+# send_updates({subscriber_id: {user_id: is_online}})
+SendUpdates = Callable[[dict[str, dict[str, bool]]], Awaitable[None]]
+
+
+class PresenceFanout:
+    """
+    Keeps which users are subscribed to online status of which users
+    Status changes are collected and sent once per interval, every subscriber gets one update
+    with all changes since the previous one, user which went offline and back within interval is not reported
+    """
+    def __init__(self, send_updates: SendUpdates, interval: float, max_subscriptions: int):
+        self.__send_updates = send_updates
+        self.__interval = interval
+        self.__max_subscriptions = max_subscriptions
+
+        self.__subscribers: dict[str, set[str]] = {} # user_id: ids of users subscribed to them
+        self.__subscriptions: dict[str, set[str]] = {} # subscriber_id: ids of users they are subscribed to
+        self.__changes: dict[str, tuple[bool, bool]] = {} # user_id: (status before interval, current status)
+        self.__changed = asyncio.Event()
+        self.__fanout_task: asyncio.Task | None = None
+
+    @property
+    def subscriptions_count(self) -> int:
+        return sum(len(user_ids) for user_ids in self.__subscriptions.values())
+
+    def start(self):
+        """Starts background task which sends updates"""
+        self.__fanout_task = asyncio.create_task(self.__run())
+
+    async def close(self):
+        if self.__fanout_task is not None:
+            self.__fanout_task.cancel()
+            try:
+                await self.__fanout_task
+            except asyncio.CancelledError:
+                pass
+            self.__fanout_task = None
+
+    def subscribe(self, subscriber_id: str, user_ids: list[str]) -> list[str]:
+        """Subscribes to status of users, returns ids which were subscribed within the limit"""
+        subscriptions = self.__subscriptions.setdefault(subscriber_id, set())
+        subscribed_user_ids = []
+        for user_id in user_ids:
+            if user_id not in subscriptions and len(subscriptions) >= self.__max_subscriptions:
+                break
+            subscriptions.add(user_id)
+            self.__subscribers.setdefault(user_id, set()).add(subscriber_id)
+            subscribed_user_ids.append(user_id)
+        if not subscriptions:
+            del self.__subscriptions[subscriber_id]
+        return subscribed_user_ids
+
+    def unsubscribe(self, subscriber_id: str, user_ids: list[str] | None = None):
+        """Unsubscribes from status of given users, from all of them if user_ids is None"""
+        subscriptions = self.__subscriptions.get(subscriber_id)
+        if subscriptions is None:
+            return
+        for user_id in list(subscriptions) if user_ids is None else user_ids:
+            subscriptions.discard(user_id)
+            subscribers = self.__subscribers.get(user_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber_id)
+                if not subscribers:
+                    del self.__subscribers[user_id]
+        if not subscriptions:
+            del self.__subscriptions[subscriber_id]
+
+    def status_changed(self, user_id: str, is_online: bool):
+        """Records change of user status, it is sent to subscribers with the next update"""
+        if user_id not in self.__subscribers:
+            return
+        previous_status = self.__changes[user_id][0] if user_id in self.__changes else not is_online
+        self.__changes[user_id] = (previous_status, is_online)
+        self.__changed.set()
+
+    def __collect_updates(self) -> dict[str, dict[str, bool]]:
+        changes, self.__changes = self.__changes, {}
+        updates: dict[str, dict[str, bool]] = {}
+        for user_id, (previous_status, is_online) in changes.items():
+            if previous_status == is_online:
+                continue
+            for subscriber_id in self.__subscribers.get(user_id, ()):
+                updates.setdefault(subscriber_id, {})[user_id] = is_online
+        return updates
+
+    async def __run(self):
+        while True:
+            await self.__changed.wait()
+            # Changes made during the interval are sent together
+            await asyncio.sleep(self.__interval)
+            self.__changed.clear()
+
+            updates = self.__collect_updates()
+            if not updates:
+                continue
+            try:
+                await self.__send_updates(updates)
+            except Exception as e:
+                log_event("presence_updates_failed", logging.ERROR, subscribers=len(updates), error=str(e))
@@ -0,0 +1,91 @@
+"""per-user token bucket limits of requests"""
+import time
+
+
+def parse_rate_limit(limit: str) -> tuple[float, float] | None:
+    """Parses limit in the form "rate/burst", empty string means no limit"""
+    if not limit.strip():
+        return None
+    rate, burst = limit.split("/")
+    return float(rate), float(burst)
+
+
+def parse_rate_limits(spec: str) -> dict[str, tuple[float, float]]:
+    """
+    Parses limits in the form "request_type=rate/burst,..." where rate is requests per second
+    and burst is number of requests which can be sent at once
+    """
+    limits = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        request_type, limit = item.split("=")
+        limits[request_type.strip()] = parse_rate_limit(limit)
+    return limits
+
+
+class TokenBucket:
+    """Bucket which is refilled with rate tokens per second up to burst tokens"""
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self, now: float) -> bool:
+        """Takes one token if there is one"""
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self) -> float:
+        """Seconds until the next token is available"""
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+
+class RateLimiter:
+    """
+    Token bucket for every user and request type
+    Request types without own limit share default limit, None default means they are not limited
+    """
+    def __init__(self, limits: dict[str, tuple[float, float]], default_limit: tuple[float, float] | None):
+        self.__limits = limits
+        self.__default_limit = default_limit
+        self.__buckets: dict[tuple[str, str], TokenBucket] = {} # (user key, request type): bucket
+
+    def __len__(self) -> int:
+        return len(self.__buckets)
+
+    def allow(self, user_key: str, request_type: str) -> float | None:
+        """Returns None if request is allowed, otherwise seconds after which it can be retried"""
+        limit = self.__limits.get(request_type, self.__default_limit)
+        if limit is None:
+            return None
+        if request_type not in self.__limits:
+            request_type = "*" # Types under default limit share one bucket
+
+        now = time.monotonic()
+        key = (user_key, request_type)
+        bucket = self.__buckets.get(key)
+        if bucket is None:
+            bucket = self.__buckets[key] = TokenBucket(*limit, now)
+        if bucket.take(now):
+            return None
+        return bucket.retry_after()
+
+    def prune(self):
+        """Removes buckets which are full again, they are the same as new ones"""
+        now = time.monotonic()
+        for key, bucket in list(self.__buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.__buckets[key]
@@ -2,30 +2,57 @@
 import json
 
 
+def encode_payload(value):
+    """JSON default function for pass-through payloads which are kept as bytes"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).decode()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class MalformedRequestError(ValueError):
+    """Exception which is raised when decoded frame does not have shape of request"""
+
+
 class Request:
     """Class to represent request to the server or from it"""
+    __slots__ = ("type", "user_id", "content")
+
     def __init__(self, request_type: str, user_id: str=None, content: dict=None):
         self.type: str = request_type
         self.user_id: str = user_id # id of user who had sent request, if server had sent should be None
         self.content: dict = content if content is not None else {}
 
-    @property
-    def json_string(self) -> str:
-        """Converts request object to json string"""
-        return json.dumps(
-            {"type": self.type, "user_id": self.user_id, "content": self.content}
-            )
+    def to_dict(self) -> dict:
+        """Converts request object to dict which is encoded into frame"""
+        return {"type": self.type, "user_id": self.user_id, "content": self.content}
 
     @classmethod
-    def from_string(cls, json_string: str) -> 'Request':
-        """Creates request object from json string"""
-        data = json.loads(json_string)
+    def from_dict(cls, data: dict) -> 'Request':
+        """Creates request object from decoded frame, raises MalformedRequestError if it is not request"""
+        if not isinstance(data, dict):
+            raise MalformedRequestError(f"Request has to be object, not {type(data).__name__}")
+        if not isinstance(data.get("type"), str):
+            raise MalformedRequestError("Request type has to be string")
+        if "user_id" not in data or not isinstance(data["user_id"], (str, type(None))):
+            raise MalformedRequestError("User id has to be string or null")
+        if not isinstance(data.get("content"), dict):
+            raise MalformedRequestError("Request content has to be object")
         return Request(
             request_type=data["type"],
             user_id=data["user_id"],
             content=data["content"]
         )
 
+    @property
+    def json_string(self) -> str:
+        """Converts request object to json string"""
+        return json.dumps(self.to_dict(), default=encode_payload)
+
+    @classmethod
+    def from_string(cls, json_string: str) -> 'Request':
+        """Creates request object from json string"""
+        return cls.from_dict(json.loads(json_string))
+
     def __str__(self) -> str:
         """Returns string representation of the request"""
         return self.json_string
@@ -0,0 +1,56 @@
+"""dispatcher which runs requests received by one connection concurrently"""
+import asyncio
+from typing import Awaitable, Callable, Hashable
+
+from request import Request
+
+
+class RequestDispatcher:
+    """
+    Runs requests of one connection concurrently, at most max_concurrent at a time
+    Requests with the same ordering key are run one after another in the order they were dispatched
+    Exclusive requests wait for all running requests and block dispatching of the following ones
+    """
+    def __init__(self, handle: Callable[[Request], Awaitable[None]], max_concurrent: int):
+        self.__handle = handle
+        self.__semaphore = asyncio.Semaphore(max_concurrent)
+        self.__tasks: set[asyncio.Task] = set()
+        self.__last_tasks: dict[Hashable, asyncio.Task] = {} # ordering key: last dispatched task with it
+
+    async def dispatch(self, request: Request, ordering_key: Hashable | None = None, exclusive: bool = False):
+        """
+        Starts handling of the request
+        Waits until number of running requests is below the limit, so caller stops reading new ones
+        """
+        if exclusive:
+            await self.join()
+            await self.__handle(request)
+            return
+
+        await self.__semaphore.acquire()
+        previous_task = self.__last_tasks.get(ordering_key) if ordering_key is not None else None
+        task = asyncio.create_task(self.__run(request, previous_task))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+        if ordering_key is not None:
+            self.__last_tasks[ordering_key] = task
+            task.add_done_callback(lambda done_task: self.__forget_task(ordering_key, done_task))
+
+    async def join(self):
+        """Waits until all dispatched requests are handled"""
+        while self.__tasks:
+            await asyncio.wait(set(self.__tasks))
+
+    async def __run(self, request: Request, previous_task: asyncio.Task | None):
+        try:
+            if previous_task is not None:
+                # Result of the previous request does not matter, only its completion
+                await asyncio.wait({previous_task})
+            await self.__handle(request)
+        finally:
+            self.__semaphore.release()
+
+    def __forget_task(self, ordering_key: Hashable, task: asyncio.Task):
+        if self.__last_tasks.get(ordering_key) is task:
+            del self.__last_tasks[ordering_key]
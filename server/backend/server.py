@@ -1,11 +1,43 @@
 """Server for handling p2p connection signaling process"""
-import asyncio
+import os
+import signal
+import multiprocessing
+import loop_monitor
 from objects_server import Server
+from server_logging import setup_logging
 
 SERVER_IP = "0.0.0.0"
 SERVER_PORT = 9000
+# Number of worker processes, more than one requires BUS_BACKEND=postgres
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+# Event loop backend, asyncio or uvloop, uvloop falls back to asyncio if it is not installed
+SERVER_EVENT_LOOP = os.getenv("SERVER_EVENT_LOOP", "asyncio")
+
+
+def run_worker(worker_index: int = 0):
+    """Runs one server worker in the current process"""
+    setup_logging(worker_index if SERVER_WORKERS > 1 else None)
+    server = Server(SERVER_IP, SERVER_PORT, reuse_port=SERVER_WORKERS > 1)
+    if server.metrics_port:
+        # Every worker exposes its own metrics
+        server.metrics_port += worker_index
+    loop_monitor.run(server.run(), SERVER_EVENT_LOOP)
 
 
 if __name__ == "__main__":
-    server = Server(SERVER_IP, SERVER_PORT)
-    asyncio.run(server.run())
+    if SERVER_WORKERS > 1 and Server.BUS_BACKEND == "none":
+        raise SystemExit("SERVER_WORKERS > 1 requires BUS_BACKEND=postgres to share state between workers.")
+    if SERVER_WORKERS > 1 and Server.STORAGE_BACKEND == "memory":
+        raise SystemExit("SERVER_WORKERS > 1 requires STORAGE_BACKEND=postgres or sqlite, memory storage is not shared.")
+
+    if SERVER_WORKERS > 1:
+        workers = [multiprocessing.Process(target=run_worker, args=(worker_index,))
+                   for worker_index in range(SERVER_WORKERS)]
+        for worker in workers:
+            worker.start()
+        # Workers shut down gracefully on SIGTERM, it is sent to this process on deploy
+        signal.signal(signal.SIGTERM, lambda signal_number, frame: [worker.terminate() for worker in workers])
+        for worker in workers:
+            worker.join()
+    else:
+        run_worker()
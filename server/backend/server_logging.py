@@ -0,0 +1,130 @@
+"""non-blocking structured logging for the server"""
+import os
+import sys
+import json
+import atexit
+import logging
+import logging.handlers
+import queue
+from datetime import datetime, timezone
+
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FOLDER_PATH = os.getenv("LOG_FOLDER_PATH", "./logs")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_TO_STDOUT = os.getenv("LOG_TO_STDOUT", "1") == "1"
+# Only every LOG_SAMPLE_EVERY-th record of high-frequency events is written
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "100"))
+# Number of characters of offers, answers, messages and keys which are written
+LOG_PAYLOAD_LIMIT = int(os.getenv("LOG_PAYLOAD_LIMIT", "32"))
+
+REDACTED_FIELDS = frozenset({"password", "email"})
+PAYLOAD_FIELDS = frozenset({"offer", "answer", "message", "public_key", "long_term_public_key", "frame"})
+
+logger = logging.getLogger("messenger")
+
+
+def log_event(event: str, level: int = logging.DEBUG, sampled: bool = False, **fields):
+    """
+    Logs event with structured fields, formatting and writing happen in the background thread
+    Sampled events are high-frequency ones of which only part is written
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={"fields": fields, "sampled": sampled})
+
+
+def truncate_payload(value) -> str:
+    """Returns beginning of the payload and its size"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = bytes(value[:LOG_PAYLOAD_LIMIT]).decode(errors="replace") + f"...({len(value)} bytes)"
+        return value
+    value = str(value)
+    if len(value) <= LOG_PAYLOAD_LIMIT:
+        return value
+    return f"{value[:LOG_PAYLOAD_LIMIT]}...({len(value)} chars)"
+
+
+def _clean_field(name: str, value):
+    if name in REDACTED_FIELDS:
+        return "<redacted>"
+    if name in PAYLOAD_FIELDS and value is not None:
+        return truncate_payload(value)
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats record as one JSON line, payload fields are truncated and secrets redacted"""
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "event": record.getMessage(),
+        }
+        for name, value in getattr(record, "fields", {}).items():
+            line[name] = _clean_field(name, value)
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        return json.dumps(line, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """Passes every sample_every-th record of each sampled event and all other records"""
+    def __init__(self, sample_every: int):
+        super().__init__()
+        self.__sample_every = max(sample_every, 1)
+        self.__counts: dict[str, int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sampled", False):
+            return True
+        count = self.__counts.get(record.msg, 0)
+        self.__counts[record.msg] = count + 1
+        if count % self.__sample_every:
+            return False
+        record.fields = {**record.fields, "sample_rate": self.__sample_every}
+        return True
+
+
+class _BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler which leaves formatting to the listener thread"""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(worker_index: int | None = None) -> logging.handlers.QueueListener:
+    """
+    Sets up logging for the application
+    Records are put to the queue on the event loop and written to rotating log file by the listener thread
+    Every worker process writes its own file, processes rotating the same file would lose records
+    """
+    os.makedirs(LOG_FOLDER_PATH, exist_ok=True)
+
+    formatter = StructuredFormatter()
+    file_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(LOG_FOLDER_PATH, "server.log" if worker_index is None else f"server-{worker_index}.log"),
+        maxBytes=LOG_MAX_BYTES,
+        backupCount=LOG_BACKUP_COUNT,
+        encoding="utf-8"
+    )
+    file_handler.setFormatter(formatter)
+    handlers = [file_handler]
+    if LOG_TO_STDOUT:
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(formatter)
+        handlers.append(stream_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _BackgroundQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_EVERY))
+
+    root_logger = logging.getLogger()
+    root_logger.handlers = [queue_handler]
+    root_logger.setLevel(LOG_LEVEL)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,981 @@
+"""storages which keep messages for offline users, public keys and users"""
+import os
+import re
+import json
+import logging
+import sqlite3
+import asyncio
+import contextlib
+import itertools
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Iterable
+
+import asyncpg
+
+from message_buffer import StoredMessage
+from metrics import ServerMetrics
+from server_logging import log_event
+
+
+# send_chunk(messages, cursor, has_more), chunk is removed from the storage only if it succeeds
+# Chunk has at most chunk_size messages and max_bytes bytes of them, but at least one message
+SendChunk = Callable[[list[str], int, bool], Awaitable[None]]
+
+# Stored messages which were not delivered within retention are removed
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", "30"))
+# Messages to user who already has this many stored are dropped, 0 disables the quota
+MESSAGE_QUOTA_PER_RECIPIENT = int(os.getenv("MESSAGE_QUOTA_PER_RECIPIENT", "10000"))
+# Chat notifications which recipient did not acknowledge within retention are removed
+CHAT_NOTIFICATION_RETENTION_DAYS = int(os.getenv("CHAT_NOTIFICATION_RETENTION_DAYS", "30"))
+
+
+class DatabaseUnavailableError(Exception):
+    """Exception which is raised when database can not be reached or query to it fails"""
+
+
+class Storage(ABC):
+    """
+    Base class for storages of the server, engines are picked by create_storage()
+    Operations take and return batches where the server has several items at once,
+    engines should do each batch in one round trip or transaction
+    Failures of the engine are raised as DatabaseUnavailableError
+    """
+    @property
+    def pending_operations(self) -> int:
+        """Number of operations which wait for the engine or run, the server sheds load when it grows"""
+        return 0
+
+    @abstractmethod
+    async def open(self):
+        """Prepares the engine, e.g. connects and creates schema"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def close(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save_messages(self, messages: list[StoredMessage]) -> None:
+        """Saves batch of (user_id, target_user_id, message) for offline recipients"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def maintain(self) -> None:
+        """
+        Removes messages older than MESSAGE_RETENTION_DAYS and chat notifications older than
+        CHAT_NOTIFICATION_RETENTION_DAYS, runs periodically
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def drain_messages(self, user_id: str, target_user_id: str, chunk_size: int, max_bytes: int,
+                             send_chunk: SendChunk) -> None:
+        """Passes messages from target user to specified user to send_chunk and removes the ones it sent"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save_key(self, user_id: str, public_key: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_key(self, user_id: str) -> str | None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_keys(self, user_ids: list[str]) -> dict[str, str | None]:
+        """Gets public keys of several users at once, None for users without key"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save_snapshot(self, state: dict) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def load_snapshots(self) -> list[dict]:
+        """Removes saved states and returns them in the order they were saved"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add_chat_notification(self, recipient_id: str, creator_id: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_chat_notifications(self, recipient_id: str, cursor: int, limit: int) -> list[tuple[int, str]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def ack_chat_notifications(self, recipient_id: str, cursor: int) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add_user(self, user_id: str, email: str, password: str) -> bool:
+        """Returns False if user with the same id or email already exists"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_user(self, email: str) -> dict | None:
+        """Returns user_id, email and stored password hash of the user with given email"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update_password(self, user_id: str, password: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def user_exists(self, user_id: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def users_exist(self, user_ids: list[str]) -> dict[str, bool]:
+        """Checks which of several users are registered at once"""
+        raise NotImplementedError
+
+
+class PostgresStorage(Storage):
+    """Storage in Postgres database, all queries share one connection pool"""
+    # Connection pool settings
+    DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+    DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+    DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100")) # Prepared statements per connection
+    DB_MAX_INACTIVE_CONNECTION_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_CONNECTION_LIFETIME", "300"))
+    DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "5"))
+    DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "10"))
+    DB_HEALTH_CHECK_INTERVAL = float(os.getenv("DB_HEALTH_CHECK_INTERVAL", "30"))
+
+    MIGRATIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+    # Messages table is partitioned by day, partitions are created this many days ahead
+    MESSAGE_PARTITIONS_AHEAD = int(os.getenv("MESSAGE_PARTITIONS_AHEAD", "3"))
+    MESSAGE_PARTITION_NAME = re.compile(r"^messages_p(\d{8})$")
+
+    def __init__(self, database_url: str, metrics: ServerMetrics | None = None):
+        self.__database_url = database_url
+        self.__metrics = metrics
+        self.__pool: asyncpg.Pool | None = None
+        self.__health_check_task: asyncio.Task | None = None
+        self.__pending_operations = 0
+
+    @property
+    def pending_operations(self) -> int:
+        """Number of queries which wait for connection or run"""
+        return self.__pending_operations
+
+    async def open(self):
+        """Creates connection pool, applies migrations and starts health checks"""
+        self.__pool = await asyncpg.create_pool(
+            self.__database_url,
+            min_size=self.DB_POOL_MIN_SIZE,
+            max_size=self.DB_POOL_MAX_SIZE,
+            statement_cache_size=self.DB_STATEMENT_CACHE_SIZE,
+            max_inactive_connection_lifetime=self.DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+            command_timeout=self.DB_COMMAND_TIMEOUT
+        )
+        await self.__apply_migrations()
+        self.__health_check_task = asyncio.create_task(self.__check_database_health())
+
+    async def close(self):
+        if self.__health_check_task is not None:
+            self.__health_check_task.cancel()
+        if self.__pool is not None:
+            await self.__pool.close()
+            self.__pool = None
+
+    @contextlib.asynccontextmanager
+    async def __acquire_connection(self, query: str):
+        """
+        Acquires connection from the pool and releases it on exit
+        Connection and query failures are raised as DatabaseUnavailableError
+        Time spent in the block is reported under the query name
+        """
+        if self.__pool is None:
+            raise DatabaseUnavailableError("Database pool is not initialized.")
+
+        start = time.perf_counter()
+        self.__pending_operations += 1
+        try:
+            async with self.__pool.acquire(timeout=self.DB_ACQUIRE_TIMEOUT) as conn:
+                if self.__metrics is not None:
+                    self.__metrics.db_pool_acquire_duration.observe(time.perf_counter() - start)
+                yield conn
+        except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError) as e:
+            raise DatabaseUnavailableError(f"{type(e).__name__}: {e}") from e
+        finally:
+            self.__pending_operations -= 1
+            if self.__metrics is not None:
+                self.__metrics.db_query_duration.observe(time.perf_counter() - start, query=query)
+
+    async def __apply_migrations(self):
+        """Applies sql files from MIGRATIONS_PATH which were not applied yet, in name order"""
+        async with self.__acquire_connection("apply_migrations") as conn:
+            async with conn.transaction():
+                # Several server processes may start at the same time
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'));")
+                await conn.execute("""--sql
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        name VARCHAR(100) PRIMARY KEY,
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    );
+                """)
+                applied = {row["name"] for row in await conn.fetch("SELECT name FROM schema_migrations;")}
+
+                for name in sorted(os.listdir(self.MIGRATIONS_PATH)):
+                    if not name.endswith(".sql") or name in applied:
+                        continue
+                    with open(os.path.join(self.MIGRATIONS_PATH, name), encoding="utf-8") as file:
+                        await conn.execute(file.read())
+                    await conn.execute("INSERT INTO schema_migrations (name) VALUES ($1);", name)
+                    log_event("migration_applied", logging.INFO, name=name)
+
+    async def __check_database_health(self):
+        """Periodically checks that database is reachable, expires pooled connections if it is not"""
+        while True:
+            await asyncio.sleep(self.DB_HEALTH_CHECK_INTERVAL)
+            try:
+                async with self.__acquire_connection("health_check") as conn:
+                    await conn.fetchval("SELECT 1;")
+            except DatabaseUnavailableError as e:
+                log_event("database_health_check_failed", logging.ERROR, error=str(e))
+                # Connections will be reopened on the next acquire
+                await self.__pool.expire_connections()
+
+    async def save_messages(self, messages: list[StoredMessage]) -> None:
+        """
+        Saves batch of (user_id, target_user_id, message) rows to the database
+        Messages to recipients who reached MESSAGE_QUOTA_PER_RECIPIENT are dropped
+        """
+        async with self.__acquire_connection("save_messages") as conn:
+            if MESSAGE_QUOTA_PER_RECIPIENT:
+                rows = await conn.fetch("""--sql
+                    SELECT target_user_id, COUNT(*) AS count FROM messages
+                    WHERE target_user_id = ANY($1::varchar[])
+                    GROUP BY target_user_id;
+                """, list({target_user_id for _, target_user_id, _ in messages}))
+                stored_counts = {row["target_user_id"]: row["count"] for row in rows}
+                messages = _apply_quota(messages, stored_counts, self.__metrics)
+
+            if messages:
+                await conn.copy_records_to_table(
+                    "messages",
+                    records=messages,
+                    columns=("user_id", "target_user_id", "message")
+                )
+
+    async def maintain(self) -> None:
+        """
+        Creates partitions of messages table for the next days and drops partitions older than retention,
+        expired rows which are not in daily partitions and expired chat notifications are deleted
+        """
+        async with self.__acquire_connection("maintain_messages") as conn:
+            async with conn.transaction():
+                # Several server processes run maintenance
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext('messages_maintenance'));")
+                today = await conn.fetchval("SELECT LOCALTIMESTAMP::date;")
+
+                for days in range(self.MESSAGE_PARTITIONS_AHEAD + 1):
+                    await self.__create_message_partition(conn, today + timedelta(days=days))
+
+                expired_before = today - timedelta(days=MESSAGE_RETENTION_DAYS)
+                partitions = await conn.fetch("""--sql
+                    SELECT child.relname AS name FROM pg_inherits
+                    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                    WHERE pg_inherits.inhparent = 'messages'::regclass;
+                """)
+                for partition in partitions:
+                    match = self.MESSAGE_PARTITION_NAME.match(partition["name"])
+                    if match and datetime.strptime(match.group(1), "%Y%m%d").date() < expired_before:
+                        await conn.execute(f"DROP TABLE {partition['name']};")
+                        log_event("message_partition_dropped", logging.INFO, partition=partition["name"])
+
+                deleted = await conn.execute(
+                    "DELETE FROM messages_default WHERE timestamp < $1::date;", expired_before
+                )
+                expired_notifications = await conn.execute(
+                    "DELETE FROM chat_notifications WHERE created_at < $1::date;",
+                    today - timedelta(days=CHAT_NOTIFICATION_RETENTION_DAYS)
+                )
+                log_event("messages_maintained", logging.INFO, expired_default_rows=deleted,
+                          expired_chat_notifications=expired_notifications)
+
+    async def __create_message_partition(self, conn: asyncpg.Connection, day: date):
+        name = f"messages_p{day:%Y%m%d}"
+        try:
+            async with conn.transaction(): # Savepoint, failure does not abort maintenance
+                await conn.execute(f"""--sql
+                    CREATE TABLE IF NOT EXISTS {name} PARTITION OF messages
+                    FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}');
+                """)
+        except asyncpg.CheckViolationError:
+            # Rows of this day are already in default partition, they stay there until they expire
+            log_event("message_partition_skipped", logging.WARNING, partition=name)
+
+    async def drain_messages(self, user_id: str, target_user_id: str, chunk_size: int, max_bytes: int,
+                             send_chunk: SendChunk) -> None:
+        """
+        Removes messages from target user to specified user from the database in chunks ordered by id
+        Each chunk is deleted and passed to send_chunk(messages, cursor, has_more), if it fails the chunk is
+        inserted back with the same ids, cursor is the id of the last message in the chunk
+        Connection is released before sending, so slow clients do not hold connections of the pool and row locks
+        """
+        cursor = 0
+        has_more = True
+        while has_more:
+            async with self.__acquire_connection("drain_messages") as conn:
+                # Candidates are cut where their total size reaches max_bytes, the first one is always taken
+                rows = await conn.fetch("""--sql
+                    WITH candidates AS (
+                        SELECT id, message FROM messages
+                        WHERE user_id = $1 AND target_user_id = $2 AND id > $3
+                        ORDER BY id
+                        LIMIT $4
+                        FOR UPDATE SKIP LOCKED
+                    ), chunk AS (
+                        SELECT id, ROW_NUMBER() OVER (ORDER BY id) AS position,
+                            SUM(octet_length(message)) OVER (ORDER BY id) AS total_bytes
+                        FROM candidates
+                    ), deleted AS (
+                        -- Messages have no index on id alone, sender and recipient let
+                        -- the delete use the recipient index in every partition
+                        DELETE FROM messages
+                        WHERE user_id = $1 AND target_user_id = $2
+                            AND id IN (SELECT id FROM chunk WHERE position = 1 OR total_bytes <= $5)
+                        RETURNING id, message, timestamp
+                    )
+                    SELECT id, message, timestamp, (SELECT COUNT(*) FROM candidates) AS candidates_count
+                    FROM deleted
+                    ORDER BY id;
+                """, target_user_id, user_id, cursor, chunk_size, max_bytes)
+
+            if rows:
+                cursor = rows[-1]["id"]
+            has_more = len(rows) == chunk_size or bool(rows) and len(rows) < rows[0]["candidates_count"]
+
+            try:
+                await send_chunk([row["message"] for row in rows], cursor, has_more)
+            except BaseException:
+                if rows:
+                    await self.__restore_messages(user_id, target_user_id, rows)
+                raise
+
+    async def __restore_messages(self, user_id: str, target_user_id: str, rows: list[asyncpg.Record]):
+        """Inserts back drained messages which were not sent, they keep their ids and order"""
+        async with self.__acquire_connection("restore_messages") as conn:
+            await conn.copy_records_to_table(
+                "messages",
+                records=[(row["id"], target_user_id, user_id, row["message"], row["timestamp"]) for row in rows],
+                columns=("id", "user_id", "target_user_id", "message", "timestamp")
+            )
+
+    async def save_key(self, user_id: str, public_key: str) -> None:
+        """Saves public key to the database"""
+        async with self.__acquire_connection("save_key") as conn:
+            await conn.execute("""--sql
+                INSERT INTO public_keys (user_id, public_key)
+                VALUES ($1, $2)
+                ON CONFLICT (user_id)
+                DO UPDATE SET
+                    public_key = EXCLUDED.public_key,
+                    timestamp = CURRENT_TIMESTAMP;
+            """, user_id, public_key)
+        log_event("public_key_saved", user_id=user_id)
+
+    async def get_key(self, user_id: str) -> str | None:
+        """Gets public key from the database"""
+        async with self.__acquire_connection("get_key") as conn:
+            row = await conn.fetchrow("""--sql
+                SELECT public_key FROM public_keys
+                WHERE user_id = $1;
+            """, user_id)
+
+            if row is None:
+                return None
+
+            return row["public_key"]
+
+    async def get_keys(self, user_ids: list[str]) -> dict[str, str | None]:
+        """Gets public keys of several users with one query, None for users without key"""
+        async with self.__acquire_connection("get_keys") as conn:
+            rows = await conn.fetch("""--sql
+                SELECT user_id, public_key FROM public_keys
+                WHERE user_id = ANY($1::varchar[]);
+            """, user_ids)
+
+        public_keys = dict.fromkeys(user_ids)
+        public_keys.update((row["user_id"], row["public_key"]) for row in rows)
+        return public_keys
+
+    async def save_snapshot(self, state: dict) -> None:
+        """Saves state of the server which has to survive restart"""
+        async with self.__acquire_connection("save_snapshot") as conn:
+            await conn.execute("INSERT INTO presence_snapshots (state) VALUES ($1::jsonb);", json.dumps(state))
+
+    async def load_snapshots(self) -> list[dict]:
+        """Removes saved states from the database and returns them in the order they were saved"""
+        async with self.__acquire_connection("load_snapshots") as conn:
+            rows = await conn.fetch("DELETE FROM presence_snapshots RETURNING id, state;")
+        return [json.loads(row["state"]) for row in sorted(rows, key=lambda row: row["id"])]
+
+    async def add_chat_notification(self, recipient_id: str, creator_id: str) -> None:
+        """Stores that creator created chat with recipient, the same pair is stored once"""
+        async with self.__acquire_connection("add_chat_notification") as conn:
+            await conn.execute("""--sql
+                INSERT INTO chat_notifications (recipient_id, creator_id)
+                VALUES ($1, $2)
+                ON CONFLICT (recipient_id, creator_id) DO NOTHING;
+            """, recipient_id, creator_id)
+
+    async def get_chat_notifications(self, recipient_id: str, cursor: int, limit: int) -> list[tuple[int, str]]:
+        """Returns up to limit (id, creator_id) of the recipient with id above cursor, ordered by id"""
+        async with self.__acquire_connection("get_chat_notifications") as conn:
+            rows = await conn.fetch("""--sql
+                SELECT id, creator_id FROM chat_notifications
+                WHERE recipient_id = $1 AND id > $2
+                ORDER BY id
+                LIMIT $3;
+            """, recipient_id, cursor, limit)
+        return [(row["id"], row["creator_id"]) for row in rows]
+
+    async def ack_chat_notifications(self, recipient_id: str, cursor: int) -> None:
+        """Removes notifications of the recipient with id up to cursor, the client has received them"""
+        async with self.__acquire_connection("ack_chat_notifications") as conn:
+            await conn.execute("""--sql
+                DELETE FROM chat_notifications WHERE recipient_id = $1 AND id <= $2;
+            """, recipient_id, cursor)
+
+    async def add_user(self, user_id: str, email: str, password: str) -> bool:
+        """
+        Adds user to the database. Password is expected to be hashed on the server.
+        Returns True if user was added, False if user already exists.
+        Raises DatabaseUnavailableError if database can not be reached.
+        """
+        async with self.__acquire_connection("add_user") as conn:
+            existing_user = await conn.fetchrow("""
+                SELECT id FROM users WHERE user_id = $1 OR email = $2;
+            """, user_id, email)
+
+            if existing_user:
+                log_event("user_already_exists", logging.INFO, user_id=user_id)
+                return False
+
+            try:
+                await conn.execute("""
+                    INSERT INTO users (user_id, email, password)
+                    VALUES ($1, $2, $3);
+                """, user_id, email, password)
+
+            except asyncpg.UniqueViolationError:
+                # User with same id or email was inserted concurrently
+                log_event("user_already_exists", logging.INFO, user_id=user_id)
+                return False
+
+            log_event("user_added", logging.INFO, user_id=user_id)
+            return True
+
+    async def get_user(self, email: str) -> dict | None:
+        """Returns user_id, email and stored password hash of the user with given email"""
+        async with self.__acquire_connection("get_user") as conn:
+            row = await conn.fetchrow("""
+                SELECT user_id, email, password
+                FROM users
+                WHERE email = $1;
+            """, email)
+
+            if row is None:
+                return None
+
+            return {"user_id": row["user_id"], "email": row["email"], "password": row["password"]}
+
+    async def update_password(self, user_id: str, password: str) -> None:
+        """Replaces stored password hash of the user"""
+        async with self.__acquire_connection("update_password") as conn:
+            await conn.execute("UPDATE users SET password = $2 WHERE user_id = $1;", user_id, password)
+
+    async def user_exists(self, user_id: str) -> bool:
+        """Checks if user with given id is registered in the database"""
+        async with self.__acquire_connection("user_exists") as conn:
+            return await conn.fetchval(
+                "SELECT EXISTS(SELECT 1 FROM users WHERE user_id = $1)",
+                user_id
+            )
+
+    async def users_exist(self, user_ids: list[str]) -> dict[str, bool]:
+        """Checks which of the users are registered in the database with one query"""
+        async with self.__acquire_connection("users_exist") as conn:
+            rows = await conn.fetch(
+                "SELECT user_id FROM users WHERE user_id = ANY($1::varchar[])",
+                user_ids
+            )
+
+        existence = dict.fromkeys(user_ids, False)
+        existence.update((row["user_id"], True) for row in rows)
+        return existence
+
+
+def _apply_quota(messages: list[StoredMessage], stored_counts: dict[str, int],
+                 metrics: ServerMetrics | None) -> list[StoredMessage]:
+    """Returns messages which fit into quota of their recipients, stored_counts is updated"""
+    accepted = []
+    for stored_message in messages:
+        target_user_id = stored_message[1]
+        stored_count = stored_counts.get(target_user_id, 0)
+        if stored_count >= MESSAGE_QUOTA_PER_RECIPIENT:
+            if metrics is not None:
+                metrics.stored_messages_dropped.inc(reason="quota")
+            log_event("stored_message_dropped", logging.WARNING, sampled=True, target_user_id=target_user_id)
+            continue
+        stored_counts[target_user_id] = stored_count + 1
+        accepted.append(stored_message)
+    return accepted
+
+
+def _cut_chunk(entries: Iterable[tuple], max_bytes: int) -> list[tuple]:
+    """Takes (id, message, ...) entries until their messages reach max_bytes, the first one is always taken"""
+    chunk = []
+    chunk_bytes = 0
+    for entry in entries:
+        message_bytes = len(entry[1].encode())
+        if chunk and chunk_bytes + message_bytes > max_bytes:
+            break
+        chunk.append(entry)
+        chunk_bytes += message_bytes
+    return chunk
+
+
+class MemoryStorage(Storage):
+    """
+    Storage in process memory, nothing survives restart
+    Used to run the server without database, e.g. in benchmarks and tests
+    """
+    def __init__(self, metrics: ServerMetrics | None = None):
+        self.__metrics = metrics
+        self.__message_ids = itertools.count(1)
+        # (user_id, target_user_id): deque of (id, message, saved at)
+        self.__messages: dict[tuple[str, str], deque] = {}
+        self.__stored_counts: dict[str, int] = {} # target_user_id: number of stored messages
+        self.__keys: dict[str, str] = {} # user_id: public key
+        self.__users: dict[str, dict] = {} # user_id: {"user_id", "email", "password"}
+        self.__users_by_email: dict[str, dict] = {}
+        self.__snapshots: list[dict] = []
+        self.__notification_ids = itertools.count(1)
+        # recipient_id: {creator_id: (id, created at)} in order of id
+        self.__chat_notifications: dict[str, dict[str, tuple[int, float]]] = {}
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def save_messages(self, messages: list[StoredMessage]) -> None:
+        if MESSAGE_QUOTA_PER_RECIPIENT:
+            messages = _apply_quota(messages, dict(self.__stored_counts), self.__metrics)
+        saved_at = time.time()
+        for user_id, target_user_id, message in messages:
+            self.__messages.setdefault((user_id, target_user_id), deque()).append(
+                (next(self.__message_ids), message, saved_at)
+            )
+            self.__stored_counts[target_user_id] = self.__stored_counts.get(target_user_id, 0) + 1
+
+    def __remove_messages(self, key: tuple[str, str], count: int):
+        queue = self.__messages[key]
+        for _ in range(count):
+            queue.popleft()
+        if not queue:
+            del self.__messages[key]
+        target_user_id = key[1]
+        self.__stored_counts[target_user_id] -= count
+        if not self.__stored_counts[target_user_id]:
+            del self.__stored_counts[target_user_id]
+
+    async def maintain(self) -> None:
+        """Removes messages and chat notifications older than retention"""
+        expired_before = time.time() - MESSAGE_RETENTION_DAYS * 24 * 60 * 60
+        for key, queue in list(self.__messages.items()):
+            expired = sum(1 for _ in itertools.takewhile(lambda entry: entry[2] < expired_before, queue))
+            if expired:
+                self.__remove_messages(key, expired)
+
+        expired_before = time.time() - CHAT_NOTIFICATION_RETENTION_DAYS * 24 * 60 * 60
+        for recipient_id, notifications in list(self.__chat_notifications.items()):
+            for creator_id, (_, created_at) in list(notifications.items()):
+                if created_at < expired_before:
+                    del notifications[creator_id]
+            if not notifications:
+                del self.__chat_notifications[recipient_id]
+
+    async def drain_messages(self, user_id: str, target_user_id: str, chunk_size: int, max_bytes: int,
+                             send_chunk: SendChunk) -> None:
+        key = (target_user_id, user_id)
+        cursor = 0
+        has_more = True
+        while has_more:
+            queue = self.__messages.get(key, ())
+            chunk = _cut_chunk(itertools.islice(queue, chunk_size), max_bytes)
+            if chunk:
+                cursor = chunk[-1][0]
+            has_more = len(chunk) == chunk_size or len(chunk) < len(queue)
+
+            await send_chunk([message for _, message, _ in chunk], cursor, has_more)
+
+            # Chunk is removed only after it was sent
+            if chunk:
+                self.__remove_messages(key, len(chunk))
+
+    async def save_key(self, user_id: str, public_key: str) -> None:
+        self.__keys[user_id] = public_key
+
+    async def get_key(self, user_id: str) -> str | None:
+        return self.__keys.get(user_id)
+
+    async def get_keys(self, user_ids: list[str]) -> dict[str, str | None]:
+        return {user_id: self.__keys.get(user_id) for user_id in user_ids}
+
+    async def save_snapshot(self, state: dict) -> None:
+        self.__snapshots.append(state)
+
+    async def load_snapshots(self) -> list[dict]:
+        snapshots, self.__snapshots = self.__snapshots, []
+        return snapshots
+
+    async def add_chat_notification(self, recipient_id: str, creator_id: str) -> None:
+        notifications = self.__chat_notifications.setdefault(recipient_id, {})
+        if creator_id not in notifications:
+            notifications[creator_id] = (next(self.__notification_ids), time.time())
+
+    async def get_chat_notifications(self, recipient_id: str, cursor: int, limit: int) -> list[tuple[int, str]]:
+        notifications = self.__chat_notifications.get(recipient_id, {}).items()
+        return [(notification_id, creator_id) for creator_id, (notification_id, _) in notifications
+                if notification_id > cursor][:limit]
+
+    async def ack_chat_notifications(self, recipient_id: str, cursor: int) -> None:
+        notifications = self.__chat_notifications.get(recipient_id)
+        if notifications is None:
+            return
+        for creator_id, (notification_id, _) in list(notifications.items()):
+            if notification_id <= cursor:
+                del notifications[creator_id]
+        if not notifications:
+            del self.__chat_notifications[recipient_id]
+
+    async def add_user(self, user_id: str, email: str, password: str) -> bool:
+        if user_id in self.__users or email in self.__users_by_email:
+            return False
+        user = {"user_id": user_id, "email": email, "password": password}
+        self.__users[user_id] = user
+        self.__users_by_email[email] = user
+        return True
+
+    async def get_user(self, email: str) -> dict | None:
+        user = self.__users_by_email.get(email)
+        return dict(user) if user is not None else None
+
+    async def update_password(self, user_id: str, password: str) -> None:
+        self.__users[user_id]["password"] = password
+
+    async def user_exists(self, user_id: str) -> bool:
+        return user_id in self.__users
+
+    async def users_exist(self, user_ids: list[str]) -> dict[str, bool]:
+        return {user_id: user_id in self.__users for user_id in user_ids}
+
+
+class SqliteStorage(Storage):
+    """
+    Storage in SQLite file, for single host deployments and CI without database server
+    Queries run one by one in a dedicated thread so they do not block the event loop,
+    each operation is one transaction and batches are written with executemany
+    """
+    # NORMAL in WAL mode may lose the last transactions on power loss but never corrupts the file
+    SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+    SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "5")) # Waiting for lock held by other process
+    SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", str(16 * 1024)))
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            target_user_id TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_target_user_id_user_id_id_idx
+            ON messages (target_user_id, user_id, id);
+        CREATE INDEX IF NOT EXISTS messages_timestamp_idx ON messages (timestamp);
+
+        CREATE TABLE IF NOT EXISTS public_keys (
+            user_id TEXT PRIMARY KEY,
+            public_key TEXT NOT NULL,
+            timestamp REAL NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT NOT NULL UNIQUE,
+            email TEXT NOT NULL UNIQUE,
+            password TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS presence_snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            state TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS chat_notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient_id TEXT NOT NULL,
+            creator_id TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            UNIQUE (recipient_id, creator_id)
+        );
+        CREATE INDEX IF NOT EXISTS chat_notifications_recipient_id_id_idx
+            ON chat_notifications (recipient_id, id);
+    """
+
+    def __init__(self, path: str, metrics: ServerMetrics | None = None):
+        self.__path = path
+        self.__metrics = metrics
+        self.__connection: sqlite3.Connection | None = None
+        self.__executor: ThreadPoolExecutor | None = None
+        self.__pending_operations = 0
+
+    @property
+    def pending_operations(self) -> int:
+        """Number of operations which wait for the storage thread or run"""
+        return self.__pending_operations
+
+    async def open(self):
+        """Opens the file in WAL mode, so readers of other processes do not block the writer, and creates schema"""
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-storage")
+        try:
+            self.__connection = await asyncio.get_running_loop().run_in_executor(self.__executor, self.__connect)
+        except sqlite3.Error as e:
+            raise DatabaseUnavailableError(f"{type(e).__name__}: {e}") from e
+
+    def __connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.__path, timeout=self.SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode = WAL;")
+        connection.execute(f"PRAGMA synchronous = {self.SQLITE_SYNCHRONOUS};")
+        connection.execute(f"PRAGMA cache_size = -{self.SQLITE_CACHE_SIZE_KB};")
+        connection.execute("PRAGMA temp_store = MEMORY;")
+        connection.executescript(self.SCHEMA)
+        return connection
+
+    async def close(self):
+        if self.__connection is not None:
+            connection, self.__connection = self.__connection, None
+            await asyncio.get_running_loop().run_in_executor(self.__executor, connection.close)
+        if self.__executor is not None:
+            self.__executor.shutdown()
+            self.__executor = None
+
+    async def __execute(self, query: str, operation: Callable[..., Any], *args) -> Any:
+        """
+        Runs operation(connection, *args) in the storage thread as one transaction
+        Failures are raised as DatabaseUnavailableError, time including wait for the thread is reported
+        under the query name
+        """
+        if self.__connection is None:
+            raise DatabaseUnavailableError("Database is not opened.")
+
+        start = time.perf_counter()
+        self.__pending_operations += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.__executor, self.__run_transaction, operation, args
+            )
+        except sqlite3.Error as e:
+            raise DatabaseUnavailableError(f"{type(e).__name__}: {e}") from e
+        finally:
+            self.__pending_operations -= 1
+            if self.__metrics is not None:
+                self.__metrics.db_query_duration.observe(time.perf_counter() - start, query=query)
+
+    def __run_transaction(self, operation: Callable[..., Any], args: tuple) -> Any:
+        with self.__connection: # Commits on success, rolls back on exception
+            return operation(self.__connection, *args)
+
+    async def save_messages(self, messages: list[StoredMessage]) -> None:
+        """
+        Saves batch of (user_id, target_user_id, message) rows with one statement
+        Messages to recipients who reached MESSAGE_QUOTA_PER_RECIPIENT are dropped
+        """
+        if MESSAGE_QUOTA_PER_RECIPIENT:
+            target_user_ids = json.dumps(list({target_user_id for _, target_user_id, _ in messages}))
+            rows = await self.__execute("save_messages", lambda conn: conn.execute("""
+                SELECT target_user_id, COUNT(*) FROM messages
+                WHERE target_user_id IN (SELECT value FROM json_each(?))
+                GROUP BY target_user_id;
+            """, (target_user_ids,)).fetchall())
+            messages = _apply_quota(messages, dict(rows), self.__metrics)
+
+        if messages:
+            saved_at = time.time()
+            await self.__execute("save_messages", lambda conn: conn.executemany("""
+                INSERT INTO messages (user_id, target_user_id, message, timestamp)
+                VALUES (?, ?, ?, ?);
+            """, [(user_id, target_user_id, message, saved_at) for user_id, target_user_id, message in messages]))
+
+    async def maintain(self) -> None:
+        """Deletes messages and chat notifications older than retention and refreshes query planner statistics"""
+        def delete_expired(conn: sqlite3.Connection, now: float) -> tuple[int, int]:
+            deleted = conn.execute(
+                "DELETE FROM messages WHERE timestamp < ?;", (now - MESSAGE_RETENTION_DAYS * 24 * 60 * 60,)
+            ).rowcount
+            expired_notifications = conn.execute(
+                "DELETE FROM chat_notifications WHERE created_at < ?;",
+                (now - CHAT_NOTIFICATION_RETENTION_DAYS * 24 * 60 * 60,)
+            ).rowcount
+            conn.execute("PRAGMA optimize;")
+            return deleted, expired_notifications
+
+        deleted, expired_notifications = await self.__execute("maintain_messages", delete_expired, time.time())
+        log_event("messages_maintained", logging.INFO, expired_rows=deleted,
+                  expired_chat_notifications=expired_notifications)
+
+    async def drain_messages(self, user_id: str, target_user_id: str, chunk_size: int, max_bytes: int,
+                             send_chunk: SendChunk) -> None:
+        """
+        Reads messages from target user to specified user in chunks ordered by id
+        Each chunk is passed to send_chunk(messages, cursor, has_more) and deleted only after it succeeds,
+        cursor is the id of the last message in the chunk
+        """
+        cursor = 0
+        has_more = True
+        while has_more:
+            candidates = await self.__execute("drain_messages", lambda conn, after_id: conn.execute("""
+                SELECT id, message FROM messages
+                WHERE target_user_id = ? AND user_id = ? AND id > ?
+                ORDER BY id
+                LIMIT ?;
+            """, (user_id, target_user_id, after_id, chunk_size)).fetchall(), cursor)
+            chunk = _cut_chunk(candidates, max_bytes)
+            if chunk:
+                cursor = chunk[-1][0]
+            has_more = len(chunk) == chunk_size or len(chunk) < len(candidates)
+
+            await send_chunk([message for _, message in chunk], cursor, has_more)
+
+            if chunk:
+                await self.__execute("drain_messages", lambda conn, first_id, last_id: conn.execute("""
+                    DELETE FROM messages
+                    WHERE target_user_id = ? AND user_id = ? AND id BETWEEN ? AND ?;
+                """, (user_id, target_user_id, first_id, last_id)), chunk[0][0], cursor)
+
+    async def save_key(self, user_id: str, public_key: str) -> None:
+        await self.__execute("save_key", lambda conn: conn.execute("""
+            INSERT INTO public_keys (user_id, public_key, timestamp)
+            VALUES (?, ?, ?)
+            ON CONFLICT (user_id)
+            DO UPDATE SET
+                public_key = excluded.public_key,
+                timestamp = excluded.timestamp;
+        """, (user_id, public_key, time.time())))
+        log_event("public_key_saved", user_id=user_id)
+
+    async def get_key(self, user_id: str) -> str | None:
+        row = await self.__execute("get_key", lambda conn: conn.execute(
+            "SELECT public_key FROM public_keys WHERE user_id = ?;", (user_id,)
+        ).fetchone())
+        return row[0] if row is not None else None
+
+    async def get_keys(self, user_ids: list[str]) -> dict[str, str | None]:
+        """Gets public keys of several users with one query, ids are passed as one JSON parameter"""
+        rows = await self.__execute("get_keys", lambda conn: conn.execute("""
+            SELECT user_id, public_key FROM public_keys
+            WHERE user_id IN (SELECT value FROM json_each(?));
+        """, (json.dumps(user_ids),)).fetchall())
+
+        public_keys = dict.fromkeys(user_ids)
+        public_keys.update(rows)
+        return public_keys
+
+    async def save_snapshot(self, state: dict) -> None:
+        await self.__execute("save_snapshot", lambda conn: conn.execute(
+            "INSERT INTO presence_snapshots (state) VALUES (?);", (json.dumps(state),)
+        ))
+
+    async def load_snapshots(self) -> list[dict]:
+        def take_snapshots(conn: sqlite3.Connection) -> list[tuple[int, str]]:
+            rows = conn.execute("SELECT id, state FROM presence_snapshots ORDER BY id;").fetchall()
+            if rows:
+                conn.execute("DELETE FROM presence_snapshots WHERE id <= ?;", (rows[-1][0],))
+            return rows
+
+        rows = await self.__execute("load_snapshots", take_snapshots)
+        return [json.loads(state) for _, state in rows]
+
+    async def add_chat_notification(self, recipient_id: str, creator_id: str) -> None:
+        await self.__execute("add_chat_notification", lambda conn: conn.execute("""
+            INSERT INTO chat_notifications (recipient_id, creator_id, created_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT (recipient_id, creator_id) DO NOTHING;
+        """, (recipient_id, creator_id, time.time())))
+
+    async def get_chat_notifications(self, recipient_id: str, cursor: int, limit: int) -> list[tuple[int, str]]:
+        return await self.__execute("get_chat_notifications", lambda conn: conn.execute("""
+            SELECT id, creator_id FROM chat_notifications
+            WHERE recipient_id = ? AND id > ?
+            ORDER BY id
+            LIMIT ?;
+        """, (recipient_id, cursor, limit)).fetchall())
+
+    async def ack_chat_notifications(self, recipient_id: str, cursor: int) -> None:
+        await self.__execute("ack_chat_notifications", lambda conn: conn.execute(
+            "DELETE FROM chat_notifications WHERE recipient_id = ? AND id <= ?;", (recipient_id, cursor)
+        ))
+
+    async def add_user(self, user_id: str, email: str, password: str) -> bool:
+        def insert_user(conn: sqlite3.Connection) -> bool:
+            try:
+                conn.execute("INSERT INTO users (user_id, email, password) VALUES (?, ?, ?);",
+                             (user_id, email, password))
+            except sqlite3.IntegrityError:
+                return False
+            return True
+
+        added = await self.__execute("add_user", insert_user)
+        log_event("user_added" if added else "user_already_exists", logging.INFO, user_id=user_id)
+        return added
+
+    async def get_user(self, email: str) -> dict | None:
+        row = await self.__execute("get_user", lambda conn: conn.execute(
+            "SELECT user_id, email, password FROM users WHERE email = ?;", (email,)
+        ).fetchone())
+        if row is None:
+            return None
+        return {"user_id": row[0], "email": row[1], "password": row[2]}
+
+    async def update_password(self, user_id: str, password: str) -> None:
+        await self.__execute("update_password", lambda conn: conn.execute(
+            "UPDATE users SET password = ? WHERE user_id = ?;", (password, user_id)
+        ))
+
+    async def user_exists(self, user_id: str) -> bool:
+        row = await self.__execute("user_exists", lambda conn: conn.execute(
+            "SELECT 1 FROM users WHERE user_id = ?;", (user_id,)
+        ).fetchone())
+        return row is not None
+
+    async def users_exist(self, user_ids: list[str]) -> dict[str, bool]:
+        rows = await self.__execute("users_exist", lambda conn: conn.execute(
+            "SELECT user_id FROM users WHERE user_id IN (SELECT value FROM json_each(?));", (json.dumps(user_ids),)
+        ).fetchall())
+
+        existence = dict.fromkeys(user_ids, False)
+        existence.update((user_id, True) for user_id, in rows)
+        return existence
+
+
+def create_storage(backend: str, database_url: str | None = None, sqlite_path: str = "",
+                   metrics: ServerMetrics | None = None) -> Storage:
+    """Returns storage engine, backend is "postgres", "sqlite" or "memory" """
+    if backend == "postgres":
+        return PostgresStorage(database_url, metrics)
+    if backend == "sqlite":
+        return SqliteStorage(sqlite_path, metrics)
+    if backend == "memory":
+        return MemoryStorage(metrics)
+    raise ValueError(f"Unsupported storage backend: {backend}")
@@ -1,10 +1,15 @@
 CREATE TABLE IF NOT EXISTS messages (
-    id SERIAL PRIMARY KEY,
+    id BIGSERIAL NOT NULL,
     user_id VARCHAR(100) NOT NULL,
     target_user_id VARCHAR(100) NOT NULL,
     message TEXT NOT NULL,
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT;
+
+CREATE INDEX IF NOT EXISTS messages_target_user_id_user_id_id_idx
+    ON messages (target_user_id, user_id, id);
 
 CREATE TABLE IF NOT EXISTS public_keys (
     user_id VARCHAR(100) PRIMARY KEY,
@@ -16,6 +21,6 @@ CREATE TABLE IF NOT EXISTS users (
     id SERIAL PRIMARY KEY,
     user_id VARCHAR(100) NOT NULL UNIQUE,
     email VARCHAR(100) NOT NULL UNIQUE,
-    password VARCHAR(100) NOT NULL,
+    password TEXT NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
\ No newline at end of file